@@ -1,33 +1,409 @@
 import os
+import time
+import hashlib
+import threading
 import chromadb
 from dotenv import load_dotenv
+from faq_index import FAQIndex, normalize_question
+from question_router import QuestionRouter
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from context_budget import ContextBudget, estimate_tokens
+from metrics import REGISTRY, STAGE_SECONDS, stage
+from single_flight import SingleFlight
+from embedding_cache import CachedEmbeddings, open_embedding_cache
+from embedding_pipeline import EmbeddingPipeline
+from product_catalog import ProductCatalog, product_metadata, render_product
 from langchain_chroma import Chroma
-from get_client_data import GetData
 from langchain.schema import Document
-from langchain_community.document_loaders import TextLoader
+from langchain_core.runnables import RunnableParallel, RunnablePassthrough
 from langchain_core.messages import HumanMessage, AIMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_core.output_parsers import StrOutputParser
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 
 load_dotenv()
 
+# Chroma rejects oversized upserts, so documents are written in batches of this size
+INDEX_BATCH_SIZE = 500
+# Documents retrieved per question, and candidates taken from each retriever before fusion
+RETRIEVAL_K = 5
+FUSION_CANDIDATES = 10
+EMBEDDING_MODEL = 'models/embedding-001'
+
+
+def content_hash(text):
+    '''
+    Stable id for a chunk: the same text always maps to the same vector store row
+    '''
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def versioned_collection_name(base_name, version):
+    return f"{base_name}_v{version}"
+
+
+def close_client(chroma_client):
+    # Chroma keeps one system per directory until its last client is closed (chromadb >= 1.0)
+    close = getattr(chroma_client, 'close', None)
+    if close is not None:
+        close()
+
+
+def drop_collection(persist_directory, collection_name):
+    chroma_client = chromadb.PersistentClient(path=persist_directory)
+    try:
+        chroma_client.delete_collection(collection_name)
+    except Exception as e:
+        print(f"[WARNING] Could not delete collection {collection_name}: {e}")
+    finally:
+        close_client(chroma_client)
+
+
+def list_collection_versions(persist_directory, base_name):
+    '''
+    Versions of the `base_name` collections stored in `persist_directory`, oldest first
+    '''
+    chroma_client = chromadb.PersistentClient(path=persist_directory)
+    prefix = f"{base_name}_v"
+    versions = []
+    try:
+        for collection in chroma_client.list_collections():
+            name = getattr(collection, 'name', collection)  # Older chromadb returns bare names
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                versions.append(int(name[len(prefix):]))
+    finally:
+        close_client(chroma_client)
+    return sorted(versions)
+
+
+# Default instructions for the answer LLM, a tenant can bring its own
+QA_SYSTEM_PROMPT = (
+    "You are a customer support assistant for a business that sells electronics."
+    "Your primary role is to provide helpful, accurate information about the business, its products, and services. You should only answer questions related to the business and its offerings."
+
+    "You have access to live product listings, including their prices, specifications, and categories. When a user asks about a product, "
+    "extract relevant product information from the provided context. "
+    "If a user asks about a product’s price, availability, or description, answer directly using the given data. "
+    "If the information is missing, tell them you couldn't find the details, and redirect them to the website or the human customer support, by giving them the contact details"
+    "website: electronest.com, call/whatsapp: 07069117393, gmail: electronest@gmail.com"
+
+    "Instructions:"
+    'If the user greets (e.g., "Hello", "Hi", "Good day"), respond with a friendly greeting introducing the business. Example:'
+    "Hello! Welcome to ElectroNest, your go-to store for the latest electronics. How can I assist you today?"
+    'If the user asks about the business (e.g., "What do you do?", "Tell me about your company"), provide details about the store and its products.'
+    'If the user asks who made you or who you are, reply as a customer support assistant for ElectroNest. Example:'
+    "I am an AI-powered customer support assistant for ElectroNest, here to help you with electronics inquiries and purchases."
+    'If the user asks something unrelated (e.g., politics, weather, who is the president, and sot of un-realted question that does not concern a customer support assistant), politely redirect them back to the business context. Example:'
+    "I'm here to assist with electronics-related queries. How can I help you today?"
+    'You would be given a list of products or faqs, when given product, if the amount in stock is mush just tell them we have a lot in stock, not the exact amount we have in stocks. If we have few you can tell them the amount we have in stock. Few can be anything less than 5'
+
+    'Example Queries:'
+    'How much is the iPhone 15?: The iPhone 15 costs $999.'
+    "Do you have gaming laptops?: Yes, we have gaming laptops including Alienware, Razer, and ASUS ROG models."
+    "What is the warranty on a Samsung TV?: The Samsung TV comes with a 1-year manufacturer warranty."
+    "What can you say about today's weather: I am a customer support assistant, and I'm here to support you with your queries concerning ElectroNest"
+    '1+1 is what: Sorry, I cant give you information about that, i am customer support assisitant for ElectroNest'
+
+    'Important:'
+    'Always provide responses in a friendly and professional tone, staying within the electronics business domain.'
+    'Never Never Never Never answer any unrelated questions that doesnt concern the business and a customer support assistant'
+    'You are limited to the companys information alone'
+    'Act like a customer support assistant, with so much marketing skills, parsuade the customer by all means to buy your product'
+    'Make your responses straightforward and cocise, making sure the customer is satisfied by your responses, no need of unecessary info the customer didnt ask of'
+)
+
+# Default instructions for rewriting a follow-up into a standalone question, a tenant can bring
+# its own
+CONTEXTUALIZE_SYSTEM_PROMPT = (
+    "You are assisting with reformulating user questions within the context of a electrical appliances store business. "
+    "Your goal is to ensure that the user's query is interpreted correctly in relation to the company's services."
+    "and that the right information regarding the users query is retireved from a database of the business\n\n"
+
+    "**Instructions:**\n"
+    "- If a user greets you (e.g., 'Hello', 'Hi'), reframe the question as a request for a request about the business.\n"
+    "- If a user asks who you are, reframe it to clarify that you are an AI-powered assistant for the business.\n"
+    "- If the user asks unrelated questions (e.g., about technology, general AI, or external topics), gently guide them back to electric store business-related topics.\n"
+    "- Keep all questions strictly within the scope of the business and its services."
+    "- always reformulate any question that is out of the scope of the business, or unrelated, to be guided back to the electric store business-related topics"
+)
+
+
+def escape_braces(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def restrict_products(ranking, category, products=()):
+    '''
+    Replace the products of `ranking` (a list of (chunk_id, Document)) that are not in
+    `category` with the next of `products`, a ranking of that category's products, keeping
+    the FAQ and About chunks at their rank
+    '''
+    seen = {chunk_id for chunk_id, _ in ranking}
+    replacements = iter([(chunk_id, document) for chunk_id, document in products
+                         if chunk_id not in seen])
+    restricted = []
+    for chunk_id, document in ranking:
+        if document.metadata.get("section") == "product" and document.metadata.get("category") != category:
+            replacement = next(replacements, None)
+            if replacement is not None:
+                restricted.append(replacement)
+        else:
+            restricted.append((chunk_id, document))
+    return restricted
+
+
+class RAGChain():
+    '''
+    Long-lived retrieval chain, built once per vector store and shared by every request.
+    The underlying runnables hold no per-request state, so `answer` is safe to call from
+    several Flask worker threads at once.
+
+    Args:
+     - retrieval_chain: Runnable adding the retrieved documents to the inputs, from
+       `RAG.query_LLM`
+     - answer_chain: Runnable producing the answer text from the inputs and documents
+     - contextualize_chain: Runnable rewriting a follow-up into a standalone question
+     - debug: Print the documents the chain retrieved for every question
+     - faq_index: Optional FAQIndex answering close FAQ matches without calling the LLM
+     - response_cache: Optional ScopedResponseCache of answers keyed on the standalone question
+     - router: QuestionRouter deciding which questions need the rewrite call
+     - context_budget: ContextBudget bounding the history sent to the LLM and logging the
+       input tokens of every request
+     - single_flight: Optional SingleFlight sharing one retrieval and answer call between
+       concurrent requests with the same standalone question
+    '''
+
+    def __init__(self, retrieval_chain, answer_chain, contextualize_chain=None, debug=False,
+                 faq_index=None, response_cache=None, router=None, context_budget=None,
+                 single_flight=None):
+        self.retrieval_chain = retrieval_chain
+        self.answer_chain = answer_chain
+        self.contextualize_chain = contextualize_chain
+        self.router = router or QuestionRouter()
+        self.context_budget = context_budget or ContextBudget()
+        self.debug = debug
+        self.faq_index = faq_index
+        self.response_cache = response_cache
+        self.single_flight = single_flight
+
+    @staticmethod
+    def format_chat_history(chat_history):
+        formatted_chat_history = []
+        for message in chat_history:
+            if message["sender"] == "user":
+                formatted_chat_history.append(
+                    HumanMessage(content=message["text"]))
+            elif message['sender'] == 'bot':
+                formatted_chat_history.append(
+                    AIMessage(content=message["text"]))
+        return formatted_chat_history
+
+    @staticmethod
+    def append_turn(chat_history, prompt, answer):
+        # Store as JSON format for Firebase
+        return chat_history + [
+            {"text": prompt, "sender": "user"},
+            {"text": answer, "sender": "bot"},
+        ]
+
+    @staticmethod
+    def count_answer(path):
+        REGISTRY.counter("chatbot_answers", "Answers, by the path that produced them",
+                         path=path).inc()
+
+    def standalone_question(self, prompt, formatted_history):
+        '''
+        The question rewritten to stand on its own, using the chat history for context.
+        The rewrite LLM call is skipped when there is no history or the question is already
+        self-contained, see QuestionRouter.
+        '''
+        start = time.perf_counter()
+        path = self.router.route(prompt, formatted_history)
+        question = prompt
+        if path == "rewritten" and self.contextualize_chain is not None:
+            with stage("rewrite_llm"):
+                question = self.contextualize_chain.invoke(
+                    {"input": prompt, "chat_history": formatted_history})
+        self.router.observe(path, time.perf_counter() - start)
+        return question
+
+    def prepare(self, prompt, chat_history):
+        '''
+        Everything that happens before the answer LLM call: FAQ fast path, history budget,
+        question rewrite and response cache lookup
+
+        returns:
+         - An answer that needs no LLM call, or None
+         - The inputs of the retrieval chain
+         - The chat history before the budget was applied
+        '''
+        if self.faq_index is not None:
+            with stage("faq_match"):
+                faq_answer, _ = self.faq_index.match(prompt)
+            if faq_answer is not None:
+                self.count_answer("faq")
+                return faq_answer, None, None
+
+        raw_history = self.format_chat_history(chat_history)
+        formatted_history = self.context_budget.compress_history(raw_history)
+        question = self.standalone_question(prompt, formatted_history)
+        if self.response_cache is not None:
+            with stage("response_cache_lookup"):
+                cached_answer = self.response_cache.get(question)
+            if cached_answer is not None:
+                self.count_answer("response_cache")
+                return cached_answer, None, None
+
+        inputs = {"input": prompt,
+                  "standalone_question": question,
+                  "chat_history": formatted_history}
+        return None, inputs, raw_history
+
+    def finish(self, inputs, raw_history, answer):
+        self.count_answer("llm")
+        context = inputs.get("context", [])
+        self.context_budget.record(inputs["input"], inputs["chat_history"], context,
+                                   raw_history, inputs.get("raw_context"))
+        if self.response_cache is not None:
+            self.response_cache.put(inputs["standalone_question"], answer, context)
+
+        if self.debug:
+            # The chain already returns the documents it retrieved, no second lookup needed
+            print("\n🔹 Retrieved Documents:")
+            for i, doc in enumerate(context, 1):
+                print(f"{i}. {doc.page_content} - Metadata: {doc.metadata}")
+
+    def answer(self, prompt, chat_history):
+        '''
+        Answer a question given the user's recent chat history
+
+        returns:
+         - The answer text
+         - The chat history with the new user message and bot reply appended
+        '''
+        answer, inputs, raw_history = self.prepare(prompt, chat_history)
+        if answer is not None:
+            return answer, self.append_turn(chat_history, prompt, answer)
+
+        if self.single_flight is None:
+            answer = self.generate(inputs, raw_history)
+        else:
+            answer, shared = self.single_flight.do(
+                normalize_question(inputs["standalone_question"]),
+                lambda: self.generate(inputs, raw_history))
+            if shared:
+                self.count_answer("coalesced")
+        return answer, self.append_turn(chat_history, prompt, answer)
+
+    def generate(self, inputs, raw_history):
+        # Process the user's query through the retrieval chain
+        with stage("retrieval"):
+            inputs = self.retrieval_chain.invoke(inputs)
+        with stage("answer_llm"):
+            answer = self.answer_chain.invoke(inputs)
+
+        self.finish(inputs, raw_history, answer)
+        return answer
+
+    def stream(self, prompt, chat_history):
+        '''
+        Answer a question like `answer`, yielding the answer text piece by piece as the LLM
+        generates it. A FAQ fast path, cached answer or an answer shared by a concurrent
+        request with the same question comes out as a single piece.
+
+        The caller joins the pieces and stores the turn once the generator is exhausted,
+        see `append_turn`.
+        '''
+        answer, inputs, raw_history = self.prepare(prompt, chat_history)
+        if answer is not None:
+            yield answer
+            return
+
+        flight = key = None
+        if self.single_flight is not None:
+            key = normalize_question(inputs["standalone_question"])
+            flight, leader = self.single_flight.join(key)
+            if not leader:
+                answer = self.single_flight.wait(flight)
+                if answer is not None:
+                    self.count_answer("coalesced")
+                    yield answer
+                    return
+                flight = None  # Gave up on the leader, answer without leading a flight
+
+        answer = None
+        try:
+            with stage("retrieval"):
+                inputs = self.retrieval_chain.invoke(inputs)
+            pieces = []
+            start = time.perf_counter()
+            for piece in self.answer_chain.stream(inputs):
+                if not pieces:
+                    REGISTRY.histogram(STAGE_SECONDS, stage="answer_llm_first_token").observe(
+                        time.perf_counter() - start)
+                pieces.append(piece)
+                yield piece
+            REGISTRY.histogram(STAGE_SECONDS, stage="answer_llm").observe(
+                time.perf_counter() - start)
+            answer = "".join(pieces)
+        finally:
+            # Followers get the answer, or run their own if the client went away mid-stream
+            if flight is not None:
+                self.single_flight.complete(key, flight, answer, failed=answer is None)
+
+        self.finish(inputs, raw_history, answer)
+
 
 class RAG():
-    def __init__(self, text_file, dataset, path='./faq_db'):
+    def __init__(self, text_file, dataset, path='./faq_db', llm=None, embeddings=None,
+                 persist_directory='./chroma_db', collection_name='knowledge_base', catalog=None,
+                 response_cache=None, system_prompt=None, rewrite_prompt=None):
         self.path = path
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
         self.text_file = text_file
         self.dataset = dataset
-        self.llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+        if llm is None:
+            # Imported on demand, the Gemini client libraries are slow to import
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+        self.llm = llm
+        self.embeddings = embeddings
+        # Start from the previous version's catalog so a refresh only re-indexes changed rows
+        self.catalog = catalog or ProductCatalog()
+        # Shared ResponseCache, this instance only reads and writes its own collection's scope
+        self.response_cache = response_cache
+        # Instructions for the answer LLM, the business's own or the default ElectroNest ones
+        self.system_prompt = system_prompt or QA_SYSTEM_PROMPT
+        # Instructions for rewriting follow-ups into standalone questions
+        self.rewrite_prompt = rewrite_prompt or CONTEXTUALIZE_SYSTEM_PROMPT
+        self.debug = os.getenv('RAG_DEBUG', '').lower() in ('1', 'true', 'yes')
+        self.faq_cutoff = float(os.getenv('FAQ_MATCH_CUTOFF', 0.9))
+        # Seconds a request waits on an identical in-flight question, 0 disables coalescing
+        self.coalesce_timeout = float(os.getenv('COALESCE_TIMEOUT', 30))
+        # 'hybrid' fuses BM25 with vector search, 'vector' searches embeddings only
+        self.retrieval_mode = os.getenv('RETRIEVAL_MODE', 'hybrid').lower()
+        self.lexical_index = None
+        self.context_budget = ContextBudget(
+            context_tokens=int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500)),
+            history_tokens=int(os.getenv('HISTORY_TOKEN_BUDGET', 400)))
+        self.documents = None
         self.retriever = None
         self.vectorstore = None
         self.rag_chain = None
-
-    def update_knowledge_base(self, about, products):
-        with open(self.text_file, "w", encoding="utf-8") as f:
+        self.retrieval_chain = None
+        self.answer_chain = None
+        self.contextualize_chain = None
+        self.chain = None
+        self.index_stats = None
+        self.chroma_client = None
+        self._chain_lock = threading.Lock()
+
+    def update_knowledge_base(self, about, products, delta=None):
+        # Write next to the live file and swap it in, so readers never see a half-written file
+        tmp_file = f"{self.text_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
             f.write("## About the Business\n")
             f.write(about + "\n\n")
 
@@ -59,65 +435,288 @@ class RAG():
 
             f.write("\n## Product Listings/Phones/Electrical Appliances\n\n")
             for product in products:
-                product_line = (
-                    f"Product ID: {product.get('Product ID', 'N/A')}\n"
-                    f"Name: {product.get('Product Name', 'N/A')}\n"
-                    f"Category: {product.get('Category', 'N/A')}\n"
-                    f"Brand: {product.get('Brand', 'N/A')}\n"
-                    f"Model: {product.get('Model', 'N/A')}\n"
-                    f"Description: {product.get('Description', 'N/A')}\n"
-                    f"Specifications: {product.get('Specifications', 'N/A')}\n"
-                    f"Price: {product.get('Price', 'N/A')}\n"
-                    f"Stock: {product.get('Stock', 'N/A')}\n"
-                    f"Warranty: {product.get('Warranty', 'N/A')}\n\n"
-                    f"---\n\n"
-                )
-                f.write(product_line)
-
-    def create_vector_store(self):
+                f.write(render_product(product))
+        os.replace(tmp_file, self.text_file)
+
+        self.catalog, counts = self.catalog.updated(products, delta)
+        print(f"[INFO] Product catalog: {len(self.catalog)} products ({counts['added']} added, "
+              f"{counts['updated']} updated, {counts['removed']} removed)")
+        self.documents = self.build_documents(about, products)
+
+    def build_documents(self, about, products):
+        '''
+        Build the documents to index: one per product and one per FAQ entry, so no record is
+        ever cut in half, plus the About section in paragraph-sized pieces. Each document
+        carries structured metadata (section, and for products category, brand, price band
+        and stock) that retrieval can filter on.
+        '''
+        documents = []
+        about_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=0)
+        for chunk in about_splitter.split_text(about.strip()):
+            documents.append(Document(page_content=chunk, metadata={"section": "about"}))
+
+        for faq in self.dataset:
+            if "question" in faq and "answer" in faq:
+                text = f"Q: {faq['question']}\nA: {faq['answer']}"
+            else:  # Changes based on the company's faqs structure format
+                text = "\n".join(f"{key}: {value}" for key, value in faq.items())
+            documents.append(Document(page_content=text, metadata={"section": "faq"}))
+
+        for product in products:
+            documents.append(Document(page_content=render_product(product, separator=False),
+                                      metadata=product_metadata(product)))
+        return documents
+
+    def create_vector_store(self, seed_collection=None):
+        '''
+        Index the documents built by `update_knowledge_base` into `self.collection_name`,
+        falling back to splitting the knowledge base file when there are none.
+
+        Args:
+         - seed_collection: Name of another collection in the same persist directory (e.g. the
+           version currently being served). Chunks already stored there are copied with their
+           embeddings instead of being embedded again.
+        '''
         # # Initialize Embeddings
         print('[INFO] Creating Vectorstore in Persistent Dir')
-        embeddings = GoogleGenerativeAIEmbeddings(model='models/embedding-001')
-
-        if not os.path.exists(self.text_file):
-            print("Knowledge base file not found!")
-            return
-
-        loader = TextLoader(self.text_file)
-        documents = loader.load()
-
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500, chunk_overlap=100
-        )
-        chunks = text_splitter.split_documents(documents)
+        if self.embeddings is None:
+            self.embeddings = self.default_embeddings()
+        embeddings = self.embeddings
+
+        if self.documents is not None:
+            # Record-aware documents built by update_knowledge_base
+            chunks = self.documents
+        else:
+            if not os.path.exists(self.text_file):
+                print("Knowledge base file not found!")
+                return
+
+            from langchain_community.document_loaders import TextLoader
+            loader = TextLoader(self.text_file)
+            documents = loader.load()
+
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=500, chunk_overlap=100
+            )
+            chunks = text_splitter.split_documents(documents)
+
+        # Key every chunk by its content hash, identical chunks collapse into one row
+        keyed_chunks = {content_hash(chunk.page_content): chunk for chunk in chunks}
 
         # Initialize ChromaDB and store vectors
-        chroma_client = chromadb.PersistentClient(path="./chroma_db")
-        self.vectorstore = Chroma.from_documents(
-            chunks, embeddings, client=chroma_client)
+        self.chroma_client = chromadb.PersistentClient(path=self.persist_directory)
+        self.vectorstore = Chroma(collection_name=self.collection_name,
+                                  embedding_function=embeddings, client=self.chroma_client)
+        self.index_stats = self.sync_vector_store(keyed_chunks, seed_collection)
+        self.lexical_index = LexicalIndex(keyed_chunks)
+        print(f"[INFO] Vectorstore refreshed: {self.index_stats['computed']} embeddings computed, "
+              f"{self.index_stats['reused']} reused, {self.index_stats['deleted']} removed")
+        if isinstance(embeddings, CachedEmbeddings):
+            print(f"[INFO] Embedding cache: {embeddings.cache.stats()}")
+
+        # A new vector store needs a new chain, built lazily on first use
+        self.chain = None
+        return self.vectorstore
+
+    def open_vector_store(self):
+        '''
+        Open the already-built `self.collection_name` as is, without reading the knowledge base
+        or embedding anything. Used at startup to serve the last good index right away.
+        '''
+        if self.embeddings is None:
+            self.embeddings = self.default_embeddings()
+        self.chroma_client = chromadb.PersistentClient(path=self.persist_directory)
+        self.chroma_client.get_collection(self.collection_name)  # Raises if it is missing
+        self.vectorstore = Chroma(collection_name=self.collection_name,
+                                  embedding_function=self.embeddings, client=self.chroma_client)
+        self.lexical_index = LexicalIndex.from_vectorstore(self.vectorstore)
+        self.chain = None
         return self.vectorstore
 
-    def retrieve_info(self, vectorstore):
-        # Retrieve questions
+    @staticmethod
+    def default_embeddings():
+        '''
+        Gemini embeddings behind the persistent embedding cache, which both indexing and
+        query embedding go through. Set EMBEDDING_CACHE_DIR to an empty string to disable it.
+        '''
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+        embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+        cache_dir = os.getenv('EMBEDDING_CACHE_DIR', './embedding_cache')
+        if not cache_dir:
+            return embeddings
+        cache = open_embedding_cache(cache_dir, EMBEDDING_MODEL,
+                                     capacity=int(os.getenv('EMBEDDING_CACHE_SIZE', 50000)))
+        return CachedEmbeddings(embeddings, cache)
+
+    def sync_vector_store(self, keyed_chunks, seed_collection=None):
+        '''
+        Bring the collection in line with `keyed_chunks` ({content hash: Document}).
+        Only chunks whose hash is not stored yet (here or in `seed_collection`) are embedded,
+        hashes that disappeared are deleted. New chunks go through the EmbeddingPipeline and
+        are stored batch by batch, so syncing into a collection a failed build left behind
+        only embeds what is still missing.
+
+        returns:
+         - Dict with the number of embeddings computed, reused and deleted
+        '''
+        existing_ids = set(self.vectorstore.get(include=[])['ids'])
+
+        stale_ids = list(existing_ids - keyed_chunks.keys())
+        for i in range(0, len(stale_ids), INDEX_BATCH_SIZE):
+            self.vectorstore.delete(ids=stale_ids[i:i + INDEX_BATCH_SIZE])
+
+        new_ids = [chunk_id for chunk_id in keyed_chunks if chunk_id not in existing_ids]
+        if seed_collection and seed_collection != self.collection_name:
+            new_ids = self.copy_from_collection(seed_collection, new_ids)
+
+        collection = self.chroma_client.get_collection(self.collection_name)
+
+        def upsert(ids, vectors, documents):
+            # Chroma rejects empty metadata dicts, None stores no metadata
+            collection.upsert(ids=ids, embeddings=vectors,
+                              documents=[document.page_content for document in documents],
+                              metadatas=[document.metadata or None for document in documents])
+
+        pipeline = self.embedding_pipeline()
+        try:
+            pipeline_stats = pipeline.run(
+                ((chunk_id, keyed_chunks[chunk_id]) for chunk_id in new_ids), upsert)
+        finally:
+            # Once per sync rather than per batch: flushing holds the lock query lookups need
+            if isinstance(self.embeddings, CachedEmbeddings):
+                self.embeddings.cache.flush()
+        if new_ids:
+            print(f"[INFO] Embedded {pipeline_stats['texts']} chunks in {pipeline_stats['batches']} "
+                  f"requests ({pipeline_stats['texts_per_second']} chunks/s, "
+                  f"{pipeline_stats['retries']} retries)")
+
+        return {"computed": len(new_ids),
+                "reused": len(keyed_chunks) - len(new_ids),
+                "deleted": len(stale_ids)}
+
+    def embedding_pipeline(self):
+        return EmbeddingPipeline(self.embeddings,
+                                 batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', 100)),
+                                 workers=int(os.getenv('EMBEDDING_WORKERS', 4)),
+                                 requests_per_second=float(os.getenv('EMBEDDING_RPS', 0)),
+                                 max_retries=int(os.getenv('EMBEDDING_RETRIES', 5)))
+
+    def copy_from_collection(self, seed_collection, ids):
+        '''
+        Copy the rows in `ids` that `seed_collection` already holds, embeddings included
+
+        returns:
+         - The ids that were not found and still need embedding
+        '''
+        try:
+            source = self.chroma_client.get_collection(seed_collection)
+        except Exception:
+            print(f"[WARNING] Seed collection {seed_collection} not found, embedding from scratch")
+            return ids
+
+        target = self.chroma_client.get_collection(self.collection_name)
+        copied = set()
+        for i in range(0, len(ids), INDEX_BATCH_SIZE):
+            rows = source.get(ids=ids[i:i + INDEX_BATCH_SIZE],
+                              include=['embeddings', 'documents', 'metadatas'])
+            if not rows['ids']:
+                continue
+            target.upsert(ids=rows['ids'], embeddings=rows['embeddings'],
+                          documents=rows['documents'], metadatas=rows['metadatas'])
+            copied.update(rows['ids'])
+        return [chunk_id for chunk_id in ids if chunk_id not in copied]
+
+    @property
+    def cache_scope(self):
+        # Collection names repeat across tenants, their directories don't
+        return os.path.join(self.persist_directory, self.collection_name)
+
+    def drop_vector_store(self):
+        '''
+        Delete this instance's collection once nothing serves from it anymore
+        '''
+        drop_collection(self.persist_directory, self.collection_name)
+        if self.response_cache is not None:
+            self.response_cache.drop_scope(self.cache_scope)
+        self.close()
+
+    def close(self):
+        '''
+        Release the in-memory index and the Chroma client, keeping the collection on disk
+        '''
+        if self.chroma_client is not None:
+            close_client(self.chroma_client)
+            self.chroma_client = None
+        self.vectorstore = None
+        self.lexical_index = None
+        self.chain = None
+
+    def retrieve_info(self, vectorstore, search_filter=None):
+        # Retrieve questions, optionally only among documents whose metadata matches search_filter
+        search_kwargs = {'k': RETRIEVAL_K}
+        if search_filter:
+            search_kwargs['filter'] = search_filter
         self.retriever = vectorstore.as_retriever(
             search_type='similarity',
-            search_kwargs={'k': 5},
+            search_kwargs=search_kwargs,
         )
         return self.retriever
 
+    def vector_search(self, query, k=RETRIEVAL_K, search_filter=None, embedding=None):
+        '''
+        Similarity search, with the query embedding and the Chroma lookup timed separately.
+        Pass `embedding` to reuse a query embedding already computed.
+        '''
+        if embedding is None:
+            with stage("embed_query"):
+                embedding = self.vectorstore.embeddings.embed_query(query)
+        with stage("vector_search"):
+            return self.vectorstore.similarity_search_by_vector(embedding, k=k, filter=search_filter)
+
+    def search(self, query):
+        '''
+        Search used by the chain. In hybrid mode, a query naming an exact identifier that occurs
+        in the knowledge base (a Product ID, "S24", "SM-A546") is answered from the BM25 index
+        alone, without embedding it. Any other query merges the BM25 and vector results with
+        reciprocal rank fusion.
+
+        A query naming a product category ("do you have smartphones?") only restricts the
+        products it retrieves to that category, so "can I return a smartphone?" still finds
+        the return policy.
+        '''
+        lexical = None
+        if self.retrieval_mode == 'hybrid' and self.lexical_index is not None:
+            with stage("bm25_search"):
+                identifiers = self.lexical_index.identifiers(query)
+                exact = []
+                if identifiers:
+                    exact = self.lexical_index.search(query, k=RETRIEVAL_K, required=identifiers)
+                lexical = exact or self.lexical_index.search(query, k=FUSION_CANDIDATES)
+            if exact:
+                return [document for _, document in exact]
+
+        with stage("embed_query"):
+            embedding = self.vectorstore.embeddings.embed_query(query)
+        semantic = [(content_hash(document.page_content), document)
+                    for document in self.vector_search(query, k=FUSION_CANDIDATES, embedding=embedding)]
+
+        category = self.catalog.detect_category(query)
+        if category:
+            products = [(content_hash(document.page_content), document) for document in
+                        self.vector_search(query, k=FUSION_CANDIDATES, embedding=embedding,
+                                           search_filter={"category": category})]
+            semantic = restrict_products(semantic, category, products)
+            if lexical is not None:
+                lexical = restrict_products(lexical, category, products)
+
+        if lexical is None:
+            return [document for _, document in semantic[:RETRIEVAL_K]]
+        return reciprocal_rank_fusion([semantic, lexical], k=RETRIEVAL_K)
+
     def query_LLM(self):
-        contextualize_q_system_prompt = (
-            "You are assisting with reformulating user questions within the context of a electrical appliances store business. "
-            "Your goal is to ensure that the user's query is interpreted correctly in relation to the company's services."
-            "and that the right information regarding the users query is retireved from a database of the business\n\n"
-
-            "**Instructions:**\n"
-            "- If a user greets you (e.g., 'Hello', 'Hi'), reframe the question as a request for a request about the business.\n"
-            "- If a user asks who you are, reframe it to clarify that you are an AI-powered assistant for the business.\n"
-            "- If the user asks unrelated questions (e.g., about technology, general AI, or external topics), gently guide them back to electric store business-related topics.\n"
-            "- Keep all questions strictly within the scope of the business and its services."
-            "- always reformulate any question that is out of the scope of the business, or unrelated, to be guided back to the electric store business-related topics"
-        )
+        # Braces in a business's own prompts are literal text, not template variables
+        contextualize_q_system_prompt = escape_braces(self.rewrite_prompt)
 
         contextualize_q_prompt = ChatPromptTemplate.from_messages([
             ("system", contextualize_q_system_prompt),
@@ -125,46 +724,11 @@ class RAG():
             ("human", "{input}")
         ])
 
-        # This uses the LLM to help reformulate the question based on chat history
-        history_aware_retriever = create_history_aware_retriever(
-            self.llm, self.retriever, contextualize_q_prompt
-        )
+        # This uses the LLM to help reformulate the question based on chat history.
+        # RAGChain runs it before the retrieval chain, which searches with its output.
+        self.contextualize_chain = contextualize_q_prompt | self.llm | StrOutputParser()
 
-        qa_system_prompt = (
-            "You are a customer support assistant for a business that sells electronics."
-            "Your primary role is to provide helpful, accurate information about the business, its products, and services. You should only answer questions related to the business and its offerings."
-
-            "You have access to live product listings, including their prices, specifications, and categories. When a user asks about a product, "
-            "extract relevant product information from the provided context. "
-            "If a user asks about a product’s price, availability, or description, answer directly using the given data. "
-            "If the information is missing, tell them you couldn't find the details, and redirect them to the website or the human customer support, by giving them the contact details"
-            "website: electronest.com, call/whatsapp: 07069117393, gmail: electronest@gmail.com"
-
-            "Instructions:"
-            'If the user greets (e.g., "Hello", "Hi", "Good day"), respond with a friendly greeting introducing the business. Example:'
-            "Hello! Welcome to ElectroNest, your go-to store for the latest electronics. How can I assist you today?"
-            'If the user asks about the business (e.g., "What do you do?", "Tell me about your company"), provide details about the store and its products.'
-            'If the user asks who made you or who you are, reply as a customer support assistant for ElectroNest. Example:'
-            "I am an AI-powered customer support assistant for ElectroNest, here to help you with electronics inquiries and purchases."
-            'If the user asks something unrelated (e.g., politics, weather, who is the president, and sot of un-realted question that does not concern a customer support assistant), politely redirect them back to the business context. Example:'
-            "I'm here to assist with electronics-related queries. How can I help you today?"
-            'You would be given a list of products or faqs, when given product, if the amount in stock is mush just tell them we have a lot in stock, not the exact amount we have in stocks. If we have few you can tell them the amount we have in stock. Few can be anything less than 5'
-
-            'Example Queries:'
-            'How much is the iPhone 15?: The iPhone 15 costs $999.'
-            "Do you have gaming laptops?: Yes, we have gaming laptops including Alienware, Razer, and ASUS ROG models."
-            "What is the warranty on a Samsung TV?: The Samsung TV comes with a 1-year manufacturer warranty."
-            "What can you say about today's weather: I am a customer support assistant, and I'm here to support you with your queries concerning ElectroNest"
-            '1+1 is what: Sorry, I cant give you information about that, i am customer support assisitant for ElectroNest'
-
-            'Important:'
-            'Always provide responses in a friendly and professional tone, staying within the electronics business domain.'
-            'Never Never Never Never answer any unrelated questions that doesnt concern the business and a customer support assistant'
-            'You are limited to the companys information alone'
-            'Act like a customer support assistant, with so much marketing skills, parsuade the customer by all means to buy your product'
-            'Make your responses straightforward and cocise, making sure the customer is satisfied by your responses, no need of unecessary info the customer didnt ask of'
-            "{context}\n\n"
-        )
+        qa_system_prompt = escape_braces(self.system_prompt) + "{context}\n\n"
 
         qa_prompt = ChatPromptTemplate.from_messages(
             [
@@ -177,44 +741,64 @@ class RAG():
         question_answer_chain = create_stuff_documents_chain(
             self.llm, qa_prompt)
 
-        self.rag_chain = create_retrieval_chain(
-            history_aware_retriever, question_answer_chain)
+        # Products the question names are looked up in the catalog and put first in the context
+        retrieve_documents = RunnableParallel(
+            catalog=self.catalog_documents,
+            retrieved=lambda x: self.search(x.get("standalone_question") or x["input"]),
+        ) | (lambda x: x["catalog"] + x["retrieved"])
+
+        # Same output keys as create_retrieval_chain, plus the documents before the budget.
+        # RAGChain runs the retrieval and answer parts separately to time them.
+        self.context_budget.prompt_tokens = estimate_tokens(qa_system_prompt)
+        self.retrieval_chain = (
+            RunnablePassthrough.assign(raw_context=retrieve_documents)
+            .assign(context=self.assemble_context)
+        )
+        self.answer_chain = question_answer_chain
+        self.rag_chain = self.retrieval_chain.assign(answer=question_answer_chain)
 
         return self.rag_chain
 
-    def continual_chat(self, prompt, chat_history):
-        print("Start chatting with the AI!")
-        # print(prompt)
-        retrieved_docs = self.retriever.get_relevant_documents(prompt)
-
-        # Debugging: Print the retrieved documents
-        print("\n🔹 Retrieved Documents:")
-        for i, doc in enumerate(retrieved_docs, 1):
-            print(f"{i}. {doc.page_content} - Metadata: {doc.metadata}")
-
-        formatted_chat_history = []
-        for message in chat_history:
-            if message["sender"] == "user":
-                formatted_chat_history.append(
-                    HumanMessage(content=message["text"]))
-            elif message['sender'] == 'bot':
-                formatted_chat_history.append(
-                    AIMessage(content=message["text"]))
-
-        # Process the user's query through the retrieval chain
-        result = self.rag_chain.invoke(
-            {"input": prompt,
-             "chat_history": formatted_chat_history})
-
-       # Update chat history
-        chat_history.append({"text": prompt, "sender": "user"})
-        # Store as JSON format for Firebase
-        chat_history.append({"text": result["answer"], "sender": "bot"})
-
-        return result['answer'], chat_history
-
-    def run(self, prompt, chat_history):
-        self.retrieve_info(self.vectorstore)
-        self.query_LLM()
-        result, history = self.continual_chat(prompt, chat_history)
-        return result, history
+    def catalog_documents(self, inputs):
+        with stage("catalog_lookup"):
+            return self.catalog.documents(inputs["input"])
+
+    def assemble_context(self, inputs):
+        with stage("context_assembly"):
+            return self.context_budget.assemble(inputs["raw_context"])
+
+    def build_chain(self):
+        '''
+        Build the retriever, prompts and retrieval chain once for the current vector store.
+        Later calls return the same RAGChain, so requests never pay the construction cost.
+        '''
+        if self.chain is not None:
+            return self.chain
+
+        with self._chain_lock:
+            if self.chain is None:
+                if self.lexical_index is None and self.retrieval_mode == 'hybrid':
+                    self.lexical_index = LexicalIndex.from_vectorstore(self.vectorstore)
+                self.retrieve_info(self.vectorstore)
+                self.query_LLM()
+                # Scoped to this version like the response cache, a new chain starts empty
+                single_flight = None
+                if self.coalesce_timeout > 0:
+                    single_flight = SingleFlight(timeout=self.coalesce_timeout)
+                response_cache = None
+                if self.response_cache is not None:
+                    response_cache = self.response_cache.scoped(
+                        self.cache_scope, self.embeddings or self.vectorstore.embeddings)
+                self.chain = RAGChain(self.retrieval_chain, self.answer_chain,
+                                      self.contextualize_chain, debug=self.debug,
+                                      faq_index=FAQIndex(self.dataset, self.faq_cutoff),
+                                      response_cache=response_cache,
+                                      context_budget=self.context_budget,
+                                      single_flight=single_flight)
+        return self.chain
+
+    def answer(self, prompt, chat_history):
+        return self.build_chain().answer(prompt, chat_history)
+
+    def stream(self, prompt, chat_history):
+        return self.build_chain().stream(prompt, chat_history)
@@ -1,14 +1,20 @@
 import os
 import time
+
+# Process start, used to report the time to the first answered request
+STARTED_AT = time.perf_counter()
+
 import json
 import threading
-from RAG import RAG
 from dotenv import load_dotenv
-from firebase_config import db
-from get_client_data import GetData
-from firebase_admin import firestore
-from datetime import datetime, timezone
-from flask import Flask, jsonify, request
+from chat_store import ChatStore
+from reply_queue import ReplyQueue
+from tenants import DEFAULT_TENANT, TenantRegistry, load_tenants
+from response_cache import ResponseCache
+import metrics
+from metrics import REFRESH_PHASE_SECONDS, REGISTRY, finish_trace, stage, start_trace
+from flask import Flask, Response, g, jsonify, request
+from index_manifest import read_manifest, source_fingerprint, write_manifest
 from twilio.twiml.messaging_response import MessagingResponse
 
 app = Flask(__name__)
@@ -25,97 +31,257 @@ def get_user_id(data):
     return data.get('user_id') or data.get('whatsapp_id') or data.get('twitter_id')
 
 
-def load_faq():
-    with open(os.getenv('FAQS_PATH'), 'r') as faq_file:
+def load_faq(tenant):
+    with open(tenant.faqs_path, 'r') as faq_file:
         return json.load(faq_file)
 
 
-def load_product_data():
-    return get_data_instance.run()
+def get_data(tenant):
+    '''
+    The tenant's GetData instance, connected to its product store on first use rather than at
+    import
+    '''
+    with services_lock:
+        if tenant.get_data_instance is None:
+            from get_client_data import GetData
+            tenant.get_data_instance = GetData(storage_type=tenant.storage_type,
+                                               spreadsheet_id=tenant.spreadsheet_id,
+                                               about_path=tenant.about_path)
+        return tenant.get_data_instance
 
 
-def store_message(dataset, user_id):
-    for data in dataset:
-        message_data = {
-            "text": data["text"],
-            "sender": data["sender"],  # "user" or "bot"
-            "timestamp": datetime.now(timezone.utc),
-        }
+def get_chat_store():
+    '''
+    ChatStore backed by the chat Firestore, connected on first use rather than at import
+    '''
+    global chat_store_instance
+    with services_lock:
+        if chat_store_instance is None:
+            from firebase_config import get_db
+            chat_store_instance = ChatStore(
+                get_db(),
+                cache_size=int(os.getenv('HISTORY_CACHE_SIZE', 10000)),
+                cache_ttl=float(os.getenv('HISTORY_CACHE_TTL', 300)))
+        return chat_store_instance
+
+
+def get_twilio_client():
+    '''
+    Twilio REST client used to send WhatsApp replies outside the webhook request
+    '''
+    global twilio_client_instance
+    with services_lock:
+        if twilio_client_instance is None:
+            from twilio.rest import Client
+            twilio_client_instance = Client(os.getenv('TWILIO_ACCOUNT_SID'),
+                                            os.getenv('TWILIO_AUTH_TOKEN'))
+        return twilio_client_instance
 
-        chat_ref = db.collection("chat_sessions").document(
-            user_id).collection("messages")
-        chat_ref.add(message_data)
 
-        # Update last active time
-        db.collection("chat_sessions").document(user_id).set(
-            {"last_active": datetime.now(timezone.utc)}, merge=True)
+def load_product_data(tenant):
+    return get_data(tenant).run()
 
-    return "Message stored successfully"
 
+def create_knowledge_base_and_vectors(tenant, faqs, products, about, previous=None, delta=None):
+    '''
+    Function to build the next version of the knowledge base into its own collection,
+    leaving the version currently being served untouched
 
-def get_chat_history(user_id):
-    messages_ref = (
-        db.collection("chat_sessions")
-        .document(user_id)
-        .collection("messages")
-        .order_by("timestamp", direction=firestore.Query.DESCENDING)
-        .limit(5)
-    )
+    Args:
+     - tenant: The business the knowledge base is built for
+     - faqs: The FAQ dataset
+     - products, about: Product rows and About text from the client's product store
+     - previous: The RAG currently being served. Its unchanged chunk embeddings and
+       catalog records are reused instead of being rebuilt.
+     - delta: SheetDelta the products come from, lets the catalog update only the changed rows
 
-    messages = messages_ref.stream()
-    chat_history = [{"text": msg.to_dict().get(
-        "text", ""), "sender": msg.to_dict().get("sender", "")} for msg in messages]
+    returns:
+     - Rag class
+     - The version number of the new collection
+    '''
+    from RAG import RAG, list_collection_versions, versioned_collection_name
+
+    print(f"[INFO] Updating knowledge base and vector store of tenant {tenant.tenant_id}...")
+    versions = list_collection_versions(tenant.chroma_dir, COLLECTION_NAME)
+    manifest = read_manifest(tenant.chroma_dir)
+    in_use = tenant.live_rag.tracked_versions() | ({manifest['version']} if manifest else set())
+    if versions and versions[-1] not in in_use:
+        # A build that failed part-way left this collection behind, finish it: only the chunks
+        # it is still missing get embedded
+        version = versions[-1]
+        print(f"[INFO] Resuming the partial build of version {version}")
+    else:
+        version = versions[-1] + 1 if versions else 1
+    seed_collection = previous.collection_name if previous else None
+    if seed_collection is None and versions:
+        # Reuse the embeddings left on disk by the previous run
+        seed_collection = versioned_collection_name(COLLECTION_NAME, versions[-1])
+
+    rag_class = RAG(text_file=tenant.text_file,
+                    dataset=faqs,
+                    persist_directory=tenant.chroma_dir,
+                    collection_name=versioned_collection_name(COLLECTION_NAME, version),
+                    catalog=previous.catalog if previous else None,
+                    llm=llm_instance,
+                    embeddings=embeddings_instance,
+                    response_cache=response_cache,
+                    system_prompt=tenant.system_prompt,
+                    rewrite_prompt=tenant.rewrite_prompt)
 
-    return chat_history[::-1]  # Oldest first
+    # Update text file and ChromaDB
+    with stage("update_knowledge_base", REFRESH_PHASE_SECONDS):
+        rag_class.update_knowledge_base(about, products, delta)
+    with stage("vector_sync", REFRESH_PHASE_SECONDS):
+        rag_class.create_vector_store(seed_collection=seed_collection)
+    with stage("build_chain", REFRESH_PHASE_SECONDS):
+        rag_class.build_chain()
 
+    print("[INFO] Successfully Created Knowledge Base")
+    return rag_class, version
 
-def create_knowledge_base_and_vectors():
-    '''
-    Function to create or update the knowledge
 
-    returns:
-     - Rag class
+def refresh_knowledge_base(tenant, products=None, about=None, delta=None):
     '''
-    print("[INFO] Updating knowledge base and vector store...")
+    Build a new knowledge base version for a tenant and swap it in for the one being served.
+    Requests already running finish on the old version, which is then garbage-collected.
+    The product data is fetched unless the caller already has it.
+    '''
+    from RAG import drop_collection, list_collection_versions, versioned_collection_name
+
     # Fetch new data from Firebase or Google Sheets
-    faq_data = load_faq()
-    rag_class = RAG(text_file=os.getenv('TEXT_FILE'),
-                    dataset=faq_data['questions'])
-    products, about = load_product_data()
+    with stage("fetch_data", REFRESH_PHASE_SECONDS):
+        if products is None:
+            products, about = load_product_data(tenant)
+        faqs = load_faq(tenant)['questions']
+
+    live_rag = tenant.live_rag
+    with tenant.refresh_lock:
+        try:
+            rag_class, version = create_knowledge_base_and_vectors(
+                tenant, faqs, products, about, previous=live_rag.rag, delta=delta)
+        except Exception:
+            REGISTRY.counter("chatbot_refreshes", "Knowledge base refreshes", status="error").inc()
+            raise
+        with stage("publish", REFRESH_PHASE_SECONDS):
+            live_rag.publish(rag_class, version)
+            write_manifest(tenant.chroma_dir, version, source_fingerprint(faqs, about, products),
+                           about, products)
+        REGISTRY.counter("chatbot_refreshes", "Knowledge base refreshes", status="ok").inc()
+
+        # Collections left behind by earlier processes are never served again
+        for stale_version in list_collection_versions(tenant.chroma_dir, COLLECTION_NAME):
+            if stale_version < version and stale_version not in live_rag.tracked_versions():
+                drop_collection(tenant.chroma_dir, versioned_collection_name(
+                    COLLECTION_NAME, stale_version))
+
+
+def open_last_good_index(tenant):
+    '''
+    Serve the tenant's last published version straight from disk: open its collection and rebuild the
+    product catalog from the manifest, without fetching data or embedding anything
 
-    # Update text file and ChromaDB
-    rag_class.update_knowledge_base(about, products)
-    rag_class.create_vector_store()
+    returns:
+     - The manifest of the version now being served, or None if there is none to open
+    '''
+    manifest = read_manifest(tenant.chroma_dir)
+    if manifest is None:
+        return None
+
+    from RAG import RAG, versioned_collection_name
+
+    rag_class = RAG(text_file=tenant.text_file,
+                    dataset=load_faq(tenant)['questions'],
+                    persist_directory=tenant.chroma_dir,
+                    collection_name=versioned_collection_name(COLLECTION_NAME, manifest['version']),
+                    llm=llm_instance,
+                    embeddings=embeddings_instance,
+                    response_cache=response_cache,
+                    system_prompt=tenant.system_prompt,
+                    rewrite_prompt=tenant.rewrite_prompt)
+    try:
+        rag_class.open_vector_store()
+    except Exception as e:
+        print(f"[WARNING] Could not open knowledge base version {manifest['version']}: {e}")
+        return None
+    rag_class.catalog, _ = rag_class.catalog.updated(manifest['products'])
+    rag_class.build_chain()
+    tenant.live_rag.publish(rag_class, manifest['version'])
+    return manifest
+
+
+def check_knowledge_base(tenant, manifest):
+    '''
+    Fetch the current data and rebuild the knowledge base only if it changed since the
+    version in `manifest` was built. Runs in the background while requests are served.
 
-    print("[INFO] Successfully Created Knowledge Base")
-    return rag_class
+    The download also seeds the sheet poller's row fingerprints, so the poller skips the tenant
+    until the check is done; otherwise its first poll would see every row as added.
+    '''
+    try:
+        with tenant.refresh_lock:
+            products, about = load_product_data(tenant)
+            if manifest and manifest['fingerprint'] == source_fingerprint(
+                    load_faq(tenant)['questions'], about, products):
+                print(f"[INFO] Knowledge base of tenant {tenant.tenant_id} is up to date, "
+                      "no rebuild needed")
+                return
+            refresh_knowledge_base(tenant, products, about)
+    except Exception as e:
+        print(f"[ERROR] Knowledge base refresh of tenant {tenant.tenant_id} failed: {e}")
+        tenant.checked = False  # Try again when the tenant is next loaded
+    finally:
+        tenant.check_pending = False
+
+
+def start_knowledge_base(tenant):
+    '''
+    Serve the tenant's last good index immediately if there is one. The first time a tenant
+    is loaded, also check it against the current data in a background thread; after that the
+    sheet poller keeps it current.
+    '''
+    manifest = open_last_good_index(tenant)
+    if tenant.checked:
+        return
+    tenant.checked = True
+    tenant.check_pending = True
+    if manifest is None:
+        print(f"[INFO] No usable index on disk for tenant {tenant.tenant_id}, "
+              "building one in the background")
+    threading.Thread(target=check_knowledge_base, args=(tenant, manifest), daemon=True).start()
 
 
 def poll_google_sheets(initial_interval, max_interval, checks_before_scale=5):
-    """Poll Google Sheets for updates every `interval` seconds."""
+    """Poll the Google Sheets of every loaded tenant for updates every `interval` seconds."""
     interval = initial_interval
     unchanged_count = 0
 
     while True:
         print(f"[INFO] Checking Google Sheets (Interval: {interval} sec)...")
-        new_data = get_data_instance.get_latest_google_sheets()
-
-        if not new_data:
+        changed = False
+        for tenant in tenants.loaded():
+            if tenant.check_pending:
+                continue  # Its startup check is downloading the sheet right now
+            try:
+                with tenant.refresh_lock:
+                    with stage("sheet_poll", REFRESH_PHASE_SECONDS):
+                        new_data = get_data(tenant).get_latest_google_sheets()
+                    if new_data:
+                        print(f'[INFO] Updating Knowledge Base of tenant {tenant.tenant_id} with New Data')
+                        changed = True
+                        # The poll already downloaded the rows, don't fetch them a second time
+                        refresh_knowledge_base(tenant, new_data.records,
+                                               get_data(tenant).get_about(), new_data)
+                        print("[INFO] Knowledge base updated successfully.")
+            except Exception as e:
+                # One tenant's sheet failing must not stop the others from being polled
+                print(f"[ERROR] Polling tenant {tenant.tenant_id} failed: {e}")
+
+        if not changed:
             unchanged_count += 1
             print(
                 f"[INFO] No changes detected ({unchanged_count}/{checks_before_scale}).")
-        elif new_data:
-            print('[INFO] Updating Knowledge Base with New Data')
+        else:
             unchanged_count = 0
-            faq_data = load_faq()
-            rag_class = RAG(text_file=os.getenv('TEXT_FILE'),
-                            dataset=faq_data['questions'])
-            products, about = load_product_data()
-
-            # Update text file and ChromaDB
-            rag_class.update_knowledge_base(about, products)
-            rag_class.create_vector_store()
-            print("[INFO] Knowledge base updated successfully.")
 
         if unchanged_count >= checks_before_scale:
             unchanged_count = 0
@@ -126,8 +292,217 @@ def poll_google_sheets(initial_interval, max_interval, checks_before_scale=5):
         time.sleep(interval)
 
 
-get_data_instance = GetData(storage_type=os.getenv('STORAGE_TYPE'))
-rag = create_knowledge_base_and_vectors()
+def start_sheet_poller():
+    '''
+    Start the Google Sheets poller in a background thread, at most once per process
+
+    returns:
+     - True if this call started it
+    '''
+    global sheet_poller
+    with services_lock:
+        if sheet_poller is not None:
+            return False
+        sheet_poller = threading.Thread(target=poll_google_sheets, args=(3600, 86400, 5),
+                                        name="sheet-poller", daemon=True)
+        sheet_poller.start()
+        return True
+
+
+COLLECTION_NAME = 'knowledge_base'
+
+# Product stores and chat store connect lazily, see get_data and get_chat_store
+services_lock = threading.Lock()
+chat_store_instance = None
+twilio_client_instance = None
+time_to_first_request = None
+# The Google Sheets poller thread of this process, see start_sheet_poller
+sheet_poller = None
+# Chat model and embeddings of new knowledge base versions, None uses Gemini
+llm_instance = None
+embeddings_instance = None
+
+# Answers shared by every knowledge base version, each version only sees its own entries
+response_cache = None
+if int(os.getenv('RESPONSE_CACHE_SIZE', 1000)) > 0:
+    response_cache = ResponseCache(maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', 1000)),
+                                   ttl=float(os.getenv('RESPONSE_CACHE_TTL', 3600)),
+                                   threshold=float(os.getenv('RESPONSE_CACHE_SIMILARITY', 0.95)))
+
+# Share of requests whose full per-stage trace is logged as a [TRACE] JSON line
+metrics.TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+
+# The businesses served, from TENANTS_FILE or else the single one configured by the environment.
+# Knowledge bases are loaded by a tenant's first request, at most TENANT_CACHE_SIZE at a time.
+tenants = TenantRegistry(load_tenants(os.getenv('TENANTS_FILE'),
+                                      os.getenv('TENANTS_DIR', './tenants')),
+                         loader=start_knowledge_base,
+                         max_loaded=int(os.getenv('TENANT_CACHE_SIZE', 50)))
+# Set KNOWLEDGE_BASE_AUTOSTART=0 to publish a knowledge base yourself, e.g. with other services
+if (os.getenv('KNOWLEDGE_BASE_AUTOSTART', '1').lower() in ('1', 'true', 'yes')
+        and tenants.default is not None):
+    startup_lease = tenants.ensure_loaded(tenants.default)
+    if startup_lease is not None:
+        startup_lease.release()
+
+
+def answer_question(tenant, rag, question, user_id):
+    '''
+    Answer a user's message to a tenant with their chat history and store the new turn
+
+    Args:
+     - rag: The tenant's RAG, leased by the caller for the whole call
+
+    returns:
+     - The response text
+    '''
+    # Fetch chat history (handles empty cases)
+    chat_store = get_chat_store()
+    session_id = tenant.session_id(user_id)
+    with stage("history_read"):
+        chat_history = chat_store.get_chat_history(session_id)
+
+    # Get AI-generated response
+    response, updated_history = rag.answer(question, chat_history)
+
+    # Store both user message & bot response in Firestore, only the new turn is written
+    with stage("history_write"):
+        chat_store.store_message(updated_history[len(chat_history):], session_id)
+    return response
+
+
+def server_sent_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def stream_answer(lease, question, session_id, chat_history, chat_store):
+    '''
+    Server-Sent Events for a streamed answer: one `data: {"token": ...}` event per piece of
+    the answer, then an `event: done` carrying the full response. The turn is stored once the
+    answer is complete; nothing is stored if the client disconnects or the chain fails.
+    The lease on the tenant's knowledge base is released once the answer is generated.
+    '''
+    # The request's own trace has ended by the time the body is generated, so start another
+    trace = start_trace("faq_stream")
+    pieces = []
+    try:
+        with lease as rag:
+            for piece in rag.stream(question, chat_history):
+                pieces.append(piece)
+                yield server_sent_event({"token": piece})
+            response = "".join(pieces)
+            updated_history = rag.build_chain().append_turn(chat_history, question, response)
+    except Exception as e:
+        print(f"[ERROR] Streaming answer failed: {e}")
+        REGISTRY.counter("chatbot_errors", "Requests that raised an exception",
+                         endpoint="faq_stream").inc()
+        finish_trace(trace, "error")
+        yield server_sent_event({"error": "The answer could not be completed"}, event="error")
+        return
+
+    with stage("history_write"):
+        chat_store.store_message(updated_history[len(chat_history):], session_id)
+    finish_trace(trace, "ok")
+    yield server_sent_event({"response": response}, event="done")
+
+
+def send_whatsapp_reply(user_id, message, tenant_id=DEFAULT_TENANT, from_number=None):
+    '''
+    Answer a queued WhatsApp message and send the reply through the Twilio REST API, from
+    the number the message was sent to (the webhook's "To"), else the tenant's number
+    '''
+    trace = start_trace("whatsapp_reply")
+    status = "error"
+    try:
+        tenant = tenants.tenants[tenant_id]
+        lease = tenants.ensure_loaded(tenant)
+        if lease is None:
+            raise RuntimeError(f"The knowledge base of tenant {tenant_id} is not loaded")
+        with lease as rag:
+            response = answer_question(tenant, rag, message, user_id)
+        with stage("twilio_send"):
+            get_twilio_client().messages.create(
+                from_=from_number or tenant.whatsapp_number, to=user_id, body=response)
+        status = "ok"
+    finally:
+        REGISTRY.counter("chatbot_replies", "WhatsApp replies sent by the worker pool",
+                         status=status).inc()
+        finish_trace(trace, status)
+
+
+# With WHATSAPP_ASYNC set, /whatsapp acknowledges at once and a worker pool sends the reply
+reply_queue = None
+if os.getenv('WHATSAPP_ASYNC', '').lower() in ('1', 'true', 'yes'):
+    # Messages are queued as (text, tenant id, number it was sent to)
+    reply_queue = ReplyQueue(lambda user_id, queued: send_whatsapp_reply(user_id, *queued),
+                             workers=int(os.getenv('WHATSAPP_WORKERS', 4)),
+                             max_pending=int(os.getenv('WHATSAPP_QUEUE_SIZE', 1000)))
+
+
+REGISTRY.gauge("chatbot_knowledge_base_version", "Knowledge base version the default tenant serves",
+               lambda: tenants.default.live_rag.version if tenants.default is not None else None)
+REGISTRY.gauge("chatbot_tenants_loaded", "Tenants with a knowledge base in memory",
+               lambda: tenants.stats()["loaded"])
+REGISTRY.gauge("chatbot_reply_queue_depth", "WhatsApp messages waiting or being answered",
+               lambda: reply_queue.pending if reply_queue is not None else None)
+REGISTRY.gauge("chatbot_response_cache_entries", "Answers held by the response cache",
+               lambda: len(response_cache.entries) if response_cache is not None else None)
+REGISTRY.gauge("chatbot_history_cache_hit_rate", "Chat history cache hit rate",
+               lambda: chat_store_instance.cache_stats()["hit_rate"]
+               if chat_store_instance is not None and chat_store_instance.cache is not None else None)
+
+
+def knowledge_base_loading():
+    return jsonify({"error": "The knowledge base is loading, please retry shortly"}), 503
+
+
+def unknown_tenant():
+    return jsonify({"error": "Unknown tenant"}), 404
+
+
+@app.before_request
+def start_request_trace():
+    g.started_at = time.perf_counter()
+    g.trace = start_trace(request.endpoint or "unknown")
+
+
+@app.after_request
+def count_request(response):
+    endpoint = request.endpoint or "unknown"
+    REGISTRY.counter("chatbot_requests", "HTTP requests", endpoint=endpoint,
+                     status=str(response.status_code)).inc()
+    REGISTRY.histogram("chatbot_request_seconds", "Time to respond, in seconds",
+                       endpoint=endpoint).observe(time.perf_counter() - g.started_at)
+    g.status = str(response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_trace(error):
+    if error is not None:
+        REGISTRY.counter("chatbot_errors", "Requests that raised an exception",
+                         endpoint=request.endpoint or "unknown").inc()
+    if 'trace' in g:
+        try:
+            finish_trace(g.pop('trace'), "error" if error is not None else g.get('status', 'ok'))
+        except ValueError:
+            pass  # Teardown ran in another context than before_request, nothing to log
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.after_request
+def log_time_to_first_request(response):
+    global time_to_first_request
+    if (time_to_first_request is None and response.status_code == 200
+            and request.endpoint in ('faq', 'whatsapp')):
+        time_to_first_request = time.perf_counter() - STARTED_AT
+        print(f"[INFO] Time to first request: {time_to_first_request:.2f} sec after startup")
+    return response
 
 
 @app.route('/faq', methods=['POST'])
@@ -138,31 +513,80 @@ def faq():
 
     if not user_id:
         return jsonify({"error": "User ID is required"}), 400
+    tenant = tenants.resolve(tenant_id=request.json.get('tenant_id'))
+    if tenant is None:
+        return unknown_tenant()
+    lease = tenants.ensure_loaded(tenant)
+    if lease is None:
+        return knowledge_base_loading()
+
+    # Opt-in streaming, with "stream": true or an Accept: text/event-stream header
+    if request.json.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+        try:
+            chat_store = get_chat_store()
+            session_id = tenant.session_id(user_id)
+            chat_history = chat_store.get_chat_history(session_id)
+        except BaseException:
+            lease.release()
+            raise
+        response = Response(stream_answer(lease, user_question, session_id, chat_history, chat_store),
+                            mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Also covers a client that disconnects before the body is generated
+        response.call_on_close(lease.release)
+        return response
+
+    with lease as rag:
+        response = answer_question(tenant, rag, user_question, user_id)
 
-    # Fetch chat history (handles empty cases)
-    chat_history = get_chat_history(user_id)
+    return jsonify({"response": response})
 
-    # Get AI-generated response
-    response, updated_history = rag.run(
-        user_question, chat_history)
 
-    # Store both user message & bot response in Firestore
-    store_message(updated_history, user_id)
+def twilio_signature_valid():
+    '''
+    Whether the request carries a valid X-Twilio-Signature for its URL and form. Without this
+    check anyone could POST to the webhook and, with WHATSAPP_ASYNC, have the business's Twilio
+    account message any number. Behind a proxy that rewrites the URL, set WHATSAPP_WEBHOOK_URL
+    to the public URL Twilio calls.
+    '''
+    auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+    if not auth_token:
+        return False
+    from twilio.request_validator import RequestValidator
 
-    return jsonify({"response": response})
+    return RequestValidator(auth_token).validate(
+        os.getenv('WHATSAPP_WEBHOOK_URL') or request.url, request.form,
+        request.headers.get('X-Twilio-Signature', ''))
 
 
 @app.route('/whatsapp', methods=['POST'])
 def whatsapp():
+    if not twilio_signature_valid():
+        return jsonify({"error": "Invalid Twilio signature"}), 403
+
     incoming_msg = request.form.get('Body', '').lower()
     user_id = request.form.get('From')
     print(f'[DEBUG] Received request data: {incoming_msg}, from {user_id}')
-
-    chat_history = get_chat_history(user_id)
-
-    response, updated_history = rag.run(incoming_msg, chat_history)
-
-    store_message(updated_history, user_id)
+    # The business is the number the message was sent to
+    tenant = tenants.resolve(whatsapp_number=request.form.get('To'))
+    if tenant is None:
+        return unknown_tenant()
+    lease = tenants.ensure_loaded(tenant)
+    if lease is None:
+        return knowledge_base_loading()
+
+    if reply_queue is not None:
+        lease.release()  # The worker leases the knowledge base when it answers
+        if not user_id or not incoming_msg.strip():
+            return jsonify({"error": "From and Body are required"}), 400
+        if not reply_queue.submit(user_id, (incoming_msg, tenant.tenant_id,
+                                            request.form.get('To'))):
+            return jsonify({"error": "Too many messages queued, please retry shortly"}), 503
+        # Empty TwiML, the reply is sent through the REST API once a worker has it
+        return str(MessagingResponse())
+
+    with lease as rag:
+        response = answer_question(tenant, rag, incoming_msg, user_id)
 
     twilio_response = MessagingResponse()
     twilio_response.message(response)
@@ -170,13 +594,24 @@ def whatsapp():
     return str(twilio_response)
 
 
+@app.route('/tenants', methods=['GET'])
+def tenant_stats():
+    return jsonify(tenants.stats())
+
+
+@app.route('/whatsapp/queue', methods=['GET'])
+def whatsapp_queue():
+    if reply_queue is None:
+        return jsonify({"error": "WhatsApp replies are sent synchronously"}), 404
+    return jsonify(reply_queue.stats())
+
+
 # Use Render's assigned port or default to 5000
 port = int(os.environ.get("PORT", 5000))
 
 if __name__ == "__main__":
-    # Start Google Sheets Polling in a separate thread
-    polling_thread = threading.Thread(
-        target=poll_google_sheets, args=(3600, 86400, 5), daemon=True)
-    polling_thread.start()
-
-    app.run(host="0.0.0.0", port=port, debug=True)
+    # Development server, see server.py to serve production traffic. The reloader would import
+    # this module a second time and build the knowledge base twice, so it stays off.
+    start_sheet_poller()
+    app.run(host="0.0.0.0", port=port, threaded=True, use_reloader=False,
+            debug=os.getenv('FLASK_DEBUG', '').lower() in ('1', 'true', 'yes'))
@@ -0,0 +1,1335 @@
+'''
+Offline micro-benchmarks for the chatbot. Every benchmark runs against local stand-ins
+(fake chat model, deterministic embeddings, in-memory Chroma) so no credentials are needed.
+
+Usage:
+    python benchmark.py chain --requests 200
+    python benchmark.py index
+    python benchmark.py firestore --turns 20
+    python benchmark.py faq --cutoff 0.9
+    python benchmark.py catalog
+    python benchmark.py chunking
+    python benchmark.py embedcache
+    python benchmark.py startup
+    python benchmark.py sheets
+    python benchmark.py webhook
+    python benchmark.py stream
+    python benchmark.py respcache
+    python benchmark.py routing
+    python benchmark.py hybrid
+    python benchmark.py context
+    python benchmark.py embedpipe --workers 8 --rps 20
+    python benchmark.py coalesce --burst 32
+    python benchmark.py cleanup
+    python benchmark.py tenants --tenants 30 --max-loaded 10
+    python benchmark.py load --concurrency 16 --output load.json
+    python benchmark.py serve --concurrency 32 --max-concurrent 16
+'''
+import os
+import re
+import sys
+import json
+import time
+import logging
+import random
+import resource
+import shutil
+import tempfile
+import argparse
+import threading
+import contextlib
+import subprocess
+import statistics
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from langchain_chroma import Chroma
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+import chromadb
+from RAG import RAG, content_hash
+from chat_store import ChatStore
+from fakes import (FakeFirestore, FakeSheet, FakeTwilioClient, HashingEmbeddings,
+                   TokenDelayChatModel)
+from reply_queue import ReplyQueue
+from response_cache import ResponseCache
+from question_router import QuestionRouter
+from context_budget import ContextBudget
+from get_client_data import GetData
+from delete_old_chat import ChatCleanup
+from faq_index import FAQIndex
+from lexical_index import LexicalIndex
+from product_catalog import ProductCatalog
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from index_manifest import read_manifest, source_fingerprint, write_manifest
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+KNOWLEDGE_BASE = os.path.join(DATA_DIR, 'knowledge_base.txt')
+FAQS = os.path.join(DATA_DIR, 'Ecommerce_FAQ_Chatbot_dataset.json')
+
+QUESTIONS = [
+    "how much is the samsung galaxy s24 ultra?",
+    "do you deliver nationwide?",
+    "what is your return policy?",
+    "is the panasonic microwave oven in stock?",
+]
+# Number the load test's WhatsApp messages are sent to
+BUSINESS_NUMBER = "whatsapp:+14155238886"
+# A typical answer length, about 40 tokens
+ANSWER = ("Thanks for reaching out to ElectroNest! The Samsung Galaxy S24 Ultra costs $1,299 and "
+          "ships nationwide within three to five business days, with a one year warranty.")
+
+
+def twilio_headers(url, form):
+    '''
+    The X-Twilio-Signature Twilio would send with a webhook request, signed with
+    TWILIO_AUTH_TOKEN
+    '''
+    from twilio.request_validator import RequestValidator
+
+    return {'X-Twilio-Signature': RequestValidator(os.environ['TWILIO_AUTH_TOKEN']).compute_signature(
+        url, form)}
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:<28} mean {statistics.mean(timings) * 1000:8.3f} ms | "
+          f"p50 {statistics.median(timings) * 1000:8.3f} ms | p99 {p99 * 1000:8.3f} ms")
+    return statistics.mean(timings)
+
+
+def load_chunks(limit):
+    with open(KNOWLEDGE_BASE, encoding='utf-8') as f:
+        text = f.read()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
+    return splitter.split_text(text)[:limit]
+
+
+def build_fake_rag(chunks):
+    '''
+    Build a RAG instance backed by a fake chat model and an in-memory Chroma collection
+    '''
+    llm = FakeListChatModel(responses=["standalone question", "answer"])
+    embeddings = DeterministicFakeEmbedding(size=256)
+    rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings)
+    rag.vectorstore = Chroma.from_texts(chunks, embeddings)
+    return rag
+
+
+def bench_chain(args):
+    rag = build_fake_rag(load_chunks(args.chunks))
+    history = [{"text": "hi", "sender": "user"},
+               {"text": "Hello! How can I help?", "sender": "bot"}]
+
+    def rebuild_per_request(question):
+        # Previous behaviour of RAG.run: rebuild everything, plus a debug retrieval
+        rag.retrieve_info(rag.vectorstore)
+        rag.query_LLM()
+        rag.retriever.invoke(question)
+        return rag.rag_chain.invoke(
+            {"input": question, "chat_history": rag.build_chain().format_chat_history(history)})
+
+    def shared_chain(question):
+        return rag.answer(question, history)
+
+    results = {}
+    for name, fn in (("rebuild per request", rebuild_per_request),
+                     ("shared RAGChain.answer", shared_chain)):
+        fn(QUESTIONS[0])  # warm up
+        timings = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            fn(QUESTIONS[i % len(QUESTIONS)])
+            timings.append(time.perf_counter() - start)
+        results[name] = summarize(name, timings)
+
+    before, after = results.values()
+    print(f"Per-request overhead saved: {(before - after) * 1000:.3f} ms "
+          f"({before / after:.2f}x faster with a zero-latency LLM)")
+
+
+def bench_index(args):
+    embeddings = DeterministicFakeEmbedding(size=256)
+    persist_directory = tempfile.mkdtemp(prefix='chroma_bench_')
+    try:
+        rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=FakeListChatModel(responses=["answer"]),
+                  embeddings=embeddings, persist_directory=persist_directory)
+        for refresh in ("cold build", "no-op refresh"):
+            start = time.perf_counter()
+            rag.create_vector_store()
+            elapsed = time.perf_counter() - start
+            rows = len(rag.vectorstore.get(include=[])['ids'])
+            print(f"{refresh:<16} {elapsed:7.2f} s | collection size {rows} | {rag.index_stats}")
+    finally:
+        shutil.rmtree(persist_directory, ignore_errors=True)
+
+
+def bench_firestore(args):
+    def store_full_history(db, dataset, user_id):
+        # Previous store_message: re-inserts the whole history, one add + one set per message
+        for data in dataset:
+            message_data = {"text": data["text"], "sender": data["sender"],
+                             "timestamp": datetime.now(timezone.utc)}
+            db.collection("chat_sessions").document(user_id).collection("messages").add(message_data)
+            db.collection("chat_sessions").document(user_id).set(
+                {"last_active": datetime.now(timezone.utc)}, merge=True)
+
+    for name in ("full history per turn", "batched new turn only", "batched + history cache"):
+        db = FakeFirestore()
+        chat_store = ChatStore(db, cache_size=1000 if name.endswith("cache") else 0)
+        writes = round_trips = 0
+        for turn in range(args.turns):
+            db.reset_counters()
+            chat_history = chat_store.get_chat_history("user")
+            updated_history = chat_history + [{"text": f"question {turn}", "sender": "user"},
+                                              {"text": f"answer {turn}", "sender": "bot"}]
+            if name == "full history per turn":
+                store_full_history(db, updated_history, "user")
+            else:
+                chat_store.store_message(updated_history[len(chat_history):], "user")
+            writes += db.writes
+            round_trips += db.round_trips
+
+        stored = sum(1 for path in db.docs if path[-2:-1] == ("messages",))
+        print(f"{name:<24} {writes / args.turns:5.1f} writes/turn | "
+              f"{round_trips / args.turns:5.1f} round-trips/turn | "
+              f"{stored} messages stored for {args.turns * 2} sent")
+        if chat_store.cache is not None:
+            print(f"{'':<24} history cache {chat_store.cache_stats()}")
+
+
+def load_faqs():
+    with open(FAQS, encoding='utf-8') as f:
+        return json.load(f)['questions']
+
+
+def load_products():
+    '''
+    Parse the product rows back out of the bundled knowledge base, as GetData would return them
+    '''
+    with open(KNOWLEDGE_BASE, encoding='utf-8') as f:
+        listings = f.read().split("## Product Listings/Phones/Electrical Appliances")[1]
+
+    products = []
+    for block in listings.split("---"):
+        product = {}
+        for line in block.strip().splitlines():
+            label, _, value = line.partition(": ")
+            product["Product Name" if label == "Name" else label] = value
+        if product.get("Product ID"):
+            products.append(product)
+    return products
+
+
+def load_about():
+    with open(KNOWLEDGE_BASE, encoding='utf-8') as f:
+        text = f.read()
+    return text.split("## About the Business")[1].split("## Frequently Asked Questions")[0]
+
+
+def bench_faq(args):
+    faqs = load_faqs()
+    rng = random.Random(0)
+
+    def with_typo(text):
+        i = rng.randrange(len(text))
+        return text[:i] + text[i + 1:]
+
+    # A third verbatim FAQs (lowercased, as the routes deliver them), a third with a typo,
+    # a third general shop questions that mostly need the RAG chain
+    traffic = []
+    for i in range(args.requests):
+        faq = faqs[i % len(faqs)]['question']
+        traffic.append([faq.lower(), with_typo(faq.lower()), QUESTIONS[i % len(QUESTIONS)]][i % 3])
+
+    faq_index = FAQIndex(faqs, cutoff=args.cutoff)
+    for question in traffic:
+        faq_index.match(question)
+
+    stats = faq_index.stats()
+    print(f"cutoff {args.cutoff} | {stats['served_without_llm']}/{stats['lookups']} requests "
+          f"served without an LLM call ({stats['fast_path_ratio']:.1%}) | fast path "
+          f"p50 {stats['fast_path_p50'] * 1e6:.1f} us, p99 {stats['fast_path_p99'] * 1e6:.1f} us")
+
+
+def bench_catalog(args):
+    products = load_products()
+    start = time.perf_counter()
+    catalog, counts = ProductCatalog().updated(products)
+    print(f"full build       {(time.perf_counter() - start) * 1000:8.2f} ms | {counts}")
+
+    changed = [dict(product, Stock="0") if i % 100 == 0 else product
+               for i, product in enumerate(products)]
+    start = time.perf_counter()
+    _, counts = catalog.updated(changed)
+    print(f"1% rows changed  {(time.perf_counter() - start) * 1000:8.2f} ms | {counts}")
+
+    queries = ["how much is the samsung galaxy s24 ultra?", "is P0001 in stock",
+               "price of microwave oven 25l", "do you deliver nationwide?"]
+    timings = []
+    for i in range(args.requests):
+        start = time.perf_counter()
+        catalog.lookup(queries[i % len(queries)])
+        timings.append(time.perf_counter() - start)
+    summarize("catalog lookup", timings)
+
+
+def bench_chunking(args):
+    products = load_products()
+    rag = RAG(text_file=KNOWLEDGE_BASE, dataset=load_faqs(),
+              llm=FakeListChatModel(responses=["answer"]))
+    strategies = {
+        "500/100 character splitter": [
+            Document(page_content=chunk) for chunk in load_chunks(None)],
+        "record-aware documents": rag.build_documents(load_about(), products),
+    }
+    rag.catalog, _ = rag.catalog.updated(products)
+
+    def rag_search(vectorstore, query):
+        # RAG.search, hybrid with its category boost, against this benchmark's vector store
+        if rag.vectorstore is not vectorstore:
+            rag.vectorstore = vectorstore
+            rag.lexical_index = LexicalIndex.from_vectorstore(vectorstore)
+            rag.retrieve_info(vectorstore)
+        return rag.search(query)
+
+    # Product questions. Context precision is the share of retrieved characters that belong to
+    # a complete record of the product asked about, from its name down to its warranty.
+    sample = products[::max(1, len(products) // args.queries)][:args.queries]
+    product_queries = [(f"how much is the {p['Product Name']} with {p['Specifications']}",
+                        re.compile(rf"Name: {re.escape(p['Product Name'])}\n(.*\n){{7}}Warranty: .*"))
+                       for p in sample]
+    # Category questions, for brands that sell in several categories
+    category_queries = sorted({(p['Brand'], p['Category']) for p in products})
+    # Questions naming a Product ID, the product should come first
+    identifier_queries = [(f"is the {p['Product ID']} {p['Category'].lower()} in stock?",
+                           f"Product ID: {p['Product ID']}\n") for p in sample]
+    # Policy questions naming a category, answered by the FAQ or About section, not a product
+    policy_queries = ["can I return a smartphone if it is damaged?",
+                      "what is the warranty on smartphones?",
+                      "do you deliver electrical appliances to Lagos?",
+                      "how do I pay for electrical appliances?",
+                      "can I track the delivery of my smartphone order?"]
+
+    for name, documents in strategies.items():
+        embeddings = HashingEmbeddings()
+        vectorstore = Chroma.from_documents(documents, embeddings)
+        characters = sum(len(doc.page_content) for doc in documents)
+
+        relevant = retrieved = 0
+        for query, record in product_queries:
+            for doc in vectorstore.similarity_search(query, k=5):
+                relevant += sum(len(match.group()) for match in record.finditer(doc.page_content))
+                retrieved += len(doc.page_content)
+        product_precision = relevant / retrieved
+
+        if name == "record-aware documents":
+            search = lambda query: rag_search(vectorstore, query)
+        else:
+            search = lambda query: vectorstore.similarity_search(query, k=5)
+
+        # FAQ and About chunks are no longer filtered out of category questions, so only count
+        # the products of another category as wrong
+        in_category = off_category = 0
+        for brand, category in category_queries:
+            results = search(f"which {brand} {category.lower()} do you have?")
+            in_category += sum(1 for doc in results if f"Category: {category}" in doc.page_content)
+            off_category += sum(1 for doc in results if "Category: " in doc.page_content
+                                and f"Category: {category}" not in doc.page_content)
+        category_precision = in_category / (5 * len(category_queries))
+
+        identifier_hits = sum(1 for query, record in identifier_queries
+                              if record in search(query)[0].page_content)
+        policy_hits = sum(1 for query in policy_queries
+                          if any("Product ID:" not in doc.page_content for doc in search(query)))
+
+        print(f"{name:<28} {len(documents):5d} chunks | {characters / 4:9,.0f} tokens embedded | "
+              f"product context precision@5 {product_precision:.2f} | "
+              f"category precision@5 {category_precision:.2f} "
+              f"({off_category} products of another category) | "
+              f"product ID hit@1 {identifier_hits / len(identifier_queries):.2f} | "
+              f"policy questions with a FAQ/About chunk@5 {policy_hits / len(policy_queries):.2f}")
+        vectorstore.delete_collection()
+
+
+def bench_embedcache(args):
+    model = HashingEmbeddings(latency=args.latency)
+    workdir = tempfile.mkdtemp(prefix='embedding_cache_bench_')
+    try:
+        for run in ("cold start", "restart, index lost", "restart, index kept"):
+            # A fresh EmbeddingCache instance reopens the files like a restarted process would
+            embeddings = CachedEmbeddings(model, EmbeddingCache(
+                os.path.join(workdir, 'cache'), 'hashing', capacity=args.capacity))
+            persist_directory = os.path.join(
+                workdir, 'chroma_cold' if run == "cold start" else 'chroma_restart')
+            rag = RAG(text_file=KNOWLEDGE_BASE, dataset=load_faqs(),
+                      llm=FakeListChatModel(responses=["answer"]), embeddings=embeddings,
+                      persist_directory=persist_directory)
+            rag.documents = rag.build_documents(load_about(), load_products())
+
+            calls_before = model.calls
+            start = time.perf_counter()
+            rag.create_vector_store()
+            for question in QUESTIONS * 5:
+                rag.vectorstore.similarity_search(question, k=5)
+            elapsed = time.perf_counter() - start
+            print(f"{run:<20} {elapsed:6.2f} s | {model.calls - calls_before:4d} embedding calls | "
+                  f"cache {embeddings.cache.stats()}")
+            embeddings.cache.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_startup(args):
+    faqs, about, products = load_faqs(), load_about(), load_products()
+    workdir = tempfile.mkdtemp(prefix='startup_bench_')
+    text_file = os.path.join(workdir, 'knowledge_base.txt')
+
+    def new_rag():
+        return RAG(text_file=text_file, dataset=faqs, llm=FakeListChatModel(responses=["answer"]),
+                   embeddings=HashingEmbeddings(latency=args.latency),
+                   persist_directory=workdir, collection_name='knowledge_base_v1')
+
+    def rebuild():
+        rag = new_rag()
+        rag.update_knowledge_base(about, products)
+        rag.create_vector_store()
+        return rag
+
+    def open_last_good():
+        manifest = read_manifest(workdir)
+        rag = new_rag()
+        rag.open_vector_store()
+        rag.catalog, _ = rag.catalog.updated(manifest['products'])
+        return rag
+
+    try:
+        for name, start_up in (("rebuild at startup", rebuild),
+                               ("open last good index", open_last_good)):
+            start = time.perf_counter()
+            rag = start_up()
+            rag.answer(QUESTIONS[0], [])
+            print(f"{name:<22} time to first answer {time.perf_counter() - start:6.2f} s")
+            if name == "rebuild at startup":
+                write_manifest(workdir, 1, source_fingerprint(faqs, about, products),
+                               about, products)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_sheets(args):
+    products = load_products()
+    sheet = FakeSheet(products)
+    data = GetData('googlesheet', sheet=sheet)
+    catalog, _ = ProductCatalog().updated(data.get_client_db_googlesheet())
+    catalog.snapshot = data.snapshot
+
+    edits = [("no change", lambda: None),
+             ("1 row updated", lambda: sheet.update_row(0, Stock="0")),
+             ("1 row added", lambda: sheet.append_row(dict(products[1], **{"Product ID": "P9999"}))),
+             ("1 row removed", lambda: sheet.delete_row(len(sheet.records) - 1))]
+    for name, edit in edits:
+        edit()
+        downloads = sheet.downloads
+        start = time.perf_counter()
+        delta = data.get_latest_google_sheets()
+        poll = time.perf_counter() - start
+        if delta:
+            start = time.perf_counter()
+            _, full_counts = catalog.updated(delta.records)
+            full = time.perf_counter() - start
+            start = time.perf_counter()
+            catalog, counts = catalog.updated(delta.records, delta)
+            incremental = time.perf_counter() - start
+            assert counts == full_counts, (counts, full_counts)
+            update = (f"catalog full {full * 1000:6.2f} ms vs delta {incremental * 1000:6.2f} ms "
+                      f"| {counts}")
+        else:
+            update = "knowledge base untouched"
+        print(f"{name:<14} poll {poll * 1000:6.2f} ms, {sheet.downloads - downloads} download(s) "
+              f"| {delta} | {update}")
+
+
+def bench_webhook(args):
+    db = FakeFirestore(latency=args.firestore_latency)
+    chat_store = ChatStore(db)
+    twilio = FakeTwilioClient(latency=args.twilio_latency)
+
+    def reply(user_id, message):
+        # Same steps as app.send_whatsapp_reply, with a fixed-latency stand-in for the chain
+        history = chat_store.get_chat_history(user_id)
+        time.sleep(args.llm_latency)
+        turn = [{"text": message, "sender": "user"}, {"text": f"re: {message}", "sender": "bot"}]
+        chat_store.store_message(turn, user_id)
+        twilio.messages.create(from_="whatsapp:+10000000000", to=user_id, body=f"re: {message}")
+        return history
+
+    messages = [(f"whatsapp:+1{user:09d}", f"message {i}")
+                for i in range(args.messages) for user in range(args.users)]
+
+    timings = []
+    for user_id, message in messages[:args.users * 2]:
+        start = time.perf_counter()
+        reply(user_id, message)
+        timings.append(time.perf_counter() - start)
+    summarize("sync webhook ack", timings)
+
+    twilio.sent.clear()
+    queue = ReplyQueue(reply, workers=args.workers, max_pending=args.queue_size)
+    timings, rejected = [], 0
+    start_all = time.perf_counter()
+    for user_id, message in messages:
+        start = time.perf_counter()
+        if not queue.submit(user_id, message):
+            rejected += 1
+        timings.append(time.perf_counter() - start)
+    summarize("async webhook ack", timings)
+    queue.join()
+    elapsed = time.perf_counter() - start_all
+
+    by_user = {}
+    for sent in twilio.sent:
+        by_user.setdefault(sent["to"], []).append(int(sent["body"].rsplit(" ", 1)[1]))
+    in_order = all(numbers == sorted(numbers) for numbers in by_user.values())
+    print(f"{len(twilio.sent)} replies sent in {elapsed:.2f} s by {args.workers} workers, "
+          f"{rejected} rejected by backpressure, per-user order kept: {in_order}")
+    print(f"queue {queue.stats()}")
+
+
+def bench_stream(args):
+    answer = ("The Samsung Galaxy S24 Ultra costs $1,299 and is in stock. It comes with a "
+              "one year warranty and ships nationwide within three to five business days. ") * 2
+    llm = TokenDelayChatModel(responses=[answer], first_token_delay=args.first_token_delay,
+                              token_delay=args.token_delay)
+    embeddings = DeterministicFakeEmbedding(size=256)
+    rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings)
+    rag.vectorstore = Chroma.from_texts(load_chunks(200), embeddings)
+    rag.answer(QUESTIONS[0], [])  # warm up
+
+    totals = []
+    for i in range(args.requests):
+        start = time.perf_counter()
+        rag.answer(QUESTIONS[i % len(QUESTIONS)], [])
+        totals.append(time.perf_counter() - start)
+    summarize("invoke: time to answer", totals)
+
+    first_tokens, totals = [], []
+    for i in range(args.requests):
+        start = time.perf_counter()
+        pieces = []
+        for piece in rag.stream(QUESTIONS[i % len(QUESTIONS)], []):
+            if not pieces:
+                first_tokens.append(time.perf_counter() - start)
+            pieces.append(piece)
+        totals.append(time.perf_counter() - start)
+        assert "".join(pieces) == answer
+    summarize("stream: time to first token", first_tokens)
+    summarize("stream: time to last token", totals)
+
+
+def bench_respcache(args):
+    traffic = ["how much is the samsung galaxy s24 ultra?", "How much is the Samsung Galaxy S24 Ultra",
+               "do you deliver nationwide?", "Do you deliver nationwide??",
+               "do you deliver nationwide to my state?", "what is your return policy?",
+               "what is your return policy for phones?", "is the panasonic microwave oven in stock?",
+               "hello", "Hello!"]
+    rng = random.Random(0)
+    questions = [rng.choice(traffic) for _ in range(args.requests)]
+    embeddings = HashingEmbeddings()
+    chunks = load_chunks(200)
+
+    for name, cache in (("no response cache", None),
+                        ("response cache", ResponseCache(threshold=args.threshold))):
+        llm = TokenDelayChatModel(responses=["answer"], first_token_delay=args.llm_latency)
+        rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings,
+                  collection_name='knowledge_base_v1', response_cache=cache)
+        rag.vectorstore = Chroma.from_texts(chunks, embeddings)
+        timings = []
+        for question in questions:
+            start = time.perf_counter()
+            rag.answer(question, [])
+            timings.append(time.perf_counter() - start)
+        summarize(name, timings)
+        print(f"{'':<28} {llm.calls} LLM calls for {len(questions)} requests"
+              + (f" | {cache.stats()}" if cache else ""))
+
+    # A refresh publishes a new collection, whose scope starts empty
+    refreshed = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings,
+                    collection_name='knowledge_base_v2', response_cache=cache)
+    refreshed.vectorstore = rag.vectorstore
+    calls = llm.calls
+    refreshed.answer(traffic[0], [])
+    print(f"after a refresh, a cached question makes {llm.calls - calls} LLM call(s)")
+
+
+class AlwaysRewriteRouter(QuestionRouter):
+    # Previous behaviour of create_history_aware_retriever: rewrite whenever there is history
+    def route(self, question, formatted_history):
+        return "rewritten" if formatted_history else "no_history"
+
+
+def bench_routing(args):
+    conversations = [
+        ["hello", "do you deliver nationwide?", "how much is the samsung galaxy s24 ultra?"],
+        ["how much is the samsung galaxy s24 ultra?", "is it in stock?", "what about the s23?"],
+        ["what is your return policy?", "do you sell gaming laptops from asus?", "why?"],
+        ["do you have smartphones?", "which one is the cheapest?", "what warranty do tvs have?"],
+    ]
+    chunks = load_chunks(200)
+    embeddings = DeterministicFakeEmbedding(size=256)
+    for name, router in (("rewrite whenever history", AlwaysRewriteRouter()),
+                         ("routed", QuestionRouter())):
+        llm = TokenDelayChatModel(responses=["standalone question"],
+                                  first_token_delay=args.llm_latency)
+        rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings)
+        rag.vectorstore = Chroma.from_texts(chunks, embeddings)
+        chain = rag.build_chain()
+        chain.router = router
+        for i in range(args.conversations):
+            history = []
+            for question in conversations[i % len(conversations)]:
+                _, history = chain.answer(question, history)
+        stats = router.stats()
+        turns = sum(stats[path]["count"] for path in ("no_history", "self_contained", "rewritten"))
+        print(f"{name:<26} {llm.calls} LLM calls for {turns} turns | rewrite ratio "
+              f"{stats['rewrite_ratio']:.0%}")
+        for path in ("no_history", "self_contained", "rewritten"):
+            if stats[path]["count"]:
+                print(f"{'':<26} {path:<15} {stats[path]['count']:5d} | time to standalone "
+                      f"question p50 {stats[path]['p50'] * 1000:8.3f} ms")
+
+
+def bench_hybrid(args):
+    faqs, products = load_faqs(), load_products()
+    rng = random.Random(0)
+    embeddings = HashingEmbeddings()
+    workdir = tempfile.mkdtemp(prefix='hybrid_bench_')
+    try:
+        rag = RAG(text_file=KNOWLEDGE_BASE, dataset=faqs, llm=FakeListChatModel(responses=["answer"]),
+                  embeddings=embeddings, persist_directory=workdir)
+        rag.documents = rag.build_documents(load_about(), products)
+        rag.create_vector_store()
+        rag.build_chain()
+
+        def same_product(product):
+            return lambda doc: (doc.metadata.get("section") == "product"
+                                and doc.page_content.startswith(f"Product ID: {product['Product ID']}"))
+
+        def same_listing(product):
+            return lambda doc: (f"Name: {product['Product Name']}\n" in doc.page_content
+                                and f"Specifications: {product['Specifications']}\n" in doc.page_content)
+
+        queries = {"product id": [], "name + spec": [], "faq": []}
+        for product in rng.sample(products, args.queries):
+            queries["product id"].append(
+                (f"is {product['Product ID']} still available?", same_product(product)))
+            queries["name + spec"].append(
+                (f"{product['Product Name']} {product['Specifications']} price", same_listing(product)))
+        for faq in rng.sample(faqs, min(args.queries, len(faqs))):
+            answer = faq['answer']
+            queries["faq"].append((faq['question'].lower(), lambda doc, a=answer: a in doc.page_content))
+
+        modes = {"vector": lambda q: rag.retriever.invoke(q),
+                 "bm25": lambda q: [doc for _, doc in rag.lexical_index.search(q, k=5)],
+                 "hybrid": rag.search}
+        for kind, cases in queries.items():
+            for mode, search in modes.items():
+                calls, hits, timings = embeddings.calls, 0, []
+                for query, relevant in cases:
+                    start = time.perf_counter()
+                    documents = search(query)
+                    timings.append(time.perf_counter() - start)
+                    hits += any(relevant(doc) for doc in documents)
+                print(f"{kind:<12} {mode:<7} recall@5 {hits / len(cases):6.1%} | "
+                      f"p50 {statistics.median(timings) * 1000:7.3f} ms | "
+                      f"{(embeddings.calls - calls) / len(cases):4.2f} embedding calls/query")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_context(args):
+    chunks = load_chunks(400)
+    # Adjacent chunks share the 100-character splitter overlap, which the budget strips
+    budget = ContextBudget(context_tokens=10 ** 9)
+    before = after = 0
+    for i in range(0, len(chunks) - 5, 5):
+        documents = [Document(page_content=chunk) for chunk in chunks[i:i + 5]]
+        before += sum(len(document.page_content) for document in documents)
+        after += sum(len(document.page_content) for document in budget.assemble(documents))
+    print(f"overlap removed from runs of 5 adjacent chunks: {1 - after / before:.1%} of the text")
+
+    rag = build_fake_rag(chunks)
+    chain = rag.build_chain()
+    long_answer = ("Thanks for reaching out to ElectroNest! " + "We have a wide range of products "
+                   "with fast nationwide delivery and a one year warranty. " * 6)
+    history = []
+    for question in QUESTIONS[:3]:
+        history = chain.append_turn(history, question, long_answer)
+
+    unbounded = ContextBudget(context_tokens=10 ** 9, history_tokens=10 ** 9,
+                              recent_messages=10 ** 9)
+    for name, budget in (("no budget", unbounded),
+                         ("default budget", ContextBudget(args.context_tokens, args.history_tokens))):
+        budget.prompt_tokens = rag.context_budget.prompt_tokens
+        rag.context_budget = chain.context_budget = budget
+        for i in range(args.requests):
+            chain.answer(QUESTIONS[i % len(QUESTIONS)], history)
+        stats = budget.stats()
+        print(f"{name:<16} input tokens mean {stats['input_tokens_mean']:7.0f} | "
+              f"p99 {stats['input_tokens_p99']:6.0f} | saved per request {stats['saved_tokens_mean']:5.0f}")
+
+
+def bench_embedpipe(args):
+    faqs, about, products = load_faqs(), load_about(), load_products()
+    workdir = tempfile.mkdtemp(prefix='embedpipe_bench_')
+    text_file = os.path.join(workdir, 'knowledge_base.txt')
+
+    def embedder(failure_rate=0.0, seed=0):
+        return HashingEmbeddings(latency=args.latency, failure_rate=failure_rate, seed=seed,
+                                 max_batch=100)
+
+    def new_rag(embeddings, version):
+        rag = RAG(text_file=text_file, dataset=faqs, llm=FakeListChatModel(responses=["answer"]),
+                  embeddings=embeddings, persist_directory=workdir,
+                  collection_name=f'knowledge_base_v{version}')
+        rag.update_knowledge_base(about, products)
+        return rag
+
+    def report(name, embeddings, elapsed, computed):
+        print(f"{name:<34} {computed} chunks in {elapsed:6.2f} s ({computed / elapsed:7.1f} "
+              f"chunks/s), {embeddings.calls} requests, {embeddings.failures} failed")
+
+    try:
+        # Previous path: Chroma.add_documents per 500 chunks, one request after the other
+        embeddings = embedder()
+        rag = new_rag(embeddings, 1)
+        keyed = {content_hash(document.page_content): document for document in rag.documents}
+        store = Chroma(collection_name='knowledge_base_v1', embedding_function=embeddings,
+                       client=chromadb.PersistentClient(path=workdir))
+        start = time.perf_counter()
+        ids = list(keyed)
+        for i in range(0, len(ids), 500):
+            store.add_documents([keyed[chunk_id] for chunk_id in ids[i:i + 500]], ids=ids[i:i + 500])
+        report("sequential add_documents", embeddings, time.perf_counter() - start, len(ids))
+
+        os.environ.update({'EMBEDDING_BATCH_SIZE': str(args.batch_size),
+                           'EMBEDDING_RPS': str(args.rps), 'EMBEDDING_RETRIES': '5'})
+        for version, workers in enumerate((1, args.workers), 2):
+            os.environ['EMBEDDING_WORKERS'] = str(workers)
+            embeddings = embedder(args.failure_rate, seed=version)
+            rag = new_rag(embeddings, version)
+            start = time.perf_counter()
+            rag.create_vector_store()
+            report(f"pipeline, {workers} workers, {args.failure_rate:.0%} errors", embeddings,
+                   time.perf_counter() - start, rag.index_stats['computed'])
+
+        # A build that gives up part-way, then the same build again
+        os.environ['EMBEDDING_RETRIES'] = '0'
+        embeddings = embedder(failure_rate=0.1, seed=2)
+        rag = new_rag(embeddings, 4)
+        try:
+            rag.create_vector_store()
+        except ConnectionError:
+            pass
+        client = chromadb.PersistentClient(path=workdir)
+        stored = client.get_collection('knowledge_base_v4').get(include=[])['ids']
+        os.environ['EMBEDDING_RETRIES'] = '5'
+        embeddings = embedder()
+        rag = new_rag(embeddings, 4)
+        start = time.perf_counter()
+        rag.create_vector_store()
+        report(f"resume after failing at {len(stored)}", embeddings,
+               time.perf_counter() - start, rag.index_stats['computed'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_coalesce(args):
+    promotion = ["is the samsung galaxy s24 ultra on discount?", "Is the Samsung Galaxy S24 Ultra on discount",
+                 "how long does the promo last?", "do you deliver nationwide?"]
+    rng = random.Random(0)
+    bursts = [[rng.choice(promotion[:args.distinct]) for _ in range(args.burst)]
+              for _ in range(args.bursts)]
+    embeddings = HashingEmbeddings(latency=args.embedding_latency)
+    chunks = load_chunks(200)
+
+    for name, timeout in (("no coalescing", 0), ("single-flight coalescing", args.timeout)):
+        llm = TokenDelayChatModel(responses=["answer"], first_token_delay=args.llm_latency)
+        rag = RAG(text_file=KNOWLEDGE_BASE, dataset=[], llm=llm, embeddings=embeddings,
+                  collection_name='knowledge_base_v1')
+        rag.coalesce_timeout = timeout
+        rag.vectorstore = Chroma.from_texts(chunks, embeddings)
+        chain = rag.build_chain()
+
+        timings = []
+
+        def ask(question):
+            start = time.perf_counter()
+            chain.answer(question, [])
+            timings.append(time.perf_counter() - start)
+
+        embedding_calls = embeddings.calls
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.burst) as pool:
+            for burst in bursts:
+                list(pool.map(ask, burst))
+        elapsed = time.perf_counter() - start
+        requests = args.burst * args.bursts
+        summarize(name, timings)
+        print(f"{'':<28} {llm.calls} LLM calls, {embeddings.calls - embedding_calls} embedding "
+              f"calls for {requests} requests, {requests / elapsed:.1f} requests/s")
+        if chain.single_flight is not None:
+            print(f"{'':<28} {chain.single_flight.stats()}")
+
+
+def seed_chat_sessions(db, sessions, messages, stale_share):
+    now = datetime.now(timezone.utc)
+    for i in range(sessions):
+        last_active = now - timedelta(hours=48 if i < sessions * stale_share else 1, seconds=i)
+        session = db.collection("chat_sessions").document(f"user-{i}")
+        db.docs[session.path] = {"last_active": last_active}
+        for j in range(messages):
+            message = session.collection("messages").document()
+            db.docs[message.path] = {"text": f"message {j}", "sender": "user",
+                                     "timestamp": last_active + timedelta(microseconds=j)}
+
+
+def bench_cleanup(args):
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=24)
+
+    def orphaned(db):
+        sessions = {path[1] for path in db.docs if len(path) == 2}
+        return sum(1 for path in db.docs if len(path) == 4 and path[1] not in sessions)
+
+    # The previous job: one delete per stale session document, messages left behind
+    db = FakeFirestore(latency=args.latency)
+    seed_chat_sessions(db, args.sessions, args.messages, args.stale_share)
+    start = time.perf_counter()
+    deleted = 0
+    for session in db.collection("chat_sessions").where("last_active", "<", cutoff).stream():
+        db.collection("chat_sessions").document(session.id).delete()
+        deleted += 1
+    elapsed = time.perf_counter() - start
+    print(f"{'per-document delete':<22} {deleted} documents in {elapsed:6.2f} s "
+          f"({deleted / elapsed:8.1f} documents/s), {db.round_trips} round trips, "
+          f"{orphaned(db)} orphaned messages")
+
+    db = FakeFirestore(latency=args.latency)
+    seed_chat_sessions(db, args.sessions, args.messages, args.stale_share)
+    counted = ChatCleanup(db, dry_run=True).run(cutoff)
+    print(f"{'dry run':<22} {counted['sessions']} sessions and {counted['messages']} messages "
+          f"counted in {counted['seconds']:6.2f} s")
+    db.reset_counters()
+    stats = ChatCleanup(db, batch_size=args.batch_size, workers=args.workers).run(cutoff)
+    print(f"{'paginated bulk delete':<22} {stats['sessions'] + stats['messages']} documents in "
+          f"{stats['seconds']:6.2f} s ({stats['documents_per_second']:8.1f} documents/s), "
+          f"{db.round_trips} round trips, {orphaned(db)} orphaned messages")
+
+
+def bench_tenants(args):
+    '''
+    Serve `--tenants` businesses from one process with at most `--max-loaded` knowledge bases
+    in memory, and drive /faq with a skewed popularity so some tenants are evicted and reloaded
+    '''
+    workdir = tempfile.mkdtemp(prefix='tenants_bench_')
+    products = load_products()
+    configs = [{"id": f"store-{i}", "faqs_path": FAQS, "storage_type": "googlesheet",
+                "whatsapp_number": f"whatsapp:+1555{i:07d}",
+                "system_prompt": f"You are the customer support assistant of store {i}."}
+               for i in range(args.tenants)]
+    for config in configs:
+        directory = os.path.join(workdir, 'tenants', config['id'])
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'about.txt'), 'w') as f:
+            f.write(f"About Us\n{config['id']} sells electronics. Call us on 0700{config['id'][6:]:0>7}.\n")
+    tenants_file = os.path.join(workdir, 'tenants.json')
+    with open(tenants_file, 'w') as f:
+        json.dump(configs, f)
+    os.environ.update({'TENANTS_FILE': tenants_file, 'TENANTS_DIR': os.path.join(workdir, 'tenants'),
+                       'TENANT_CACHE_SIZE': str(args.max_loaded), 'KNOWLEDGE_BASE_AUTOSTART': '0',
+                       'EMBEDDING_CACHE_DIR': '', 'RESPONSE_CACHE_SIZE': '0'})
+    log = sys.stdout if args.verbose else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(log):
+            import app
+
+            app.chat_store_instance = ChatStore(FakeFirestore(latency=0.02))
+            app.llm_instance = TokenDelayChatModel(responses=[ANSWER])
+            app.embeddings_instance = HashingEmbeddings()
+            rng = random.Random(args.seed)
+            start = time.perf_counter()
+            for tenant in app.tenants.tenants.values():
+                os.makedirs(os.path.dirname(tenant.text_file), exist_ok=True)
+                tenant.get_data_instance = GetData('googlesheet', sheet=FakeSheet(
+                    rng.sample(products, len(products) // 2)), about_path=tenant.about_path)
+                tenant.checked = True  # Built just now, no need to check it against the sheet
+                app.refresh_knowledge_base(tenant)
+                tenant.unload()
+            built = time.perf_counter() - start
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            # Zipf-like popularity: a few stores get most of the traffic
+            ids = list(app.tenants.tenants)
+            weights = [1 / (rank + 1) for rank in range(len(ids))]
+            plan = [(rng.choices(ids, weights)[0], f"user-{rng.randrange(100)}",
+                     rng.choice(QUESTIONS)) for _ in range(args.requests)]
+            clients = threading.local()
+            timings, errors = [], []
+
+            def send(request):
+                tenant_id, user, question = request
+                if not hasattr(clients, 'client'):
+                    clients.client = app.app.test_client()
+                started = time.perf_counter()
+                response = clients.client.post('/faq', json={
+                    "question": question, "user_id": user, "tenant_id": tenant_id})
+                timings.append(time.perf_counter() - started)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(send, plan))
+            elapsed = time.perf_counter() - start
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        if log is not sys.stdout:
+            log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.tenants} tenants built in {built:.1f} s, at most {args.max_loaded} loaded")
+    summarize("/faq across tenants", timings)
+    print(f"{len(timings) / elapsed:.1f} requests/s, {len(errors)} errors, "
+          f"registry {app.tenants.stats()}")
+    print(f"peak RSS {rss_before / 1024:.0f} MB after building, {rss_after / 1024:.0f} MB after serving")
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100))] if timings else 0.0
+
+
+def latency_summary(timings, elapsed):
+    return {"requests": len(timings),
+            "rps": round(len(timings) / elapsed, 2) if elapsed else 0.0,
+            "mean_ms": round(statistics.mean(timings) * 1000, 3) if timings else 0.0,
+            "p50_ms": round(percentile(timings, 50) * 1000, 3),
+            "p95_ms": round(percentile(timings, 95) * 1000, 3),
+            "p99_ms": round(percentile(timings, 99) * 1000, 3)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(KNOWLEDGE_BASE)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_fake_app(args):
+    '''
+    Import app.py with every external service replaced by a fake with the latencies in `args`.
+    The environment must already be set up, the knowledge base is not built yet.
+
+    returns:
+     - The app module
+     - Its fake Firestore, chat model, embeddings and Twilio client
+    '''
+    import app
+
+    db = FakeFirestore(latency=args.firestore_latency)
+    sheet = FakeSheet(load_products(), latency=args.sheet_latency)
+    llm = TokenDelayChatModel(responses=[ANSWER], first_token_delay=args.llm_latency,
+                              token_delay=args.token_delay)
+    embeddings = HashingEmbeddings(latency=args.embedding_latency)
+    twilio = FakeTwilioClient(latency=args.twilio_latency)
+    app.chat_store_instance = ChatStore(db)
+    app.tenants.default.get_data_instance = GetData('googlesheet', sheet=sheet)
+    app.twilio_client_instance = twilio
+    app.llm_instance, app.embeddings_instance = llm, embeddings
+    return app, (db, llm, embeddings, twilio)
+
+
+def load_questions(rng):
+    '''
+    Mostly questions the FAQ dataset cannot answer, so they reach retrieval and the LLM
+    '''
+    questions = QUESTIONS + [faq['question'] for faq in rng.sample(load_faqs(), 10)]
+    for product in load_products():
+        questions += [f"how much is the {product['Product Name']}?",
+                      f"does {product['Product ID']} come with a warranty?"]
+    return questions
+
+
+def bench_load(args):
+    '''
+    Boot app.py against the fakes and drive /faq and /whatsapp from `--concurrency` threads.
+    Prints one JSON document, so runs can be compared across commits.
+    '''
+    workdir = tempfile.mkdtemp(prefix='load_bench_')
+    text_file = os.path.join(workdir, 'knowledge_base.txt')
+    shutil.copyfile(KNOWLEDGE_BASE, text_file)
+    os.environ.update({'FAQS_PATH': FAQS, 'TEXT_FILE': text_file, 'STORAGE_TYPE': 'googlesheet',
+                       'KNOWLEDGE_BASE_AUTOSTART': '0', 'EMBEDDING_CACHE_DIR': '',
+                       'WHATSAPP_ASYNC': '1' if args.whatsapp_async else '0',
+                       'TWILIO_AUTH_TOKEN': 'benchmark-token',
+                       'WHATSAPP_WORKERS': str(args.workers),
+                       'RESPONSE_CACHE_SIZE': str(args.response_cache_size)})
+    cwd = os.getcwd()
+    os.chdir(workdir)  # chroma_db and faq_db are relative to the working directory
+    log = sys.stdout if args.verbose else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(log):
+            app, fakes = start_fake_app(args)
+            db, llm, embeddings, twilio = fakes
+            tenant = app.tenants.default
+            start = time.perf_counter()
+            app.refresh_knowledge_base(tenant)
+            startup = time.perf_counter() - start
+
+            rng = random.Random(args.seed)
+            questions = load_questions(rng)
+            plan = [("whatsapp" if rng.random() < args.whatsapp_share else "faq",
+                     f"user-{rng.randrange(args.users)}", rng.choice(questions))
+                    for _ in range(args.requests)]
+
+            before = (llm.calls, embeddings.calls, db.round_trips, len(twilio.sent))
+            clients = threading.local()
+            results = {"faq": [], "whatsapp": []}
+            errors = []
+
+            def send(request):
+                endpoint, user, question = request
+                if not hasattr(clients, 'client'):
+                    clients.client = app.app.test_client()
+                started = time.perf_counter()
+                if endpoint == "faq":
+                    response = clients.client.post('/faq', json={"question": question, "user_id": user})
+                else:
+                    form = {"Body": question, "From": f"whatsapp:+1{user.split('-')[1]:0>9}",
+                            "To": BUSINESS_NUMBER}
+                    response = clients.client.post(
+                        '/whatsapp', data=form,
+                        headers=twilio_headers('http://localhost/whatsapp', form))
+                elapsed = time.perf_counter() - started
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+                results[endpoint].append(elapsed)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(send, plan))
+            elapsed = time.perf_counter() - start
+            drained = elapsed
+            if app.reply_queue is not None:
+                app.reply_queue.join()
+                drained = time.perf_counter() - start
+            after = (llm.calls, embeddings.calls, db.round_trips, len(twilio.sent))
+            single_flight = tenant.live_rag.rag.build_chain().single_flight
+    finally:
+        os.chdir(cwd)
+        if log is not sys.stdout:
+            log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    served = args.requests or 1
+    calls = {name: round((after[i] - before[i]) / served, 3)
+             for i, name in enumerate(("llm", "embedding", "firestore", "twilio"))}
+    report = {
+        "benchmark": "load",
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "config": {key: value for key, value in vars(args).items() if key != 'func'},
+        "startup_s": round(startup, 3),
+        "elapsed_s": round(elapsed, 3),
+        "drained_s": round(drained, 3),
+        "errors": len(errors),
+        "overall": latency_summary(results["faq"] + results["whatsapp"], elapsed),
+        "endpoints": {endpoint: latency_summary(timings, elapsed)
+                      for endpoint, timings in results.items() if timings},
+        "external_calls_per_request": calls,
+    }
+    if app.response_cache is not None:
+        report["response_cache"] = app.response_cache.stats()
+    if single_flight is not None:
+        report["coalescing"] = single_flight.stats()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def bench_serve(args):
+    '''
+    Requests per second of app.py over real HTTP at a fixed fake-LLM latency: served one request
+    at a time, then by server.py's threaded server with and without its concurrency limit
+    '''
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+    from werkzeug.serving import make_server as werkzeug_server
+    import server
+
+    workdir = tempfile.mkdtemp(prefix='serve_bench_')
+    text_file = os.path.join(workdir, 'knowledge_base.txt')
+    shutil.copyfile(KNOWLEDGE_BASE, text_file)
+    # Every request pays the LLM latency: no response cache, no coalescing
+    os.environ.update({'FAQS_PATH': FAQS, 'TEXT_FILE': text_file, 'STORAGE_TYPE': 'googlesheet',
+                       'KNOWLEDGE_BASE_AUTOSTART': '0', 'EMBEDDING_CACHE_DIR': '',
+                       'RESPONSE_CACHE_SIZE': '0', 'COALESCE_TIMEOUT': '0',
+                       'TWILIO_AUTH_TOKEN': 'benchmark-token'})
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    log = sys.stdout if args.verbose else open(os.devnull, 'w')
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # One access log line per request
+    rows = []
+    try:
+        with contextlib.redirect_stdout(log):
+            app, (db, llm, embeddings, twilio) = start_fake_app(args)
+            app.refresh_knowledge_base(app.tenants.default)
+            server.warm_up(app)
+            rng = random.Random(args.seed)
+            questions = load_questions(rng)
+            plan = [("whatsapp" if rng.random() < 0.5 else "faq", f"user-{rng.randrange(50)}",
+                     rng.choice(questions)) for _ in range(args.requests)]
+
+            def send(base_url, request):
+                endpoint, user, question = request
+                if endpoint == "faq":
+                    data = json.dumps({"question": question, "user_id": user}).encode()
+                    headers = {'Content-Type': 'application/json'}
+                else:
+                    form = {"Body": question, "From": f"whatsapp:+1{user.split('-')[1]:0>9}"}
+                    data = urllib.parse.urlencode(form).encode()
+                    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                               **twilio_headers(f"{base_url}/{endpoint}", form)}
+                started = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(
+                            f"{base_url}/{endpoint}", data=data, headers=headers), timeout=60) as r:
+                        r.read()
+                        status = r.status
+                except urllib.error.HTTPError as e:
+                    status = e.code
+                return status, time.perf_counter() - started
+
+            servers = (
+                ("one request at a time", lambda port: werkzeug_server(
+                    '127.0.0.1', port, app.app, threaded=False)),
+                ("threaded, no limit", lambda port: server.make_server(
+                    app.app, '127.0.0.1', port, max_concurrent=0)),
+                (f"threaded, limit {args.max_concurrent}", lambda port: server.make_server(
+                    app.app, '127.0.0.1', port, max_concurrent=args.max_concurrent,
+                    queue_timeout=args.queue_timeout)),
+            )
+            for name, factory in servers:
+                http_server = factory(0)
+                port = http_server.socket.getsockname()[1] if hasattr(http_server, 'socket') \
+                    else http_server.effective_port
+                threading.Thread(target=http_server.serve_forever, daemon=True).start()
+                llm_calls = llm.calls
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                    results = list(pool.map(lambda request: send(f"http://127.0.0.1:{port}", request),
+                                            plan))
+                elapsed = time.perf_counter() - start
+                http_server.shutdown()
+                ok = [seconds for status, seconds in results if status < 400]
+                rows.append((name, elapsed, ok, len(results) - len(ok), llm.calls - llm_calls))
+    finally:
+        os.chdir(cwd)
+        if log is not sys.stdout:
+            log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.requests} requests from {args.concurrency} clients, "
+          f"LLM first token after {args.llm_latency * 1000:.0f} ms")
+    for name, elapsed, ok, failed, llm_calls in rows:
+        summary = latency_summary(ok, elapsed)
+        print(f"{name:<24} {summary['rps']:7.1f} req/s | p50 {summary['p50_ms']:8.1f} ms | "
+              f"p99 {summary['p99_ms']:8.1f} ms | {failed} rejected | {llm_calls} LLM calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    chain = subparsers.add_parser(
+        'chain', help='Per-request overhead of rebuilding the chain vs reusing it')
+    chain.add_argument('--requests', type=int, default=200)
+    chain.add_argument('--chunks', type=int, default=200)
+    chain.set_defaults(func=bench_chain)
+
+    index = subparsers.add_parser(
+        'index', help='Embeddings computed vs reused on a cold build and a no-op refresh')
+    index.set_defaults(func=bench_index)
+
+    firestore = subparsers.add_parser(
+        'firestore', help='Firestore writes, round-trips and history cache hits per chat turn')
+    firestore.add_argument('--turns', type=int, default=20)
+    firestore.set_defaults(func=bench_firestore)
+
+    faq = subparsers.add_parser(
+        'faq', help='Share of traffic answered by the FAQ fast path and its latency')
+    faq.add_argument('--requests', type=int, default=3000)
+    faq.add_argument('--cutoff', type=float, default=0.9)
+    faq.set_defaults(func=bench_faq)
+
+    catalog = subparsers.add_parser(
+        'catalog', help='Product catalog build, incremental update and lookup latency')
+    catalog.add_argument('--requests', type=int, default=5000)
+    catalog.set_defaults(func=bench_catalog)
+
+    chunking = subparsers.add_parser(
+        'chunking', help='Chunk count, embedding cost and retrieval precision per chunking strategy')
+    chunking.add_argument('--queries', type=int, default=100)
+    chunking.set_defaults(func=bench_chunking)
+
+    embedcache = subparsers.add_parser(
+        'embedcache', help='Embedding calls on a cold start and on restarts with the disk cache')
+    embedcache.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds per fake embedding request')
+    embedcache.add_argument('--capacity', type=int, default=10000)
+    embedcache.set_defaults(func=bench_embedcache)
+
+    startup = subparsers.add_parser(
+        'startup', help='Time to first answer: rebuilding the index vs opening the persisted one')
+    startup.add_argument('--latency', type=float, default=0.2,
+                         help='Seconds per fake embedding request')
+    startup.set_defaults(func=bench_startup)
+
+    sheets = subparsers.add_parser(
+        'sheets', help='Sheet downloads and catalog work per poll, with row-level diffing')
+    sheets.set_defaults(func=bench_sheets)
+
+    webhook = subparsers.add_parser(
+        'webhook', help='WhatsApp webhook ack latency, synchronous vs queued replies')
+    webhook.add_argument('--users', type=int, default=20)
+    webhook.add_argument('--messages', type=int, default=5, help='Messages per user')
+    webhook.add_argument('--workers', type=int, default=8)
+    webhook.add_argument('--queue-size', type=int, default=80)
+    webhook.add_argument('--llm-latency', type=float, default=0.05)
+    webhook.add_argument('--firestore-latency', type=float, default=0.005)
+    webhook.add_argument('--twilio-latency', type=float, default=0.01)
+    webhook.set_defaults(func=bench_webhook)
+
+    stream = subparsers.add_parser(
+        'stream', help='Time to first token when streaming /faq answers vs waiting for invoke')
+    stream.add_argument('--requests', type=int, default=10)
+    stream.add_argument('--first-token-delay', type=float, default=0.3)
+    stream.add_argument('--token-delay', type=float, default=0.02)
+    stream.set_defaults(func=bench_stream)
+
+    respcache = subparsers.add_parser(
+        'respcache', help='LLM calls and latency with the semantic response cache')
+    respcache.add_argument('--requests', type=int, default=500)
+    respcache.add_argument('--threshold', type=float, default=0.95)
+    respcache.add_argument('--llm-latency', type=float, default=0.05)
+    respcache.set_defaults(func=bench_respcache)
+
+    routing = subparsers.add_parser(
+        'routing', help='History rewrite calls skipped by routing self-contained questions')
+    routing.add_argument('--conversations', type=int, default=40)
+    routing.add_argument('--llm-latency', type=float, default=0.02)
+    routing.set_defaults(func=bench_routing)
+
+    hybrid = subparsers.add_parser(
+        'hybrid', help='Recall and latency of vector, BM25 and hybrid retrieval')
+    hybrid.add_argument('--queries', type=int, default=100)
+    hybrid.set_defaults(func=bench_hybrid)
+
+    context = subparsers.add_parser(
+        'context', help='Input tokens per request with and without the context budget')
+    context.add_argument('--requests', type=int, default=40)
+    context.add_argument('--context-tokens', type=int, default=1500)
+    context.add_argument('--history-tokens', type=int, default=400)
+    context.set_defaults(func=bench_context)
+
+    embedpipe = subparsers.add_parser(
+        'embedpipe', help='Full rebuild embedding throughput, sequential vs the parallel pipeline')
+    embedpipe.add_argument('--latency', type=float, default=0.2, help='Seconds per request')
+    embedpipe.add_argument('--batch-size', type=int, default=100)
+    embedpipe.add_argument('--workers', type=int, default=8)
+    embedpipe.add_argument('--rps', type=float, default=20, help='Requests per second limit')
+    embedpipe.add_argument('--failure-rate', type=float, default=0.1)
+    embedpipe.set_defaults(func=bench_embedpipe)
+
+    coalesce = subparsers.add_parser(
+        'coalesce', help='Bursts of identical concurrent questions, with and without coalescing')
+    coalesce.add_argument('--bursts', type=int, default=10)
+    coalesce.add_argument('--burst', type=int, default=32, help='Concurrent requests per burst')
+    coalesce.add_argument('--distinct', type=int, default=3, help='Different questions per burst')
+    coalesce.add_argument('--timeout', type=float, default=30)
+    coalesce.add_argument('--llm-latency', type=float, default=0.3)
+    coalesce.add_argument('--embedding-latency', type=float, default=0.05)
+    coalesce.set_defaults(func=bench_coalesce)
+
+    cleanup = subparsers.add_parser(
+        'cleanup', help='Stale chat session cleanup, per-document vs paginated bulk deletes')
+    cleanup.add_argument('--sessions', type=int, default=400)
+    cleanup.add_argument('--messages', type=int, default=30, help='Messages per session')
+    cleanup.add_argument('--stale-share', type=float, default=0.75)
+    cleanup.add_argument('--batch-size', type=int, default=500)
+    cleanup.add_argument('--workers', type=int, default=8)
+    cleanup.add_argument('--latency', type=float, default=0.01, help='Seconds per round trip')
+    cleanup.set_defaults(func=bench_cleanup)
+
+    tenants = subparsers.add_parser(
+        'tenants', help='Many businesses served by one process with a bounded set loaded')
+    tenants.add_argument('--tenants', type=int, default=30)
+    tenants.add_argument('--max-loaded', type=int, default=10)
+    tenants.add_argument('--requests', type=int, default=300)
+    tenants.add_argument('--concurrency', type=int, default=8)
+    tenants.add_argument('--seed', type=int, default=0)
+    tenants.add_argument('--verbose', action='store_true', help='Keep the app logs')
+    tenants.set_defaults(func=bench_tenants)
+
+    load = subparsers.add_parser(
+        'load', help='Throughput and latency of the Flask app under concurrent /faq and /whatsapp load')
+    load.add_argument('--requests', type=int, default=400)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--whatsapp-share', type=float, default=0.5,
+                      help='Fraction of requests sent to /whatsapp, the rest go to /faq')
+    load.add_argument('--whatsapp-async', action='store_true',
+                      help='Acknowledge /whatsapp at once and reply from the worker pool')
+    load.add_argument('--workers', type=int, default=8)
+    load.add_argument('--response-cache-size', type=int, default=1000, help='0 disables it')
+    load.add_argument('--llm-latency', type=float, default=0.2, help='Seconds to the first token')
+    load.add_argument('--token-delay', type=float, default=0.005)
+    load.add_argument('--embedding-latency', type=float, default=0.05)
+    load.add_argument('--firestore-latency', type=float, default=0.01)
+    load.add_argument('--sheet-latency', type=float, default=0.2)
+    load.add_argument('--twilio-latency', type=float, default=0.05)
+    load.add_argument('--seed', type=int, default=0)
+    load.add_argument('--output', help='Also write the JSON report to this file')
+    load.add_argument('--verbose', action='store_true', help='Keep the app logs')
+    load.set_defaults(func=bench_load)
+
+    serve = subparsers.add_parser(
+        'serve', help='Requests per second over HTTP, one at a time vs the threaded server.py')
+    serve.add_argument('--requests', type=int, default=200)
+    serve.add_argument('--concurrency', type=int, default=32)
+    serve.add_argument('--max-concurrent', type=int, default=16)
+    serve.add_argument('--queue-timeout', type=float, default=5.0)
+    serve.add_argument('--llm-latency', type=float, default=0.2, help='Seconds to the first token')
+    serve.add_argument('--token-delay', type=float, default=0.005)
+    serve.add_argument('--embedding-latency', type=float, default=0.05)
+    serve.add_argument('--firestore-latency', type=float, default=0.01)
+    serve.add_argument('--sheet-latency', type=float, default=0.2)
+    serve.add_argument('--twilio-latency', type=float, default=0.05)
+    serve.add_argument('--seed', type=int, default=0)
+    serve.add_argument('--verbose', action='store_true', help='Keep the app logs')
+    serve.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+from cache import LRUCache
+
+HISTORY_LIMIT = 5
+# Same value as firestore.Query.DESCENDING, without importing the Firestore client at startup
+DESCENDING = "DESCENDING"
+
+
+class ChatStore():
+    '''
+    Persists chat turns in Firestore under chat_sessions/{user_id}/messages
+
+    Each user's recent-turn window is kept in a bounded LRU/TTL cache. `store_message` writes
+    through to it, so a conversation only hits Firestore for history on its first turn or after
+    the entry expired. Memory stays bounded by `cache_size` windows of `history_limit` messages.
+
+    Args:
+     - db: Firestore client (or anything with the same interface, e.g. fakes.FakeFirestore)
+     - history_limit: Number of most recent messages returned as history
+     - cache_size: Maximum number of users whose history window is cached, 0 disables the cache
+     - cache_ttl: Seconds a cached window is trusted before it is re-read from Firestore
+    '''
+
+    def __init__(self, db, history_limit=HISTORY_LIMIT, cache_size=10000, cache_ttl=300):
+        self.db = db
+        self.history_limit = history_limit
+        self.cache = LRUCache(cache_size, ttl=cache_ttl) if cache_size else None
+
+    def session_ref(self, user_id):
+        return self.db.collection("chat_sessions").document(user_id)
+
+    def store_message(self, messages, user_id):
+        '''
+        Append the messages of a new turn in a single batched commit.
+        Only the new messages are written, plus one `last_active` update for the session.
+
+        Args:
+         - messages: List of {"text", "sender"} dicts, oldest first
+         - user_id: The chat session to append to
+        '''
+        if not messages:
+            return "No messages to store"
+
+        session_ref = self.session_ref(user_id)
+        chat_ref = session_ref.collection("messages")
+        now = datetime.now(timezone.utc)
+
+        batch = self.db.batch()
+        for i, data in enumerate(messages):
+            message_data = {
+                "text": data["text"],
+                "sender": data["sender"],  # "user" or "bot"
+                # Keep messages of the same turn strictly ordered by timestamp
+                "timestamp": now + timedelta(microseconds=i),
+            }
+            batch.set(chat_ref.document(), message_data)
+
+        # Update last active time
+        batch.set(session_ref, {"last_active": now}, merge=True)
+        batch.commit()
+
+        if self.cache is not None:
+            new_messages = tuple({"text": data["text"], "sender": data["sender"]}
+                                 for data in messages)
+            self.cache.update(user_id, lambda window: (
+                window + new_messages)[-self.history_limit:])
+
+        return "Message stored successfully"
+
+    def get_chat_history(self, user_id):
+        if self.cache is not None:
+            window = self.cache.get(user_id)
+            if window is not None:
+                return [dict(message) for message in window]
+
+        messages_ref = (
+            self.session_ref(user_id)
+            .collection("messages")
+            .order_by("timestamp", direction=DESCENDING)
+            .limit(self.history_limit)
+        )
+
+        chat_history = []
+        for msg in messages_ref.stream():
+            data = msg.to_dict()
+            chat_history.append({"text": data.get("text", ""),
+                                 "sender": data.get("sender", "")})
+
+        chat_history = chat_history[::-1]  # Oldest first
+        if self.cache is not None:
+            self.cache.set(user_id, tuple(chat_history))
+        return [dict(message) for message in chat_history]
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {}
@@ -0,0 +1,124 @@
+from langchain.schema import Document
+from metrics import Histogram
+
+# Rough tokens-per-character ratio of English text for Gemini and most BPE tokenizers
+CHARS_PER_TOKEN = 4
+# Overlaps shorter than this are treated as coincidence rather than shared chunk text
+MIN_OVERLAP_CHARS = 40
+# Smallest piece of a document worth keeping when it has to be cut to fit the budget
+MIN_PIECE_TOKENS = 40
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def overlap_length(left, right):
+    '''
+    Length of the longest suffix of `left` that is also a prefix of `right`
+    '''
+    for size in range(min(len(left), len(right)), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class ContextBudget():
+    '''
+    Bounds what is sent to the answer LLM on every request.
+
+    Retrieved documents are deduplicated (exact copies, documents contained in another one,
+    and the text adjacent chunks share because of the splitter overlap), kept in retrieval
+    order, which puts catalog matches first, and cut off at `context_tokens`. Chat history
+    keeps the last `recent_messages` verbatim; older messages are shortened to an excerpt and
+    the oldest are dropped once the history exceeds `history_tokens`.
+
+    Token counts are estimated from character counts, no tokenizer is loaded.
+
+    Args:
+     - context_tokens: Budget for the retrieved documents
+     - history_tokens: Budget for the chat history
+     - recent_messages: Number of latest messages never shortened
+     - excerpt_chars: Length older messages are shortened to
+    '''
+
+    def __init__(self, context_tokens=1500, history_tokens=400, recent_messages=2,
+                 excerpt_chars=200):
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.recent_messages = recent_messages
+        self.excerpt_chars = excerpt_chars
+        self.prompt_tokens = 0  # Tokens of the fixed system prompt, set by RAG.query_LLM
+        self.input_tokens = Histogram(buckets=(250, 500, 1000, 2000, 4000, 8000, 16000))
+        self.saved_tokens = Histogram(buckets=(0, 100, 250, 500, 1000, 2000, 4000))
+
+    def assemble(self, documents):
+        '''
+        Deduplicate and trim retrieved documents to the context budget
+        '''
+        kept, used = [], 0
+        for document in documents:
+            text = document.page_content.strip()
+            for previous in kept:
+                if text in previous.page_content:
+                    text = ""
+                    break
+                text = text[overlap_length(previous.page_content, text):]
+            if not text.strip():
+                continue
+
+            tokens = estimate_tokens(text)
+            if used + tokens > self.context_tokens:
+                remaining = self.context_tokens - used
+                if remaining < MIN_PIECE_TOKENS:
+                    break
+                text, tokens = text[:remaining * CHARS_PER_TOKEN], remaining
+            kept.append(Document(page_content=text, metadata=document.metadata))
+            used += tokens
+        return kept
+
+    def compress_history(self, messages):
+        '''
+        Shorten older messages and drop the oldest ones to fit the history budget
+        '''
+        recent_start = max(len(messages) - self.recent_messages, 0)
+        compressed = []
+        for i, message in enumerate(messages):
+            if i < recent_start and len(message.content) > self.excerpt_chars:
+                message = message.__class__(content=message.content[:self.excerpt_chars] + "...")
+            compressed.append(message)
+
+        while (len(compressed) > self.recent_messages
+               and sum(estimate_tokens(m.content) for m in compressed) > self.history_tokens):
+            compressed.pop(0)
+        return compressed
+
+    def record(self, question, history, context, raw_history=None, raw_context=None):
+        '''
+        Log the estimated input tokens of a request, and the tokens the budget saved
+
+        returns:
+         - The estimated input token count
+        '''
+        history_tokens = sum(estimate_tokens(message.content) for message in history)
+        context_tokens = sum(estimate_tokens(document.page_content) for document in context)
+        total = self.prompt_tokens + estimate_tokens(question) + history_tokens + context_tokens
+        self.input_tokens.observe(total)
+
+        saved = 0
+        if raw_history is not None:
+            saved += sum(estimate_tokens(message.content) for message in raw_history) - history_tokens
+        if raw_context is not None:
+            saved += sum(estimate_tokens(document.page_content) for document in raw_context) - context_tokens
+        self.saved_tokens.observe(saved)
+        print(f"[INFO] Input tokens: ~{total} (prompt {self.prompt_tokens}, history "
+              f"{history_tokens}, context {context_tokens}), {saved} saved by the context budget")
+        return total
+
+    def stats(self):
+        return {"requests": self.input_tokens.count,
+                "input_tokens_mean": self.input_tokens.sum / self.input_tokens.count
+                if self.input_tokens.count else 0.0,
+                "input_tokens_p99": self.input_tokens.percentile(99),
+                "saved_tokens_mean": self.saved_tokens.sum / self.saved_tokens.count
+                if self.saved_tokens.count else 0.0}
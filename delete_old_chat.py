@@ -1,18 +1,175 @@
-import firebase_admin
-from firebase_admin import firestore
+'''
+Deletes chat sessions inactive for longer than a cutoff, together with their `messages`
+subcollection, which Firestore does not delete with the parent document.
+
+Usage:
+    python delete_old_chat.py --hours 24
+    python delete_old_chat.py --dry-run
+    python delete_old_chat.py --emulator localhost:8080 --project demo-chatbot
+'''
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
-db = firestore.client()
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_SIZE = 500
+
+
+class ChatCleanup():
+    '''
+    Pages through stale sessions by `last_active` and deletes each one's messages in batched
+    commits of up to `batch_size`, then the session document itself. Sessions of a page are
+    purged by up to `workers` threads.
+
+    A session document is only deleted once its messages are gone, so it keeps matching the
+    stale query until it is fully purged: an interrupted or failed run is resumed by running
+    the job again.
+
+    Args:
+     - db: Firestore client (or anything with the same interface, e.g. fakes.FakeFirestore)
+     - batch_size: Messages deleted per batched commit, at most 500
+     - page_size: Stale sessions fetched per query
+     - workers: Number of sessions purged in parallel
+     - dry_run: Only count what would be deleted
+    '''
+
+    def __init__(self, db, batch_size=MAX_BATCH_SIZE, page_size=100, workers=4, dry_run=False):
+        self.db = db
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.page_size = page_size
+        self.workers = workers
+        self.dry_run = dry_run
+        self.sessions = 0
+        self.messages = 0
+        self.failed = 0
+
+    def stale_sessions(self, cutoff):
+        '''
+        Stale session snapshots, oldest first, one page of `page_size` at a time
+        '''
+        query = (self.db.collection("chat_sessions")
+                 .where("last_active", "<", cutoff)
+                 .order_by("last_active")
+                 .limit(self.page_size))
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            if not page:
+                return
+            yield page
+            if len(page) < self.page_size:
+                return
+            last = page[-1]
+
+    def count_messages(self, session_ref):
+        query = session_ref.collection("messages").order_by("timestamp").limit(self.batch_size)
+        count, last = 0, None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            count += len(page)
+            if len(page) < self.batch_size:
+                return count
+            last = page[-1]
+
+    def purge_session(self, session_ref):
+        '''
+        Delete a session's messages in batches, then the session document
+
+        returns:
+         - Number of messages deleted (or counted, in a dry run)
+        '''
+        if self.dry_run:
+            return self.count_messages(session_ref)
+
+        messages = session_ref.collection("messages").limit(self.batch_size)
+        deleted = 0
+        while True:
+            page = list(messages.stream())
+            if page:
+                batch = self.db.batch()
+                for message in page:
+                    batch.delete(message.reference)
+                batch.commit()
+                deleted += len(page)
+            if len(page) < self.batch_size:
+                break
+        session_ref.delete()
+        return deleted
+
+    def _purge(self, session):
+        try:
+            return self.purge_session(session.reference)
+        except Exception as e:
+            print(f"[ERROR] Could not delete chat session {session.id}: {e}")
+            return None
+
+    def run(self, cutoff):
+        '''
+        returns:
+         - Dict with the sessions and messages deleted (or counted), failures and throughput
+        '''
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for page in self.stale_sessions(cutoff):
+                for deleted in pool.map(self._purge, page):
+                    if deleted is None:
+                        self.failed += 1
+                    else:
+                        self.sessions += 1
+                        self.messages += deleted
+        elapsed = time.perf_counter() - start
+
+        documents = self.sessions + self.messages
+        return {"dry_run": self.dry_run, "sessions": self.sessions, "messages": self.messages,
+                "failed": self.failed, "seconds": round(elapsed, 3),
+                "documents_per_second": round(documents / elapsed, 1) if elapsed else 0.0}
+
+
+def connect(emulator=None, project=None):
+    '''
+    The chat Firestore, or a Firestore emulator at `emulator` (host:port), which needs no
+    credentials
+    '''
+    if emulator:
+        os.environ["FIRESTORE_EMULATOR_HOST"] = emulator
+        from google.cloud import firestore
+        return firestore.Client(project=project or os.getenv("CHAT_PROJECT_ID") or "demo-chatbot")
+
+    from firebase_config import get_db
+    return get_db()
+
+
+def delete_old_chats(db=None, hours=24, **options):
+    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+    cleanup = ChatCleanup(db if db is not None else connect(), **options)
+    stats = cleanup.run(cutoff_time)
+    action = "Would delete" if cleanup.dry_run else "Deleted"
+    print(f"[INFO] {action} {stats['sessions']} chat sessions and {stats['messages']} messages "
+          f"in {stats['seconds']} s ({stats['documents_per_second']} documents/s), "
+          f"{stats['failed']} failed")
+    return stats
 
 
-def delete_old_chats():
-    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=24)
-    chat_sessions = db.collection("chat_sessions").where(
-        "last_active", "<", cutoff_time).stream()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, default=24,
+                        help='Delete sessions inactive for longer than this')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+    parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--emulator', default=os.getenv('FIRESTORE_EMULATOR_HOST'),
+                        help='host:port of a Firestore emulator')
+    parser.add_argument('--project', help='Project id to use with the emulator')
+    args = parser.parse_args()
 
-    for session in chat_sessions:
-        db.collection("chat_sessions").document(session.id).delete()
-        print(f"Deleted chat session {session.id}")
+    delete_old_chats(connect(args.emulator, args.project), hours=args.hours,
+                     batch_size=args.batch_size, page_size=args.page_size,
+                     workers=args.workers, dry_run=args.dry_run)
 
 
-delete_old_chats()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Bytes of a sha256 digest, the form keys are stored in next to their vectors
+DIGEST_SIZE = 32
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_embedding_cache(directory, model, capacity=50000):
+    '''
+    Return the process-wide cache for `model` stored in `directory`, opening it on first use.
+    Every RAG version shares it, so only one instance ever writes the files.
+    '''
+    key = (os.path.abspath(directory), model)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = EmbeddingCache(directory, model, capacity)
+        return _caches[key]
+
+
+class EmbeddingCache():
+    '''
+    Disk-backed embedding cache keyed by model name and text hash.
+
+    Vectors live in one float32 file of `capacity` fixed-size slots, opened with memory-mapping,
+    so the cache never grows past capacity * dimension * 4 bytes. A JSON index maps each key to
+    its slot in least-recently-used order; when the file is full the least recently used slot
+    is overwritten. The index is rewritten atomically on `flush` and at exit.
+
+    A slot is overwritten right away but the index only on `flush`, so after a crash the index
+    can point a key at a slot that now holds another text's vector. Each slot's key digest is
+    kept in a second memory-mapped file, written with the vector, and `get` only returns a
+    vector whose slot still carries its key.
+
+    Only one process should write a given directory at a time.
+
+    Args:
+     - directory: Parent directory, each model gets its own subdirectory
+     - model: Embedding model name, part of every key
+     - capacity: Maximum number of vectors kept
+    '''
+
+    def __init__(self, directory, model, capacity=50000):
+        self.model = model
+        self.capacity = capacity
+        self.directory = os.path.join(directory, model.replace("/", "_"))
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.keys_path = os.path.join(self.directory, "keys.bin")
+        self.hits = 0
+        self.misses = 0
+        self.dimension = None
+        self.vectors = None
+        self.slot_keys = None  # Digest of the key each slot holds, all zeros while it is written
+        self.slots = OrderedDict()  # key -> slot, least recently used first
+        self.free_slots = []  # Slots no key holds, used before evicting
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        if not all(os.path.exists(path)
+                   for path in (self.index_path, self.vectors_path, self.keys_path)):
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] Ignoring unreadable embedding cache index: {e}")
+            return
+        if index.get("model") != self.model or index.get("capacity") != self.capacity:
+            print("[INFO] Embedding cache settings changed, starting a new cache")
+            return
+        self.dimension = index["dimension"]
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+",
+                                 shape=(self.capacity, self.dimension))
+        self.slot_keys = np.memmap(self.keys_path, dtype=np.uint8, mode="r+",
+                                   shape=(self.capacity, DIGEST_SIZE))
+        self.slots = OrderedDict((key, slot) for key, slot in index["slots"])
+        self.free_slots = sorted(set(range(self.capacity)) - set(self.slots.values()), reverse=True)
+
+    def _create_vectors(self, dimension):
+        self.dimension = dimension
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="w+",
+                                 shape=(self.capacity, dimension))
+        self.slot_keys = np.memmap(self.keys_path, dtype=np.uint8, mode="w+",
+                                   shape=(self.capacity, DIGEST_SIZE))
+        self.slots = OrderedDict()
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+
+    def key(self, text, kind):
+        # Query and document embeddings can differ for the same text, so both are part of the key
+        return hashlib.sha256(f"{self.model}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            slot = self.slots.get(key)
+            if slot is not None and self.slot_keys[slot].tobytes() != bytes.fromhex(key):
+                del self.slots[key]  # Overwritten after the index was last flushed
+                self.free_slots.append(slot)  # By a vector no key in the index points to
+                self._dirty = True
+                slot = None
+            if slot is None:
+                self.misses += 1
+                return None
+            self.slots.move_to_end(key)
+            self.hits += 1
+            return self.vectors[slot].tolist()
+
+    def put(self, key, vector):
+        with self._lock:
+            if self.vectors is None or len(vector) != self.dimension:
+                self._create_vectors(len(vector))
+
+            if key in self.slots:
+                slot = self.slots.pop(key)
+            elif self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                _, slot = self.slots.popitem(last=False)  # Evict the least recently used
+            self.slot_keys[slot] = 0  # Matches no key until the new vector is in place
+            self.vectors[slot] = vector
+            self.slot_keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+            self.slots[key] = slot
+            self._dirty = True
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self.vectors is None:
+                return
+            self.vectors.flush()
+            self.slot_keys.flush()
+            index = {"model": self.model, "capacity": self.capacity,
+                     "dimension": self.dimension, "slots": list(self.slots.items())}
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.slots), "capacity": self.capacity,
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Embeddings wrapper that looks every text up in an EmbeddingCache before calling the model.
+    Used both to index the knowledge base and to embed user questions at query time.
+
+    Args:
+     - embeddings: The underlying embeddings model
+     - cache: EmbeddingCache shared with every other user of the same model
+     - flush_every: Persist the index after this many new query embeddings. Document
+       embeddings are persisted by whoever embeds them, once per index sync.
+    '''
+
+    def __init__(self, embeddings, cache, flush_every=50):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.flush_every = flush_every
+        self._pending_queries = 0
+
+    def embed_documents(self, texts):
+        keys = [self.cache.key(text, "document") for text in texts]
+        vectors = [self.cache.get(key) for key in keys]
+
+        # Embed each missing text once, even if it appears several times in the batch
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], texts[i])
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            for key, vector in computed.items():
+                self.cache.put(key, vector)
+            vectors = [vector if vector is not None else computed[key]
+                       for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        key = self.cache.key(text, "query")
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(key, vector)
+            self._pending_queries += 1
+            if self._pending_queries >= self.flush_every:
+                self._pending_queries = 0
+                self.cache.flush()
+        return vector
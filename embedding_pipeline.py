@@ -0,0 +1,122 @@
+import time
+import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class RateLimiter():
+    '''
+    Spaces calls at least 1 / `rate` seconds apart, across every thread sharing it
+
+    Args:
+     - rate: Calls per second, None or 0 for no limit
+    '''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class EmbeddingPipeline():
+    '''
+    Embeds a stream of chunks in batches on a bounded thread pool and hands every batch to
+    `upsert` as soon as it is embedded, so a build that fails part-way keeps what it stored.
+
+    Embedding requests are rate limited across the workers and retried with exponential
+    backoff and jitter; a batch that still fails after `max_retries` retries fails the run.
+    At most `workers * 2` batches are in memory at a time, however many chunks there are.
+
+    Args:
+     - embeddings: Embeddings model, its `embed_documents` is called once per batch
+     - batch_size: Texts per embedding request
+     - workers: Number of requests in flight at once
+     - requests_per_second: Embedding request rate limit, None or 0 for no limit
+     - max_retries: Retries of a failed request before giving up
+     - backoff: Seconds before the first retry, doubled for each following one
+    '''
+
+    def __init__(self, embeddings, batch_size=100, workers=4, requests_per_second=None,
+                 max_retries=5, backoff=0.5):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.workers = workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def batches(self, chunks):
+        batch = []
+        for chunk_id, document in chunks:
+            batch.append((chunk_id, document))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def embed(self, batch):
+        texts = [document.page_content for _, document in batch]
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                return batch, self.embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                print(f"[WARNING] Embedding request failed ({e}), retrying in {delay:.1f} s")
+                time.sleep(delay)
+
+    def run(self, chunks, upsert):
+        '''
+        Args:
+         - chunks: Iterable of (chunk id, Document), consumed lazily
+         - upsert: Called as upsert(ids, vectors, documents) for every embedded batch, from
+           the calling thread only
+
+        returns:
+         - Dict with the number of texts and batches embedded, retries and throughput
+        '''
+        start = time.perf_counter()
+        texts = batches = 0
+        pending = set()
+        batch_iter = self.batches(chunks)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while True:
+                    for batch in batch_iter:
+                        pending.add(pool.submit(self.embed, batch))
+                        if len(pending) >= self.workers * 2:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch, vectors = future.result()
+                        upsert([chunk_id for chunk_id, _ in batch], vectors,
+                               [document for _, document in batch])
+                        texts += len(batch)
+                        batches += 1
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        elapsed = time.perf_counter() - start
+        return {"texts": texts, "batches": batches, "retries": self.retries,
+                "seconds": round(elapsed, 3),
+                "texts_per_second": round(texts / elapsed, 1) if elapsed else 0.0}
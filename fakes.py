@@ -0,0 +1,373 @@
+'''
+Local stand-ins for the external services the chatbot talks to, used by benchmark.py to run
+without credentials. They implement only the parts of each client API the app uses.
+'''
+import re
+import math
+import time
+import random
+import uuid
+import zlib
+import threading
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+DESCENDING = "DESCENDING"
+
+
+class FakeFirestore():
+    '''
+    In-memory Firestore with a request counter.
+
+    Args:
+     - latency: Seconds each round-trip to the "server" takes
+
+    Counters:
+     - round_trips: Requests that would cross the network (reads, single writes, batch commits)
+     - writes: Individual document writes, whether sent alone or inside a batch
+    '''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.docs = {}  # document path tuple -> dict
+        self.round_trips = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def reset_counters(self):
+        with self._lock:
+            self.round_trips = 0
+            self.writes = 0
+
+    def _round_trip(self, writes=0):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.round_trips += 1
+            self.writes += writes
+
+    def _write(self, path, data, merge=False):
+        with self._lock:
+            if merge and path in self.docs:
+                self.docs[path] = {**self.docs[path], **data}
+            else:
+                self.docs[path] = dict(data)
+
+    def _delete(self, path):
+        with self._lock:
+            self.docs.pop(path, None)
+
+
+class FakeSnapshot():
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field)
+
+
+class FakeDocument():
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.store, self.path + (name,))
+
+    def set(self, data, merge=False):
+        self.store._round_trip(writes=1)
+        self.store._write(self.path, data, merge)
+
+    def get(self):
+        self.store._round_trip()
+        return FakeSnapshot(self, self.store.docs.get(self.path))
+
+    def delete(self):
+        self.store._round_trip(writes=1)
+        self.store._delete(self.path)
+
+
+class FakeQuery():
+    def __init__(self, collection, filters=(), order=None, limit=None, start_after=None):
+        self.collection = collection
+        self.filters = filters
+        self.order = order
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        state = dict(filters=self.filters, order=self.order,
+                     limit=self._limit, start_after=self._start_after)
+        state.update(changes)
+        return FakeQuery(self.collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self.filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(order=(field, direction))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, cursor):
+        # Like Firestore, a snapshot cursor breaks ties on the ordered field by document path
+        if isinstance(cursor, FakeSnapshot):
+            cursor = (cursor.to_dict(), cursor.reference.path)
+        else:
+            cursor = (cursor, None)
+        return self._copy(start_after=cursor)
+
+    def _matches(self, data):
+        ops = {"<": lambda a, b: a < b, "<=": lambda a, b: a <= b, "==": lambda a, b: a == b,
+               ">": lambda a, b: a > b, ">=": lambda a, b: a >= b}
+        for field, op, value in self.filters:
+            if field not in data or not ops[op](data[field], value):
+                return False
+        return True
+
+    def stream(self):
+        store = self.collection.store
+        store._round_trip()
+        prefix = self.collection.path
+        with store._lock:
+            rows = [(path, dict(data)) for path, data in store.docs.items()
+                    if len(path) == len(prefix) + 1 and path[:-1] == prefix]
+        rows = [(path, data) for path, data in rows if self._matches(data)]
+
+        if self.order:
+            field, direction = self.order
+            reverse = str(direction).upper().endswith(DESCENDING)
+            rows = [(path, data) for path, data in rows if field in data]
+            rows.sort(key=lambda row: (row[1][field], row[0]), reverse=reverse)
+            if self._start_after is not None:
+                values, cursor_path = self._start_after
+                cursor = (values[field], cursor_path or ())
+                if cursor_path is None and not reverse:
+                    # Without a document to tie-break on, skip every row equal to the cursor
+                    rows = [(path, data) for path, data in rows if data[field] > values[field]]
+                else:
+                    rows = [(path, data) for path, data in rows
+                            if ((data[field], path) < cursor if reverse else (data[field], path) > cursor)]
+
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for path, data in rows:
+            yield FakeSnapshot(FakeDocument(store, path), data)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        super().__init__(self)
+
+    def document(self, document_id=None):
+        return FakeDocument(self.store, self.path + (document_id or uuid.uuid4().hex,))
+
+    def add(self, data):
+        doc = self.document()
+        doc.set(data)
+        return None, doc
+
+
+class FakeWriteBatch():
+    def __init__(self, store):
+        self.store = store
+        self._ops = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def set(self, reference, data, merge=False):
+        self._ops.append(("set", reference.path, data, merge))
+
+    def delete(self, reference):
+        self._ops.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        self.store._round_trip(writes=len(self._ops))
+        for op, path, data, merge in self._ops:
+            if op == "set":
+                self.store._write(path, data, merge)
+            else:
+                self.store._delete(path)
+        self._ops = []
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Deterministic bag-of-words embeddings: texts sharing words get similar vectors, which is
+    enough to compare retrieval quality offline.
+
+    Args:
+     - size: Vector dimension
+     - latency: Seconds each embedding request takes, per call not per text
+     - failure_rate: Share of requests that fail with a ConnectionError, like transient API errors
+     - max_batch: Texts per request, larger lists are sent as several requests one after the
+       other, like the Gemini client does
+    '''
+
+    def __init__(self, size=512, latency=0.0, failure_rate=0.0, seed=0, max_batch=None):
+        self.size = size
+        self.latency = latency
+        self.max_batch = max_batch
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+        self.texts_embedded = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _embed(self, text):
+        vector = [0.0] * self.size
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode("utf-8")) % self.size] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def _request(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failures += 1
+                raise ConnectionError("Embedding request failed (injected)")
+            self.calls += 1
+            self.texts_embedded += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_documents(self, texts):
+        if not self.max_batch:
+            return self._request(texts)
+        vectors = []
+        for i in range(0, len(texts), self.max_batch):
+            vectors.extend(self._request(texts[i:i + self.max_batch]))
+        return vectors
+
+    def embed_query(self, text):
+        return self._request([text])[0]
+
+
+class FakeSpreadsheet():
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.modified = 0
+        self.metadata_requests = 0
+
+    def get_lastUpdateTime(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.metadata_requests += 1
+        return f"2025-01-01T00:00:{self.modified:06d}Z"
+
+
+class FakeSheet():
+    '''
+    In-memory gspread worksheet. Every edit bumps the spreadsheet's modified time, the way
+    Drive does.
+
+    Args:
+     - records: Rows, as returned by get_all_records
+     - latency: Seconds a full download of the rows takes
+    '''
+
+    def __init__(self, records, latency=0.0):
+        self.records = [dict(row) for row in records]
+        self.latency = latency
+        self.spreadsheet = FakeSpreadsheet()
+        self.downloads = 0
+
+    def get_all_records(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.downloads += 1
+        return [dict(row) for row in self.records]
+
+    def update_row(self, position, **changes):
+        self.records[position] = {**self.records[position], **changes}
+        self.spreadsheet.modified += 1
+
+    def append_row(self, row):
+        self.records.append(dict(row))
+        self.spreadsheet.modified += 1
+
+    def delete_row(self, position):
+        del self.records[position]
+        self.spreadsheet.modified += 1
+
+
+class FakeTwilioMessages():
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, body=None, from_=None, to=None, **kwargs):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+        with self.client._lock:
+            self.client.sent.append({"from": from_, "to": to, "body": body})
+        return FakeTwilioMessage(uuid.uuid4().hex)
+
+
+class FakeTwilioMessage():
+    def __init__(self, sid):
+        self.sid = sid
+
+
+class FakeTwilioClient():
+    '''
+    Stand-in for twilio.rest.Client that records outgoing messages instead of sending them
+
+    Args:
+     - latency: Seconds each call to the REST API takes
+    '''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = []
+        self.messages = FakeTwilioMessages(self)
+        self._lock = threading.Lock()
+
+
+class TokenDelayChatModel(FakeListChatModel):
+    '''
+    FakeListChatModel that takes time like a real LLM: `first_token_delay` seconds before the
+    first token, then `token_delay` seconds per token. Streams word by word; `invoke` pays the
+    same total delay before returning the whole response.
+    '''
+
+    first_token_delay: float = 0.0
+    token_delay: float = 0.0
+    calls: int = 0
+
+    def _tokens(self):
+        self.calls += 1
+        response = self.responses[self.i]
+        self.i = self.i + 1 if self.i < len(self.responses) - 1 else 0
+        return re.findall(r"\S+\s*|\s+", response)
+
+    def _call(self, *args, **kwargs):
+        tokens = self._tokens()
+        time.sleep(self.first_token_delay + self.token_delay * len(tokens))
+        return "".join(tokens)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.first_token_delay)
+        for token in self._tokens():
+            time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
@@ -0,0 +1,77 @@
+import re
+import time
+from difflib import SequenceMatcher
+from metrics import Counter, Histogram
+
+
+def normalize_question(text):
+    '''
+    Lowercase, drop punctuation and collapse whitespace so trivial variations match
+    '''
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+class FAQIndex():
+    '''
+    Precomputed index of the FAQ dataset, consulted before the RAG chain runs.
+    A question that matches an FAQ closely enough is answered with the canned answer,
+    without any embedding or LLM call.
+
+    Args:
+     - dataset: List of {"question": ..., "answer": ...} dicts, as loaded from FAQS_PATH
+     - cutoff: Minimum similarity (0-1) for a fuzzy match to be trusted. Exact matches after
+       normalization always win; a cutoff above 1 disables fuzzy matching.
+    '''
+
+    def __init__(self, dataset, cutoff=0.9):
+        self.cutoff = cutoff
+        self.answers = {}
+        for faq in dataset:
+            question, answer = faq.get('question'), faq.get('answer')
+            if question and answer:
+                self.answers.setdefault(normalize_question(question), answer)
+        self.questions = list(self.answers)
+
+        self.lookups = Counter()
+        self.hits = Counter()
+        self.latency = Histogram()
+
+    def match(self, question):
+        '''
+        returns:
+         - The canned answer and the match score, or (None, 0.0) when nothing reaches the cutoff
+        '''
+        start = time.perf_counter()
+        normalized = normalize_question(question)
+        answer, score = self.answers.get(normalized), 1.0
+
+        if answer is None:
+            score, best = 0.0, None
+            matcher = SequenceMatcher(b=normalized, autojunk=False)
+            threshold = max(self.cutoff, 0.0)
+            for candidate in self.questions:
+                matcher.set_seq1(candidate)
+                # Both are cheap upper bounds of ratio, skip candidates that cannot reach the cutoff
+                if (matcher.real_quick_ratio() < threshold
+                        or matcher.quick_ratio() < max(threshold, score)):
+                    continue
+                candidate_score = matcher.ratio()
+                if candidate_score > score:
+                    score, best = candidate_score, candidate
+            if best is not None and score >= self.cutoff:
+                answer = self.answers[best]
+            else:
+                score = 0.0
+
+        self.lookups.inc()
+        if answer is not None:
+            self.hits.inc()
+            self.latency.observe(time.perf_counter() - start)
+        return answer, score
+
+    def stats(self):
+        lookups, hits = self.lookups.value, self.hits.value
+        return {"lookups": lookups, "served_without_llm": hits,
+                "fast_path_ratio": hits / lookups if lookups else 0.0,
+                "fast_path_p50": self.latency.percentile(50),
+                "fast_path_p99": self.latency.percentile(99)}
@@ -1,30 +1,49 @@
 import os
-import firebase_admin
+import threading
 from dotenv import load_dotenv
-from firebase_admin import credentials, firestore
 
 load_dotenv()
 
-config_json = {
-    "type": os.getenv("CHAT_TYPE"),
-    "project_id": os.getenv("CHAT_PROJECT_ID"),
-    "private_key_id": os.getenv("CHAT_KEY_ID"),
-    "private_key": os.getenv("CHAT_PRIVATE_KEY"),
-    "client_email": os.getenv("CHAT_CLIENT_EMAIL"),
-    "client_id": os.getenv("CHAT_CLIENT_ID"),
-    "auth_uri": os.getenv("CHAT_AUTH_URI"),
-    "token_uri": os.getenv("CHAT_TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("CHAT_AUTH_PROVIDER_X509_CERT_URL"),
-    "client_x509_cert_url": os.getenv("CHAT_CLIENT_X509_CERT_URL"),
-    "universe_domain": os.getenv("CHAT_UNIVERSAL_DOMAIN")
-}
-
-
-cred = credentials.Certificate(config_json)
-firebase_admin.initialize_app(cred)
-
-# Initialize with a unique name
-if "chat_app" not in firebase_admin._apps:
-    chat_app = firebase_admin.initialize_app(cred, name="chat_app")
-
-db = firestore.client(chat_app)  # Pass the named app
+_db = None
+_db_lock = threading.Lock()
+
+
+def get_db():
+    '''
+    Firestore client for the chat app, connected on first use so importing this module
+    stays cheap and does not need credentials
+    '''
+    global _db
+    with _db_lock:
+        if _db is not None:
+            return _db
+
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        config_json = {
+            "type": os.getenv("CHAT_TYPE"),
+            "project_id": os.getenv("CHAT_PROJECT_ID"),
+            "private_key_id": os.getenv("CHAT_KEY_ID"),
+            "private_key": os.getenv("CHAT_PRIVATE_KEY"),
+            "client_email": os.getenv("CHAT_CLIENT_EMAIL"),
+            "client_id": os.getenv("CHAT_CLIENT_ID"),
+            "auth_uri": os.getenv("CHAT_AUTH_URI"),
+            "token_uri": os.getenv("CHAT_TOKEN_URI"),
+            "auth_provider_x509_cert_url": os.getenv("CHAT_AUTH_PROVIDER_X509_CERT_URL"),
+            "client_x509_cert_url": os.getenv("CHAT_CLIENT_X509_CERT_URL"),
+            "universe_domain": os.getenv("CHAT_UNIVERSAL_DOMAIN")
+        }
+
+        cred = credentials.Certificate(config_json)
+        if firebase_admin._DEFAULT_APP_NAME not in firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+
+        # Initialize with a unique name
+        if "chat_app" not in firebase_admin._apps:
+            chat_app = firebase_admin.initialize_app(cred, name="chat_app")
+        else:
+            chat_app = firebase_admin.get_app("chat_app")
+
+        _db = firestore.client(chat_app)  # Pass the named app
+        return _db
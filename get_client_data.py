@@ -1,32 +1,82 @@
 import os
-import gspread
-import firebase_admin
+import hashlib
 from dotenv import load_dotenv
-from oauth2client.service_account import ServiceAccountCredentials
 
 load_dotenv()
 
 
+def row_fingerprint(row):
+    return hashlib.sha1(repr(sorted(row.items())).encode('utf-8')).hexdigest()
+
+
+def row_key(row, position):
+    # Rows are keyed by Product ID, rows without one fall back to their position
+    return str(row.get('Product ID') or f'row-{position}').strip()
+
+
+class SheetDelta():
+    '''
+    Products added, updated and removed between two polls of the product sheet.
+    Falsy when nothing changed, so callers can keep testing `if not new_data`.
+
+    Args:
+     - added, updated: Lists of the new or changed rows
+     - removed: List of the Product IDs that disappeared
+     - records: Every current row, for consumers that still need the full snapshot
+     - base_snapshot, snapshot: Numbers of the downloads the delta goes from and to. A consumer
+       may apply the delta only to state built from `base_snapshot`.
+    '''
+
+    def __init__(self, added=None, updated=None, removed=None, records=None,
+                 base_snapshot=None, snapshot=None):
+        self.added = added or []
+        self.updated = updated or []
+        self.removed = removed or []
+        self.records = records
+        self.base_snapshot = base_snapshot
+        self.snapshot = snapshot
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+    def __repr__(self):
+        return (f"SheetDelta(added={len(self.added)}, updated={len(self.updated)}, "
+                f"removed={len(self.removed)})")
+
+
 class GetData():
     '''
     Class to get product data, depending on the type of database used for storing
 
     Args:
      - datatype: The Type of Data to fetch could be 'firebase' or 'googlesheet'
+     - sheet: An already opened worksheet (e.g. fakes.FakeSheet) used instead of connecting
+     - spreadsheet_id: Google Sheets document to read, defaults to GOOGLE_SHEETS_ID
+     - about_path: Text file with the business's About text, None uses the ElectroNest one
     '''
 
-    def __init__(self, storage_type):
+    def __init__(self, storage_type, sheet=None, spreadsheet_id=None, about_path=None):
         self.storage_type = storage_type
+        self.spreadsheet_id = spreadsheet_id or os.getenv("GOOGLE_SHEETS_ID")
+        self.about_path = about_path
         self.client_db = None
-        self.sheet = None
+        self.sheet = sheet
         self.records = None
+        self.row_fingerprints = {}  # row key -> fingerprint of the last downloaded rows
+        self.last_update_time = None
+        self.snapshot = 0  # Number of the last download
+        self.downloads = 0
 
         if self.storage_type == 'firebase':
             self.initialize_firebase()
-        elif self.storage_type == 'googlesheet':
+        elif self.storage_type == 'googlesheet' and self.sheet is None:
             self.initialize_google_sheets()
 
     def initialize_firebase(self):
+        # Imported here so only deployments that use Firebase pay for it
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
         # This File connects to the client/business database
         config_json = {
             "type": os.getenv("BUSINESS_TYPE"),
@@ -42,13 +92,13 @@ class GetData():
             "universe_domain": os.getenv("BUSINESS_UNIVERSAL_DOMAIN")
         }
 
-        client_cred = firebase_admin.credentials.Certificate(config_json)
+        client_cred = credentials.Certificate(config_json)
 
         # Initialize with a unique name
         if "client_app" not in firebase_admin._apps:
             client_app = firebase_admin.initialize_app(
                 client_cred, name="client_app")
-            self.client_db = firebase_admin.firestore.client(
+            self.client_db = firestore.client(
                 client_app)  # Pass the named app
 
     def get_client_db_firebase(self):
@@ -72,6 +122,10 @@ class GetData():
         """
         Initializes Google Sheets API connection.
         """
+        # Imported here so only deployments that use Google Sheets pay for it
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+
         scope = ["https://spreadsheets.google.com/feeds",
                  "https://www.googleapis.com/auth/drive"]
 
@@ -93,7 +147,7 @@ class GetData():
             config_json, scope)
         client = gspread.authorize(creds)
         self.sheet = client.open_by_key(
-            os.getenv("GOOGLE_SHEETS_ID")).sheet1  # Load first sheet
+            self.spreadsheet_id).sheet1  # Load first sheet
         return self.sheet
 
     def get_client_db_googlesheet(self):
@@ -103,24 +157,77 @@ class GetData():
         if not self.sheet:
             return []
 
+        self.last_update_time = self.sheet_last_update_time()
         self.records = self.sheet.get_all_records()
+        self.snapshot += 1
+        self.downloads += 1
+        self.row_fingerprints = {row_key(row, i): row_fingerprint(row)
+                                 for i, row in enumerate(self.records)}
         return self.records
 
+    def sheet_last_update_time(self):
+        '''
+        Drive's modifiedTime for the spreadsheet: one small metadata request that tells
+        whether anything changed, without downloading the rows. None when unavailable, so the
+        rows are downloaded and compared instead. The `lastUpdateTime` attribute of older
+        gspread versions is only read when the spreadsheet is opened, so it is not used.
+        '''
+        spreadsheet = getattr(self.sheet, 'spreadsheet', None)
+        if not hasattr(spreadsheet, 'get_lastUpdateTime'):
+            return None
+        try:
+            return spreadsheet.get_lastUpdateTime()
+        except Exception as e:
+            print(f'[WARNING] Could not read the sheet modified time: {e}')
+            return None
+
     def get_latest_google_sheets(self):
+        '''
+        Poll the sheet for changes
+
+        returns:
+         - SheetDelta of the rows added, updated and removed since the last download
+        '''
         if not self.sheet:
-            return []
+            return SheetDelta()
+
+        update_time = self.sheet_last_update_time()
+        if update_time is not None and update_time == self.last_update_time:
+            print('[INFO] No Changes Detected in Google Sheets (modified time unchanged)')
+            return SheetDelta(records=self.records, base_snapshot=self.snapshot,
+                              snapshot=self.snapshot)
 
         current_data = self.sheet.get_all_records()
+        self.downloads += 1
+        current_fingerprints = {}
+        delta = SheetDelta(records=current_data, base_snapshot=self.snapshot,
+                           snapshot=self.snapshot + 1)
+        for i, row in enumerate(current_data):
+            key = row_key(row, i)
+            current_fingerprints[key] = row_fingerprint(row)
+            previous = self.row_fingerprints.get(key)
+            if previous is None:
+                delta.added.append(row)
+            elif previous != current_fingerprints[key]:
+                delta.updated.append(row)
+        delta.removed = [key for key in self.row_fingerprints if key not in current_fingerprints]
 
-        if current_data != self.records:
-            print('[INFO] Detected New Changes. Updating Data...')
-            # print(f'Current Data {current_data}\n\n Old Data {self.records}')
-            self.records = current_data
-            return current_data
-        print('[INFO] No Changes Detected in Google Sheets')
-        return []
+        self.records = current_data
+        self.snapshot += 1
+        self.row_fingerprints = current_fingerprints
+        self.last_update_time = update_time
+
+        if delta:
+            print(f'[INFO] Detected New Changes: {delta}. Updating Data...')
+        else:
+            print('[INFO] No Changes Detected in Google Sheets')
+        return delta
+
+    def get_about(self):
+        if self.about_path:
+            with open(self.about_path, encoding='utf-8') as f:
+                return f.read()
 
-    def run(self):
         about = '''' \
         About Us
         Who We Are
@@ -151,6 +258,10 @@ class GetData():
 
         Follow us on social media for the latest arrivals and exclusive deals!
         '''
+        return about
+
+    def run(self):
+        about = self.get_about()
 
         if self.storage_type.lower() == 'firebase':
             return self.get_client_db_firebase(), about
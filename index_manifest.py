@@ -0,0 +1,45 @@
+'''
+Manifest of the last knowledge base version that was completely built and published.
+It lets a restarted process serve that version straight from disk, and tells whether the
+source data (FAQs, About text, product rows) changed since it was built.
+'''
+import os
+import json
+import hashlib
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def source_fingerprint(faqs, about, products):
+    '''
+    Hash of everything the knowledge base is built from
+    '''
+    payload = json.dumps([faqs, about, products], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Ignoring unreadable index manifest: {e}")
+        return None
+
+
+def write_manifest(directory, version, fingerprint, about, products):
+    '''
+    Record a published version, together with the About text and product rows it was built
+    from so the product catalog can be rebuilt at startup without fetching the sheet
+    '''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, MANIFEST_FILE)
+    manifest = {"version": version, "fingerprint": fingerprint,
+                "about": about, "products": products}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,116 @@
+import re
+import math
+from collections import Counter
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_][a-z0-9]+)*")
+# A token mixing letters and digits names something exactly: P0042, S24, SM-A546, 25L
+IDENTIFIER_PATTERN = re.compile(r"^(?=.*\d)(?=.*[a-z])[a-z0-9_-]+$")
+# Constant of reciprocal rank fusion, the usual value from the original paper
+RRF_K = 60
+
+
+def tokenize(text):
+    '''
+    Lowercase word tokens. Hyphenated identifiers are kept whole and also split into their
+    parts, so "SM-A546" matches both "sm-a546" and "a546".
+    '''
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if "-" in token or "_" in token:
+            tokens.extend(part for part in re.split(r"[-_]", token) if part)
+    return tokens
+
+
+class LexicalIndex():
+    '''
+    In-memory BM25 inverted index over the same chunks as the vector store, keyed by the same
+    content-hash ids. Rebuilt whenever the vector store is (re)built or opened, so both always
+    hold the same rows.
+
+    Args:
+     - documents: Dict of {chunk id: Document}
+     - k1, b: BM25 term frequency saturation and length normalization
+    '''
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = dict(documents)
+        self.postings = {}  # term -> list of (chunk id, term frequency)
+        self.lengths = {}
+        for chunk_id, document in self.documents.items():
+            counts = Counter(tokenize(document.page_content))
+            self.lengths[chunk_id] = sum(counts.values())
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, []).append((chunk_id, frequency))
+        self.average_length = (sum(self.lengths.values()) / len(self.lengths)) if self.lengths else 0.0
+
+    def __len__(self):
+        return len(self.documents)
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore):
+        '''
+        Build the index from the rows of an existing Chroma collection, without embedding
+        '''
+        # Imported here, so the tokenizer can be used without loading langchain
+        from langchain.schema import Document
+
+        rows = vectorstore.get(include=["documents", "metadatas"])
+        return cls({chunk_id: Document(page_content=text, metadata=metadata or {})
+                    for chunk_id, text, metadata in zip(rows["ids"], rows["documents"],
+                                                        rows["metadatas"])})
+
+    def idf(self, term):
+        frequency = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.documents) - frequency + 0.5) / (frequency + 0.5))
+
+    def scores(self, query):
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for chunk_id, frequency in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / self.average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
+
+    def search(self, query, k=5, required=()):
+        '''
+        Args:
+         - required: Terms a chunk must all contain to be returned, e.g. the query's identifiers
+
+        returns:
+         - List of (chunk id, Document), best BM25 score first
+        '''
+        scores = self.scores(query)
+        for term in required:
+            containing = {chunk_id for chunk_id, _ in self.postings.get(term, ())}
+            scores = {chunk_id: score for chunk_id, score in scores.items() if chunk_id in containing}
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [(chunk_id, self.documents[chunk_id]) for chunk_id in best]
+
+    def identifiers(self, query):
+        '''
+        Identifier-like tokens of the query that occur in the indexed chunks
+        '''
+        return [token for token in tokenize(query)
+                if IDENTIFIER_PATTERN.match(token) and token in self.postings]
+
+
+def reciprocal_rank_fusion(rankings, k=5):
+    '''
+    Merge ranked lists of (chunk id, Document) by summing 1 / (RRF_K + rank) per list
+
+    returns:
+     - The top `k` Documents
+    '''
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, (chunk_id, document) in enumerate(ranking, 1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank)
+            documents.setdefault(chunk_id, document)
+    return [documents[chunk_id] for chunk_id in sorted(scores, key=scores.get, reverse=True)[:k]]
@@ -0,0 +1,128 @@
+import threading
+
+
+class Lease():
+    '''
+    A request's hold on one knowledge base version: the version is not dropped or closed until
+    the lease is released. Released by `release()` or by leaving a `with` block over it, which
+    yields the RAG; releasing more than once is harmless.
+    '''
+
+    def __init__(self, live_rag, rag, version):
+        self.live_rag = live_rag
+        self.rag = rag
+        self.version = version
+        self.released = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.rag
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self.live_rag.release(self.version)
+
+
+class LiveRAG():
+    '''
+    Double-buffered holder for the RAG instance the Flask routes serve from.
+
+    A refresh builds the next version into its own collection off to the side and `publish`
+    swaps it in with a single pointer assignment. Every request leases the version it started
+    on, so in-flight requests finish against the old index, and a superseded version is dropped
+    as soon as its last lease is released.
+    '''
+
+    def __init__(self):
+        self.rag = None
+        self.version = None
+        self._lock = threading.Lock()
+        self._leases = {}   # version -> number of requests currently using it
+        self._retired = {}  # version -> superseded RAG waiting for its leases to drain
+        self._unloaded = []  # (version, RAG) unloaded and waiting for their leases to drain
+
+    def acquire(self):
+        '''
+        Lease the currently published RAG for the duration of a request
+
+        returns:
+         - Lease, use it as `with live_rag.acquire() as rag:` or call its `release()`
+        '''
+        with self._lock:
+            if self.rag is None:
+                raise RuntimeError("No knowledge base has been published yet")
+            rag, version = self.rag, self.version
+            self._leases[version] = self._leases.get(version, 0) + 1
+        return Lease(self, rag, version)
+
+    def release(self, version):
+        with self._lock:
+            self._leases[version] -= 1
+            if not self._leases[version]:
+                del self._leases[version]
+        self.collect()
+
+    def publish(self, rag, version):
+        '''
+        Atomically make `rag` the version every new request is served from
+        '''
+        with self._lock:
+            previous, previous_version = self.rag, self.version
+            self.rag, self.version = rag, version
+            if previous is not None and previous is not rag:
+                if previous.collection_name == rag.collection_name:
+                    # Same collection reopened, the new RAG serves from it: only close the old one
+                    self._unloaded.append((previous_version, previous))
+                else:
+                    self._retired[previous_version] = previous
+        print(f"[INFO] Published knowledge base version {version}")
+        self.collect()
+
+    def unload(self):
+        '''
+        Stop serving the published version without dropping its collection, which stays on
+        disk to be opened again. Requests holding a lease finish on it, then it is closed.
+
+        returns:
+         - The RAG that was published
+        '''
+        with self._lock:
+            rag, version = self.rag, self.version
+            self.rag, self.version = None, None
+            if rag is not None:
+                self._unloaded.append((version, rag))
+        self.collect()
+        return rag
+
+    def tracked_versions(self):
+        '''
+        Versions this holder still owns: the published one, and retired or unloaded ones
+        still in use
+        '''
+        with self._lock:
+            return {self.version, *self._retired, *(version for version, _ in self._unloaded)}
+
+    def collect(self):
+        '''
+        Drop every retired version and close every unloaded one that no request is using
+        anymore
+        '''
+        with self._lock:
+            drained = [version for version in self._retired if version not in self._leases]
+            to_drop = [self._retired.pop(version) for version in drained]
+            to_close = [rag for version, rag in self._unloaded if version not in self._leases]
+            self._unloaded = [(version, rag) for version, rag in self._unloaded
+                              if version in self._leases]
+
+        # Deleting a collection touches disk, so do it outside the lock
+        for version, rag in zip(drained, to_drop):
+            rag.drop_vector_store()
+            print(f"[INFO] Garbage-collected knowledge base version {version}")
+        for rag in to_close:
+            rag.close()
@@ -0,0 +1,204 @@
+import json
+import time
+import bisect
+import random
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import deque
+
+# Latency buckets in seconds, from a cache hit to a slow LLM answer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter():
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram():
+    '''
+    Latency histogram with fixed buckets, plus a window of recent samples for percentiles
+
+    Args:
+     - buckets: Upper bounds of the buckets, in seconds
+     - window: Number of most recent observations kept for `percentile`
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=2048):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self._recent.append(value)
+
+    def percentile(self, q):
+        '''
+        The q-th percentile (0-100) of the recent observations, None before the first one
+        '''
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry():
+    '''
+    Named, labelled counters and histograms, rendered in the Prometheus text format.
+    A metric with labels is one Counter or Histogram per combination of label values.
+    '''
+
+    def __init__(self):
+        self._families = {}  # name -> (type, help, {label tuple: metric})
+        self._gauges = {}    # name -> (help, function returning the current value)
+        self._lock = threading.Lock()
+
+    def _metric(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help_text, {}))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        return self._metric("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._metric("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, help_text, function):
+        '''
+        Register a gauge read from `function` at every scrape
+        '''
+        with self._lock:
+            self._gauges[name] = (help_text, function)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            families = [(name, kind, help_text, list(metrics.items()))
+                        for name, (kind, help_text, metrics) in sorted(self._families.items())]
+            gauges = sorted(self._gauges.items())
+
+        for name, kind, help_text, metrics in families:
+            if kind == "counter":
+                # The text format names a counter's family after its samples, _total included
+                name = f"{name}_total"
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, metric in sorted(metrics, key=lambda item: item[0]):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+                    continue
+                with metric._lock:
+                    counts, count, total = list(metric.bucket_counts), metric.count, metric.sum
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    le = bound if bound == "+Inf" else _format_value(float(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+        for name, (help_text, function) in gauges:
+            try:
+                value = function()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry served on /metrics
+REGISTRY = Registry()
+STAGE_SECONDS = "chatbot_stage_seconds"
+REFRESH_PHASE_SECONDS = "chatbot_refresh_phase_seconds"
+# Fraction of requests whose full trace is logged, see start_trace
+TRACE_SAMPLE_RATE = 0.0
+
+_current_trace = ContextVar("trace", default=None)
+
+
+class Trace():
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def to_dict(self, status):
+        return {"trace": self.name, "status": status,
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+                "spans": self.spans}
+
+
+def start_trace(name, sample_rate=None):
+    '''
+    Start collecting the spans of a request on this thread, if it is sampled
+
+    returns:
+     - Token for finish_trace
+    '''
+    rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    return _current_trace.set(Trace(name) if rate and random.random() < rate else None)
+
+
+def finish_trace(token, status="ok"):
+    '''
+    Log the trace started with `token` as one JSON line, if it was sampled
+    '''
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    if trace is not None:
+        print(f"[TRACE] {json.dumps(trace.to_dict(status))}")
+
+
+@contextmanager
+def stage(name, metric=STAGE_SECONDS):
+    '''
+    Time a block as one stage of a request, or one phase of a knowledge base refresh with
+    metric=REFRESH_PHASE_SECONDS, and add it as a span to the current trace
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if metric == REFRESH_PHASE_SECONDS:
+            histogram = REGISTRY.histogram(metric, "Time per knowledge base refresh phase, in seconds",
+                                           phase=name)
+        else:
+            histogram = REGISTRY.histogram(metric, "Time per request stage, in seconds", stage=name)
+        histogram.observe(elapsed)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append({"stage": name,
+                                "start_ms": round((start - trace.started) * 1000, 3),
+                                "duration_ms": round(elapsed * 1000, 3)})
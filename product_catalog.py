@@ -0,0 +1,246 @@
+import re
+import time
+from collections import namedtuple
+from langchain.schema import Document
+from metrics import Histogram
+from get_client_data import row_fingerprint
+
+PRODUCT_FIELDS = (
+    ("Product ID", "Product ID"),
+    ("Product Name", "Name"),
+    ("Category", "Category"),
+    ("Brand", "Brand"),
+    ("Model", "Model"),
+    ("Description", "Description"),
+    ("Specifications", "Specifications"),
+    ("Price", "Price"),
+    ("Stock", "Stock"),
+    ("Warranty", "Warranty"),
+)
+
+# Compact per-product record, one slot per sheet column
+ProductRecord = namedtuple(
+    "ProductRecord", ["product_id", "name", "category", "brand", "model", "description",
+                      "specifications", "price", "stock", "warranty"])
+
+PRODUCT_ID_PATTERN = re.compile(r"\b[a-z]\d{3,}\b", re.IGNORECASE)
+# Longest name/model, in words, looked for in a question
+MAX_NAME_WORDS = 8
+# (upper bound, band) pairs used for the price_band metadata, the last band is open-ended
+PRICE_BANDS = ((100, "under_100"), (500, "100_500"), (1000, "500_1000"),
+               (2000, "1000_2000"), (float("inf"), "over_2000"))
+
+
+def normalize_name(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", str(text).lower()).split())
+
+
+def render_product(product, separator=True):
+    '''
+    Render a product row the way it appears in the knowledge base text file
+    '''
+    text = "\n".join(f"{label}: {product.get(column, 'N/A')}" for column, label in PRODUCT_FIELDS)
+    return text + "\n\n---\n\n" if separator else text
+
+
+def parse_number(value):
+    '''
+    Parse sheet values like "$2,838" or "47" into a float, None when there is no number
+    '''
+    match = re.search(r"\d[\d,]*(?:\.\d+)?", str(value))
+    return float(match.group().replace(",", "")) if match else None
+
+
+def price_band(price):
+    amount = parse_number(price)
+    if amount is None:
+        return "unknown"
+    for limit, band in PRICE_BANDS:
+        if amount < limit:
+            return band
+    return PRICE_BANDS[-1][1]
+
+
+def category_aliases(category):
+    '''
+    Words that name a category in a question: "Smartphones" -> smartphones, smartphone
+    '''
+    name = normalize_name(category)
+    if not name or name == "n a":
+        return set()
+    head = name.split()[-1]
+    return {alias for word in (name, head) for alias in (word, word.rstrip("s")) if alias}
+
+
+def product_metadata(product):
+    '''
+    Structured metadata stored next to a product's vector, used for retrieval filters
+    '''
+    stock = parse_number(product.get("Stock"))
+    return {
+        "section": "product",
+        "product_id": str(product.get("Product ID", "")),
+        "category": str(product.get("Category", "N/A")),
+        "brand": str(product.get("Brand", "N/A")),
+        "price_band": price_band(product.get("Price")),
+        "stock": int(stock) if stock is not None else -1,
+        "in_stock": bool(stock),
+    }
+
+
+class ProductCatalog():
+    '''
+    In-memory structured index of the product sheet, keyed by Product ID, normalized name,
+    brand and model. Questions naming a product ("price of X", "is Y in stock") resolve to
+    its record with a few dict lookups, and the record is handed to the LLM as context
+    instead of relying on vector recall.
+
+    A catalog is never mutated once built, so requests can read it without locking.
+    `updated` returns a new catalog that shares every unchanged record with this one.
+    '''
+
+    def __init__(self):
+        self.records = {}       # product id -> ProductRecord
+        self.fingerprints = {}  # product id -> hash of the sheet row
+        self.by_name = {}       # normalized name -> tuple of product ids
+        self.by_model = {}      # normalized model -> tuple of product ids
+        self.by_brand = {}      # normalized brand -> tuple of product ids
+        self.categories = {}    # category alias -> category, as stored in the metadata
+        self.snapshot = None    # GetData snapshot the catalog was built from, when known
+        self.lookup_latency = Histogram()
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def make_record(product):
+        return ProductRecord(*(str(product.get(column, 'N/A')) for column, _ in PRODUCT_FIELDS))
+
+    def updated(self, products, delta=None):
+        '''
+        Build the catalog for a new sheet snapshot, re-indexing only added, changed and
+        removed rows
+
+        Args:
+         - products: Every current product row
+         - delta: Optional SheetDelta from the poller. If this catalog was built from the
+           delta's base snapshot only the delta's rows are looked at, instead of fingerprinting
+           the whole sheet again
+
+        returns:
+         - The new ProductCatalog
+         - Dict with the number of rows added, updated and removed
+        '''
+        catalog = ProductCatalog()
+        catalog.records = dict(self.records)
+        catalog.fingerprints = dict(self.fingerprints)
+        catalog.by_name = dict(self.by_name)
+        catalog.by_model = dict(self.by_model)
+        catalog.by_brand = dict(self.by_brand)
+
+        catalog.snapshot = delta.snapshot if delta is not None else None
+        if delta is not None and self.snapshot is not None and delta.base_snapshot == self.snapshot:
+            changed = delta.added + delta.updated
+            removed = [product_id for product_id in delta.removed if product_id in catalog.records]
+        else:
+            changed = products
+            seen = {str(product.get("Product ID", "")).strip() for product in products}
+            removed = [product_id for product_id in catalog.records if product_id not in seen]
+
+        counts = {"added": 0, "updated": 0, "removed": 0}
+        for product in changed:
+            product_id = str(product.get("Product ID", "")).strip()
+            if not product_id:
+                continue
+            fingerprint = row_fingerprint(product)
+            if catalog.fingerprints.get(product_id) == fingerprint:
+                continue
+
+            counts["updated" if product_id in catalog.records else "added"] += 1
+            catalog._remove(product_id)
+            catalog._add(product_id, catalog.make_record(product), fingerprint)
+
+        for product_id in removed:
+            catalog._remove(product_id)
+            counts["removed"] += 1
+
+        catalog.categories = {alias: category
+                              for category in {record.category for record in catalog.records.values()}
+                              for alias in category_aliases(category)}
+        return catalog, counts
+
+    def _add(self, product_id, record, fingerprint):
+        self.records[product_id] = record
+        self.fingerprints[product_id] = fingerprint
+        for index, value in ((self.by_name, record.name), (self.by_model, record.model),
+                             (self.by_brand, record.brand)):
+            key = normalize_name(value)
+            if key and key != "n a":
+                index[key] = index.get(key, ()) + (product_id,)
+
+    def _remove(self, product_id):
+        record = self.records.pop(product_id, None)
+        self.fingerprints.pop(product_id, None)
+        if record is None:
+            return
+        for index, value in ((self.by_name, record.name), (self.by_model, record.model),
+                             (self.by_brand, record.brand)):
+            key = normalize_name(value)
+            remaining = tuple(pid for pid in index.get(key, ()) if pid != product_id)
+            if remaining:
+                index[key] = remaining
+            else:
+                index.pop(key, None)
+
+    def lookup(self, question, limit=5):
+        '''
+        Find the products a question names directly, by Product ID, name or model.
+        A brand mentioned alongside narrows the matches to that brand.
+
+        returns:
+         - List of ProductRecord, at most `limit`
+        '''
+        start = time.perf_counter()
+        matched = []
+        for product_id in PRODUCT_ID_PATTERN.findall(question):
+            if product_id.upper() in self.records:
+                matched.append(product_id.upper())
+
+        words = normalize_name(question).split()
+        brands = set()
+        for size in range(min(MAX_NAME_WORDS, len(words)), 0, -1):
+            for i in range(len(words) - size + 1):
+                phrase = " ".join(words[i:i + size])
+                matched.extend(self.by_name.get(phrase, ()))
+                matched.extend(self.by_model.get(phrase, ()))
+                brands.update(self.by_brand.get(phrase, ()))
+
+        if brands:
+            matched = [product_id for product_id in matched if product_id in brands] or matched
+        records = [self.records[product_id] for product_id in dict.fromkeys(matched)][:limit]
+        self.lookup_latency.observe(time.perf_counter() - start)
+        return records
+
+    def detect_category(self, question):
+        '''
+        The product category a question names ("do you have smartphones?"), or None
+        '''
+        words = normalize_name(question).split()
+        for size in (2, 1):
+            for i in range(len(words) - size + 1):
+                category = self.categories.get(" ".join(words[i:i + size]))
+                if category:
+                    return category
+        return None
+
+    def documents(self, question, limit=5):
+        '''
+        Matched products as Documents, ready to be placed in the LLM context
+        '''
+        documents = []
+        for record in self.lookup(question, limit):
+            product = {column: value for (column, _), value in zip(PRODUCT_FIELDS, record)}
+            documents.append(Document(page_content=render_product(product, separator=False),
+                                      metadata={**product_metadata(product),
+                                                "source": "product_catalog"}))
+        return documents
@@ -0,0 +1,61 @@
+import re
+from metrics import REGISTRY, Counter, Histogram
+
+# Words that point back at an earlier turn ("how much is it?", "do you have a cheaper one?")
+REFERENCE_PATTERN = re.compile(
+    r"\b(it|its|it's|itself|that|this|these|those|they|them|their|theirs|he|she|him|her|"
+    r"one|ones|same|also|too|else|another|other|others|more|cheaper|bigger|smaller|"
+    r"better|instead|above|previous|last|former|latter)\b", re.IGNORECASE)
+# Openers that continue the previous question ("and in black?", "what about the S24?")
+FOLLOW_UP_OPENERS = ("and ", "or ", "but ", "so ", "what about", "how about", "then ")
+# Questions this short rarely stand on their own once there is history ("why?", "how much?")
+MIN_SELF_CONTAINED_WORDS = 4
+
+PATHS = ("no_history", "self_contained", "rewritten")
+
+
+class QuestionRouter():
+    '''
+    Decides whether a question must be rewritten by the LLM before retrieval. Only follow-ups
+    that refer to earlier turns are sent to the rewrite call; first messages and questions
+    that already stand on their own are retrieved with as they are.
+
+    Keeps a counter and a latency histogram (time to the standalone question) per path, for
+    this router's `stats`, and records both in the process-wide metrics registry labelled by
+    path, where they outlive the chain a refresh replaces and are exported on /metrics.
+    '''
+
+    def __init__(self):
+        self.counts = {path: Counter() for path in PATHS}
+        self.latency = {path: Histogram() for path in PATHS}
+
+    @staticmethod
+    def is_self_contained(question):
+        text = " ".join(question.lower().split())
+        if len(text.split()) < MIN_SELF_CONTAINED_WORDS or text.startswith(FOLLOW_UP_OPENERS):
+            return False
+        return REFERENCE_PATTERN.search(text) is None
+
+    def route(self, question, formatted_history):
+        if not formatted_history:
+            return "no_history"
+        return "self_contained" if self.is_self_contained(question) else "rewritten"
+
+    def observe(self, path, elapsed):
+        self.counts[path].inc()
+        self.latency[path].observe(elapsed)
+        REGISTRY.counter("chatbot_question_routes", "Questions, by how the standalone "
+                         "question was produced", path=path).inc()
+        REGISTRY.histogram("chatbot_question_route_seconds", "Time to the standalone question, "
+                           "in seconds", path=path).observe(elapsed)
+
+    def stats(self):
+        stats = {}
+        for path in PATHS:
+            stats[path] = {"count": self.counts[path].value,
+                           "p50": self.latency[path].percentile(50),
+                           "p99": self.latency[path].percentile(99)}
+        total = sum(self.counts[path].value for path in PATHS)
+        rewritten = self.counts["rewritten"].value
+        stats["rewrite_ratio"] = rewritten / total if total else 0.0
+        return stats
@@ -0,0 +1,121 @@
+import time
+import threading
+from collections import deque
+from metrics import Counter, Histogram
+
+
+class ReplyQueue():
+    '''
+    Bounded queue of incoming messages answered by a fixed pool of worker threads, so a
+    webhook can acknowledge a message at once and the reply is sent when it is ready.
+
+    Messages from the same user are handled one at a time and in the order they arrived,
+    while different users are served in parallel. Once `max_pending` messages are waiting,
+    `submit` refuses new ones so the caller can push back instead of queueing without bound.
+
+    Args:
+     - handler: Called as handler(user_id, message) by a worker, for each message
+     - workers: Number of worker threads
+     - max_pending: Maximum number of messages waiting or being handled
+    '''
+
+    def __init__(self, handler, workers=4, max_pending=1000):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.pending = 0
+        self.max_depth = 0
+        self._users = {}      # user id -> deque of (enqueued at, message), while the user has work
+        self._ready = deque()  # users with messages waiting and no worker on them
+        self._condition = threading.Condition()
+
+        self.enqueued = Counter()
+        self.rejected = Counter()
+        self.processed = Counter()
+        self.failed = Counter()
+        self.queue_wait = Histogram()
+        self.handling_time = Histogram()
+
+        self._workers = [threading.Thread(target=self._work, name=f"reply-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, user_id, message):
+        '''
+        Queue a message for the worker pool
+
+        returns:
+         - False if the queue is full and the message was not accepted
+        '''
+        with self._condition:
+            if self.pending >= self.max_pending:
+                self.rejected.inc()
+                return False
+            self.pending += 1
+            self.max_depth = max(self.max_depth, self.pending)
+
+            if user_id in self._users:
+                # A worker holds or is about to pick up this user, it will drain the message
+                self._users[user_id].append((time.perf_counter(), message))
+            else:
+                self._users[user_id] = deque([(time.perf_counter(), message)])
+                self._ready.append(user_id)
+                self._condition.notify()
+        self.enqueued.inc()
+        return True
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+                user_id = self._ready.popleft()
+                enqueued_at, message = self._users[user_id][0]
+
+            self.queue_wait.observe(time.perf_counter() - enqueued_at)
+            start = time.perf_counter()
+            try:
+                self.handler(user_id, message)
+                self.processed.inc()
+            except Exception as e:
+                self.failed.inc()
+                print(f"[ERROR] Could not reply to {user_id}: {e}")
+            self.handling_time.observe(time.perf_counter() - start)
+
+            with self._condition:
+                self.pending -= 1
+                messages = self._users[user_id]
+                messages.popleft()
+                if messages:
+                    # Back of the line, so one busy user cannot starve the others
+                    self._ready.append(user_id)
+                    self._condition.notify()
+                else:
+                    del self._users[user_id]
+                self._condition.notify_all()
+
+    def join(self, timeout=None):
+        '''
+        Wait until every queued message has been handled
+
+        returns:
+         - False if the timeout expired first
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        return {"depth": self.pending, "max_depth": self.max_depth,
+                "capacity": self.max_pending, "workers": len(self._workers),
+                "enqueued": self.enqueued.value, "rejected": self.rejected.value,
+                "processed": self.processed.value, "failed": self.failed.value,
+                "queue_wait_p50": self.queue_wait.percentile(50),
+                "queue_wait_p99": self.queue_wait.percentile(99),
+                "handling_p50": self.handling_time.percentile(50),
+                "handling_p99": self.handling_time.percentile(99)}
@@ -0,0 +1,141 @@
+import re
+import numpy as np
+from cache import LRUCache
+from faq_index import normalize_question
+from lexical_index import IDENTIFIER_PATTERN, tokenize
+from metrics import Counter
+
+# Questions about availability get a fresh answer every time
+STOCK_PATTERN = re.compile(
+    r"\b(stock|stocks|available|availability|sold out|how many|left|remaining)\b", re.IGNORECASE)
+# The answer prompt gives exact counts below this stock level, so such answers are not reused
+LOW_STOCK = 5
+
+
+class CachedResponse():
+    def __init__(self, answer, vector, specifics):
+        self.answer = answer
+        self.vector = vector
+        self.specifics = specifics
+
+
+def specific_tokens(question):
+    '''
+    Product ids, model numbers and other numbers in a question: "price of iPhone 15 Pro" and
+    "price of iPhone 14 Pro" embed almost identically but must not share an answer
+    '''
+    return frozenset(token for token in tokenize(question)
+                     if token.isdigit() or IDENTIFIER_PATTERN.match(token))
+
+
+class ResponseCache():
+    '''
+    LLM answers keyed on the standalone question (the question after history rewriting),
+    shared by every knowledge base version. Entries are scoped to the collection they were
+    answered from, so a refresh, which publishes a new collection, never serves an old answer.
+
+    A question is first looked up by its normalized text; otherwise its embedding is compared
+    with the cached questions of the same scope and the closest one is served if its cosine
+    similarity reaches `threshold` and it names the same identifiers and numbers.
+
+    Args:
+     - maxsize: Maximum number of answers kept, least recently used ones are evicted beyond that
+     - ttl: Seconds an answer may be served, None keeps it until evicted
+     - threshold: Minimum cosine similarity for a near-duplicate question to be served
+    '''
+
+    def __init__(self, maxsize=1000, ttl=3600, threshold=0.95):
+        self.threshold = threshold
+        self.entries = LRUCache(maxsize, ttl)  # (scope, normalized question) -> CachedResponse
+
+        self.exact_hits = Counter()
+        self.semantic_hits = Counter()
+        self.misses = Counter()
+        self.bypassed = Counter()
+
+    def scoped(self, scope, embeddings):
+        '''
+        View of the cache for one knowledge base version
+        '''
+        return ScopedResponseCache(self, scope, embeddings)
+
+    def get(self, scope, question, embed):
+        '''
+        returns:
+         - The cached answer for the question or a near-duplicate of it, None on a miss
+        '''
+        key = (scope, normalize_question(question))
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.exact_hits.inc()
+            return entry.answer
+
+        specifics = specific_tokens(question)
+        candidates = [(cached_key, cached) for cached_key, cached in self.entries.items()
+                      if cached_key[0] == scope and cached.specifics == specifics]
+        if candidates:
+            vector = np.asarray(embed(question), dtype=np.float32)
+            matrix = np.stack([cached.vector for _, cached in candidates])
+            norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(vector) or 1.0)
+            similarities = matrix @ vector / np.where(norms == 0, 1.0, norms)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                entry = self.entries.get(candidates[best][0])  # Refreshes its recency
+                if entry is not None:
+                    self.semantic_hits.inc()
+                    return entry.answer
+
+        self.misses.inc()
+        return None
+
+    def put(self, scope, question, answer, context, embed):
+        '''
+        Cache an answer, unless it depends on stock levels: the question asks about
+        availability or the context holds a product that is out of or low on stock
+        '''
+        if is_stock_sensitive(question, context):
+            self.bypassed.inc()
+            return False
+        vector = np.asarray(embed(question), dtype=np.float32)
+        self.entries.set((scope, normalize_question(question)),
+                         CachedResponse(answer, vector, specific_tokens(question)))
+        return True
+
+    def drop_scope(self, scope):
+        for key, _ in self.entries.items():
+            if key[0] == scope:
+                self.entries.pop(key)
+
+    def stats(self):
+        exact, semantic = self.exact_hits.value, self.semantic_hits.value
+        lookups = exact + semantic + self.misses.value
+        return {"size": len(self.entries), "exact_hits": exact, "semantic_hits": semantic,
+                "misses": self.misses.value, "bypassed": self.bypassed.value,
+                "evictions": self.entries.evictions,
+                "hit_rate": (exact + semantic) / lookups if lookups else 0.0}
+
+
+class ScopedResponseCache():
+    def __init__(self, cache, scope, embeddings):
+        self.cache = cache
+        self.scope = scope
+        self.embeddings = embeddings
+
+    def get(self, question):
+        return self.cache.get(self.scope, question, self.embeddings.embed_query)
+
+    def put(self, question, answer, context):
+        return self.cache.put(self.scope, question, answer, context, self.embeddings.embed_query)
+
+    def drop(self):
+        self.cache.drop_scope(self.scope)
+
+
+def is_stock_sensitive(question, context):
+    if STOCK_PATTERN.search(question):
+        return True
+    for document in context:
+        stock = document.metadata.get("stock")
+        if document.metadata.get("section") == "product" and stock is not None and stock < LOW_STOCK:
+            return True
+    return False
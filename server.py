@@ -0,0 +1,226 @@
+'''
+Production entry point: serves /faq and /whatsapp from a pool of threads sharing one loaded
+knowledge base per process, and runs the Google Sheets poller once.
+
+Usage:
+    python server.py --max-concurrent 16
+    MAX_CONCURRENT_REQUESTS=16 SERVER_THREADS=32 python server.py
+
+Uses waitress when it is installed, otherwise werkzeug's threaded server. Scale up with
+threads, not processes: a process owns its working directory (./chroma_db, ./embedding_cache
+and the index versions built there), so a second server started in the same directory exits.
+'''
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+from metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:  # Windows, the working directory lock is not supported
+    fcntl = None
+
+# Held for the life of the process, see lock_working_directory
+_directory_lock = None
+
+
+class ConcurrencyLimit():
+    '''
+    WSGI middleware admitting at most `max_concurrent` requests at a time. A request arriving
+    while all slots are taken waits up to `queue_timeout` seconds for one, then gets a 503 with
+    Retry-After, so a burst is shed instead of piling up behind slow LLM calls.
+
+    A slot is held until the response has been fully sent, which covers streamed answers.
+    Paths in `exempt` (metrics scrapes) are never limited.
+
+    Args:
+     - wsgi_app: The WSGI application to protect
+     - max_concurrent: Requests handled at once, 0 for no limit
+     - queue_timeout: Seconds a request waits for a slot
+     - exempt: Paths served without taking a slot
+    '''
+
+    def __init__(self, wsgi_app, max_concurrent=32, queue_timeout=5.0, exempt=('/metrics',)):
+        self.wsgi_app = wsgi_app
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.exempt = set(exempt)
+        self.active = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self._lock = threading.Lock()
+        self.rejected = REGISTRY.counter("chatbot_requests_rejected",
+                                         "Requests shed because every slot stayed taken")
+        REGISTRY.gauge("chatbot_requests_active", "Requests being handled",
+                       lambda: self.active)
+
+    def __call__(self, environ, start_response):
+        if self._slots is None or environ.get('PATH_INFO') in self.exempt:
+            return self.wsgi_app(environ, start_response)
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected.inc()
+            body = json.dumps({"error": "The server is busy, please retry shortly"}).encode()
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'application/json'),
+                            ('Content-Length', str(len(body))), ('Retry-After', '1')])
+            return [body]
+
+        with self._lock:
+            self.active += 1
+        try:
+            return _Release(self.wsgi_app(environ, start_response), self._release)
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+
+class _Release():
+    '''
+    Response iterable calling `release` once the server closes it
+    '''
+
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+def warm_up(app_module, timeout=600):
+    '''
+    Connect to the chat store and wait for the default tenant's knowledge base to be published
+    (opened from disk, or built in the background on a first start) before taking traffic
+
+    returns:
+     - True if the default tenant is ready to answer
+    '''
+    tenants = app_module.tenants
+    if tenants.default is None:
+        return True  # Tenants are loaded by their first request
+
+    start = time.perf_counter()
+    app_module.get_chat_store()
+    lease = tenants.ensure_loaded(tenants.default)
+    while lease is None:
+        if time.perf_counter() - start > timeout:
+            print(f"[WARNING] Knowledge base not ready after {timeout} sec, serving anyway")
+            return False
+        time.sleep(0.1)
+        if tenants.default.live_rag.rag is not None:
+            lease = tenants.ensure_loaded(tenants.default)
+    lease.release()
+    print(f"[INFO] Warmed up in {time.perf_counter() - start:.2f} sec")
+    return True
+
+
+def lock_working_directory(path):
+    '''
+    Lock `path` for the life of the process, so only one server writes the knowledge base
+    files and embedding cache of a working directory
+
+    returns:
+     - False if another process holds the lock
+    '''
+    global _directory_lock
+    if fcntl is None:
+        return True
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _directory_lock = lock
+    return True
+
+
+def make_server(app, host, port, threads=None, max_concurrent=16, queue_timeout=5.0):
+    '''
+    A threaded WSGI server for `app` with its concurrency limit applied
+
+    Under waitress only requests that reached a thread can be shed, so it gets more threads
+    than slots: the extra ones wait for a slot and answer 503 when none frees up in time.
+
+    Args:
+     - threads: waitress worker threads, defaults to twice `max_concurrent`
+
+    returns:
+     - Object with `serve_forever()` and `shutdown()`
+    '''
+    wsgi_app = ConcurrencyLimit(app, max_concurrent, queue_timeout)
+    if max_concurrent and threads is not None and threads <= max_concurrent:
+        print(f"[WARNING] {threads} threads never exhaust {max_concurrent} slots, "
+              f"using {max_concurrent * 2} threads")
+        threads = None
+    threads = threads or (2 * max_concurrent if max_concurrent else 16)
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        # werkzeug starts a thread per connection, the concurrency limit bounds the work done
+        from werkzeug.serving import make_server as werkzeug_server
+        return werkzeug_server(host, port, wsgi_app, threaded=True)
+
+    server = create_server(wsgi_app, host=host, port=port, threads=threads)
+    server.serve_forever = server.run
+    server.shutdown = server.close
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 5000)))
+    parser.add_argument('--threads', type=int,
+                        default=int(os.getenv('SERVER_THREADS', 0)) or None,
+                        help='Worker threads with waitress, more than --max-concurrent '
+                             '(default twice as many)')
+    parser.add_argument('--max-concurrent', type=int,
+                        default=int(os.getenv('MAX_CONCURRENT_REQUESTS', 16)),
+                        help='Requests handled at once, 0 for no limit')
+    parser.add_argument('--queue-timeout', type=float,
+                        default=float(os.getenv('REQUEST_QUEUE_TIMEOUT', 5)),
+                        help='Seconds a request waits for a free slot before a 503')
+    parser.add_argument('--warmup-timeout', type=float,
+                        default=float(os.getenv('WARMUP_TIMEOUT', 600)))
+    args = parser.parse_args()
+
+    if not lock_working_directory(os.getenv('SERVER_LOCK', './server.lock')):
+        sys.exit(f"[ERROR] Another server is running in {os.getcwd()}, "
+                 "run one process per directory and scale it with --threads")
+
+    # Imported here, so the knowledge base is opened once, in the serving process
+    import app as app_module
+
+    warm_up(app_module, args.warmup_timeout)
+    if os.getenv('SHEETS_POLLER', '1').lower() in ('1', 'true', 'yes'):
+        app_module.start_sheet_poller()
+
+    server = make_server(app_module.app, args.host, args.port, threads=args.threads,
+                         max_concurrent=args.max_concurrent, queue_timeout=args.queue_timeout)
+    print(f"[INFO] Serving on {args.host}:{args.port} with at most {args.max_concurrent or 'unlimited'} "
+          f"concurrent requests")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import threading
+from metrics import Counter
+
+
+class Flight():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight():
+    '''
+    Coalesces identical concurrent calls: the first caller for a key runs the call, callers
+    arriving while it runs wait for its result instead of running it again.
+
+    A follower waits at most `timeout` seconds; if the leader takes longer or fails, the
+    follower runs the call itself. Nothing is kept once a call completes, later callers start
+    a new flight (repeated questions are served by the ResponseCache instead).
+
+    Args:
+     - timeout: Seconds a follower waits for the leader's result
+    '''
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._flights = {}  # key -> Flight in progress
+        self._lock = threading.Lock()
+
+        self.leaders = Counter()
+        self.followers = Counter()
+        self.fallbacks = Counter()  # Followers that gave up waiting and ran the call themselves
+
+    def join(self, key):
+        '''
+        returns:
+         - The Flight for the key
+         - True if the caller is its leader and must call `complete`
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                self.leaders.inc()
+                return flight, True
+        return flight, False
+
+    def complete(self, key, flight, result=None, failed=False):
+        '''
+        Publish the leader's result, or its failure, to the waiting followers
+        '''
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result, flight.failed = result, failed
+        flight.done.set()
+
+    def wait(self, flight):
+        '''
+        returns:
+         - The leader's result, or None if the follower has to run the call itself
+        '''
+        if flight.done.wait(self.timeout) and not flight.failed:
+            self.followers.inc()
+            return flight.result
+        self.fallbacks.inc()
+        return None
+
+    def do(self, key, function):
+        '''
+        Run `function()` once for every concurrent caller with the same key
+
+        returns:
+         - The result of `function()`
+         - True if it came from another caller's flight
+        '''
+        flight, leader = self.join(key)
+        if not leader:
+            result = self.wait(flight)
+            if result is not None:
+                return result, True
+            return function(), False
+
+        try:
+            result = function()
+        except BaseException:
+            self.complete(key, flight, failed=True)
+            raise
+        self.complete(key, flight, result)
+        return result, False
+
+    def stats(self):
+        leaders, followers = self.leaders.value, self.followers.value
+        calls = leaders + followers + self.fallbacks.value
+        return {"in_flight": len(self._flights), "leaders": leaders, "followers": followers,
+                "fallbacks": self.fallbacks.value,
+                "coalescing_ratio": followers / calls if calls else 0.0}
@@ -0,0 +1,222 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from live_rag import LiveRAG
+
+DEFAULT_TENANT = 'default'
+
+
+class Tenant():
+    '''
+    One business served by this process: where its knowledge base is kept on disk, where its
+    product data comes from, and the LiveRAG its requests are served from while it is loaded.
+
+    Args:
+     - tenant_id: Name used to select the tenant in requests, and its directory name
+     - faqs_path: The business's FAQ dataset
+     - text_file: Knowledge base text file written on every refresh
+     - chroma_dir: Directory of its Chroma collections and index manifest
+     - storage_type, spreadsheet_id: Where its product rows are read from, see GetData
+     - whatsapp_number: Twilio number it receives WhatsApp messages on, e.g. "whatsapp:+1..."
+     - system_prompt: Instructions for the answer LLM, None uses RAG's default prompt
+     - rewrite_prompt: Instructions for rewriting follow-ups into standalone questions, None
+       uses RAG's default prompt
+     - about_path: Text file with the business's About text, indexed with its products
+    '''
+
+    def __init__(self, tenant_id, faqs_path, text_file, chroma_dir, storage_type=None,
+                 spreadsheet_id=None, whatsapp_number=None, system_prompt=None,
+                 rewrite_prompt=None, about_path=None):
+        self.tenant_id = tenant_id
+        self.faqs_path = faqs_path
+        self.text_file = text_file
+        self.chroma_dir = chroma_dir
+        self.storage_type = storage_type
+        self.spreadsheet_id = spreadsheet_id
+        self.whatsapp_number = whatsapp_number
+        self.system_prompt = system_prompt
+        self.rewrite_prompt = rewrite_prompt
+        self.about_path = about_path
+
+        self.live_rag = LiveRAG()
+        self.get_data_instance = None  # Connected to the product store on first use
+        self.checked = False  # Whether the index on disk was checked against the source data
+        self.check_pending = False  # The startup check is running, the poller leaves it alone
+        self.lock = threading.Lock()  # Held while the knowledge base is opened from disk
+        # Held by a refresh from choosing its version until it is published, so two refreshes
+        # never build into the same collection. Reentrant: the startup check refreshes under it.
+        self.refresh_lock = threading.RLock()
+
+    def __repr__(self):
+        return f"Tenant({self.tenant_id!r})"
+
+    def session_id(self, user_id):
+        '''
+        Chat session of a user with this business. The default tenant keeps the bare user id,
+        so single-business deployments find their existing history.
+        '''
+        return user_id if self.tenant_id == DEFAULT_TENANT else f"{self.tenant_id}:{user_id}"
+
+    def unload(self):
+        '''
+        Release the knowledge base held in memory, it stays on disk to be opened again
+        '''
+        rag = self.live_rag.unload()
+        if rag is not None and rag.response_cache is not None:
+            rag.response_cache.drop_scope(rag.cache_scope)
+        return rag
+
+
+def load_tenants(tenants_file=None, tenants_dir='./tenants'):
+    '''
+    Tenants listed in `tenants_file`, a JSON list of objects with an "id" and any Tenant
+    argument. Paths not given default to files under `tenants_dir`/<id>. Without a file, the
+    single business configured by TEXT_FILE, FAQS_PATH, STORAGE_TYPE and ABOUT_PATH is the
+    default tenant.
+
+    returns:
+     - Dict of {tenant id: Tenant}
+    '''
+    if not tenants_file:
+        return {DEFAULT_TENANT: Tenant(DEFAULT_TENANT,
+                                       faqs_path=os.getenv('FAQS_PATH'),
+                                       text_file=os.getenv('TEXT_FILE'),
+                                       chroma_dir='./chroma_db',
+                                       storage_type=os.getenv('STORAGE_TYPE'),
+                                       spreadsheet_id=os.getenv('GOOGLE_SHEETS_ID'),
+                                       whatsapp_number=os.getenv('TWILIO_WHATSAPP_NUMBER'),
+                                       about_path=os.getenv('ABOUT_PATH'))}
+
+    with open(tenants_file, encoding='utf-8') as f:
+        configs = json.load(f)
+
+    tenants = {}
+    for config in configs:
+        config = dict(config)
+        tenant_id = config.pop('id')
+        directory = os.path.join(tenants_dir, tenant_id)
+        config.setdefault('faqs_path', os.path.join(directory, 'faqs.json'))
+        config.setdefault('text_file', os.path.join(directory, 'knowledge_base.txt'))
+        config.setdefault('chroma_dir', os.path.join(directory, 'chroma_db'))
+        config.setdefault('about_path', os.path.join(directory, 'about.txt'))
+        tenants[tenant_id] = Tenant(tenant_id, **config)
+    return tenants
+
+
+class TenantRegistry():
+    '''
+    Every configured tenant, with at most `max_loaded` knowledge bases held in memory.
+
+    A tenant is loaded by its first request and the least recently used one is unloaded once
+    more than `max_loaded` are; its index stays on disk and is opened again by its next request.
+    Tenant objects themselves are small and kept for the life of the process.
+
+    `max_loaded` caps a count, not memory: an unloaded tenant's Chroma client is closed, but
+    the process keeps the allocator's high-water mark and chromadb's shared caches. Size it
+    from the resident memory measured per loaded tenant (`benchmark.py tenants`).
+
+    Args:
+     - tenants: Dict of {tenant id: Tenant}
+     - loader: Called as loader(tenant) to open the tenant's knowledge base
+     - max_loaded: Maximum number of tenants with a knowledge base in memory
+    '''
+
+    def __init__(self, tenants, loader, max_loaded=50):
+        self.tenants = tenants
+        self.loader = loader
+        self.max_loaded = max_loaded
+        self.by_number = {tenant.whatsapp_number: tenant for tenant in tenants.values()
+                          if tenant.whatsapp_number}
+        self.loads = 0
+        self.evictions = 0
+        self._loaded = OrderedDict()  # tenant id -> Tenant, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tenants)
+
+    @property
+    def default(self):
+        '''
+        The tenant requests that name none are served by, if there is one
+        '''
+        if DEFAULT_TENANT in self.tenants:
+            return self.tenants[DEFAULT_TENANT]
+        return next(iter(self.tenants.values())) if len(self.tenants) == 1 else None
+
+    def resolve(self, tenant_id=None, whatsapp_number=None):
+        '''
+        The tenant named by a request, by id or by the number a WhatsApp message was sent to
+
+        returns:
+         - The Tenant, or None if the request names no known tenant
+        '''
+        if tenant_id:
+            return self.tenants.get(tenant_id)
+        if whatsapp_number and whatsapp_number in self.by_number:
+            return self.by_number[whatsapp_number]
+        return self.default
+
+    def ensure_loaded(self, tenant):
+        '''
+        Open the tenant's knowledge base if it is not in memory, mark it most recently used and
+        lease it. The lease is taken under the registry lock, so another request cannot evict
+        the tenant between this call and the request using it: an evicted tenant is only closed
+        once its leases are released.
+
+        returns:
+         - Lease of the knowledge base, to release once the request is done, or None if the
+           tenant has no knowledge base to serve yet
+        '''
+        while True:
+            with self._lock:
+                if tenant.tenant_id in self._loaded:
+                    lease = self._lease(tenant)
+                    if lease is not None:
+                        self._loaded.move_to_end(tenant.tenant_id)
+                        return lease
+
+            with tenant.lock:
+                if tenant.live_rag.rag is None:
+                    self.loader(tenant)
+                    self.loads += 1
+                if tenant.live_rag.rag is None:
+                    return None
+
+            with self._lock:
+                lease = self._lease(tenant)
+                if lease is None:
+                    continue  # Evicted again since it was loaded, load it once more
+                self._loaded[tenant.tenant_id] = tenant
+                self._loaded.move_to_end(tenant.tenant_id)
+                evicted = []
+                while len(self._loaded) > self.max_loaded:
+                    evicted.append(self._loaded.popitem(last=False)[1])
+                self.evictions += len(evicted)
+
+            # Unloading touches the response cache, so do it outside the lock
+            for old in evicted:
+                old.unload()
+                print(f"[INFO] Unloaded knowledge base of tenant {old.tenant_id}")
+            return lease
+
+    @staticmethod
+    def _lease(tenant):
+        try:
+            return tenant.live_rag.acquire()
+        except RuntimeError:
+            return None  # Unloaded by an eviction that has not finished yet
+
+    def loaded(self):
+        '''
+        Tenants with a knowledge base in memory, most recently used last
+        '''
+        with self._lock:
+            return list(self._loaded.values())
+
+    def stats(self):
+        with self._lock:
+            return {"tenants": len(self.tenants), "loaded": len(self._loaded),
+                    "max_loaded": self.max_loaded, "loads": self.loads,
+                    "evictions": self.evictions}
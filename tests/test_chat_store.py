@@ -0,0 +1,61 @@
+import pytest
+from chat_store import ChatStore
+from fakes import FakeFirestore
+
+
+def messages_of(db, user_id):
+    return [data for path, data in db.docs.items()
+            if path[:2] == ("chat_sessions", user_id) and path[2:3] == ("messages",)]
+
+
+def answer_turn(chat_store, user_id, turn):
+    # The write path of app.answer_question: read the history, store only the new turn
+    chat_history = chat_store.get_chat_history(user_id)
+    updated_history = chat_history + [{"text": f"question {turn}", "sender": "user"},
+                                      {"text": f"answer {turn}", "sender": "bot"}]
+    chat_store.store_message(updated_history[len(chat_history):], user_id)
+
+
+@pytest.mark.parametrize("cache_size", [0, 1000])
+def test_one_batched_commit_per_turn(cache_size):
+    db = FakeFirestore()
+    chat_store = ChatStore(db, cache_size=cache_size)
+    for turn in range(10):
+        answer_turn(chat_store, "user", turn)
+
+    db.reset_counters()
+    chat_store.store_message([{"text": "question", "sender": "user"},
+                              {"text": "answer", "sender": "bot"}], "user")
+    # 2 messages and the session's last_active, sent in one commit
+    assert db.writes == 3
+    assert db.round_trips == 1
+
+
+def test_history_is_not_reinserted():
+    db = FakeFirestore()
+    chat_store = ChatStore(db, cache_size=0)
+
+    for turn in range(20):
+        db.reset_counters()
+        answer_turn(chat_store, "user", turn)
+        assert db.writes == 3
+        # One history read plus one batch commit, however long the conversation is
+        assert db.round_trips == 2
+
+    stored = messages_of(db, "user")
+    assert len(stored) == 40
+    assert sorted(message["text"] for message in stored) == sorted(
+        [f"question {turn}" for turn in range(20)] + [f"answer {turn}" for turn in range(20)])
+    assert "last_active" in db.docs[("chat_sessions", "user")]
+
+
+def test_history_cache_skips_reads():
+    db = FakeFirestore()
+    chat_store = ChatStore(db, cache_size=1000)
+
+    answer_turn(chat_store, "user", 0)
+    db.reset_counters()
+    answer_turn(chat_store, "user", 1)
+    assert db.round_trips == 1  # The commit only, the history comes from the cache
+    assert chat_store.get_chat_history("user")[-2:] == [
+        {"text": "question 1", "sender": "user"}, {"text": "answer 1", "sender": "bot"}]